@@ -14,7 +14,21 @@ celery_app = Celery(
   "search_engine",
   broker=redis_url,
   backend=redis_url,
-  include=['app.tasks.indexing_tasks']
+  include=['app.tasks.indexing_tasks', 'app.tasks.crawl_tasks']
 )
 
 celery_app.autodiscover_tasks(['app.tasks'])
+
+# Periodic jobs, run by `celery -A app.celery_app beat`
+beat_schedule = {}
+if settings.RECRAWL_INTERVAL_SECONDS > 0:
+  beat_schedule["recrawl-articles"] = {
+    "task": "app.tasks.crawl_tasks.recrawl_articles",
+    "schedule": settings.RECRAWL_INTERVAL_SECONDS,
+  }
+if settings.COMPACTION_INTERVAL_SECONDS > 0:
+  beat_schedule["compact-index"] = {
+    "task": "app.tasks.indexing_tasks.compact_index",
+    "schedule": settings.COMPACTION_INTERVAL_SECONDS,
+  }
+celery_app.conf.beat_schedule = beat_schedule
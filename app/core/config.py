@@ -2,7 +2,7 @@ import os
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
-  FETCHED_ARTICLES: str = "./data/fetched_sample_articles.json"
+  FETCHED_ARTICLES: str = "./data/fetched_sample_articles.jsonl"  # JSONL, one article per line
   SQLITE_DB: str = "./data/wikipedia_articles.db"
 
   # Redis configuration with Docker-friendly defaults
@@ -10,6 +10,89 @@ class Settings(BaseSettings):
   REDIS_PORT: int = int(os.getenv('REDIS_PORT', '6380')) 
   REDIS_DB: int = int(os.getenv('REDIS_DB', '0'))
 
+  # ingest_articles: articles per transaction when bulk loading the crawler output
+  INGEST_CHUNK_SIZE: int = 5000
+
+  # Streaming first-time setup: crawl -> SQLite -> index through bounded queues, searchable while crawling
+  PIPELINED_SETUP: bool = False
+  PIPELINE_QUEUE_SIZE: int = 200  # fetched articles waiting to be ingested, fetching pauses when full
+  PIPELINE_BATCH_SIZE: int = 50  # articles per SQLite transaction / index update
+  PIPELINE_BATCH_WAIT_SECONDS: float = 1.0  # max wait to fill a batch before flushing a partial one
+
+  # Incremental recrawl: how often celery beat schedules it (0 disables the periodic job)
+  RECRAWL_INTERVAL_SECONDS: int = 24 * 60 * 60
+
+  # Deleted / updated documents are folded into the index by a compaction task: queued right away once
+  # this many are waiting, otherwise picked up by the periodic run (0 disables the periodic job)
+  COMPACTION_MIN_DIRTY_DOCS: int = 100
+  COMPACTION_INTERVAL_SECONDS: int = 5 * 60
+
+  # Segmented index: new documents go into small segments, this many segments of one size tier are merged into one
+  SEGMENT_MERGE_FACTOR: int = 10
+  INDEX_WRITE_LOCK_TIMEOUT_SECONDS: int = 10 * 60  # index writers (builds, segment flushes, merges) run one at a time
+
+  # Full rebuilds queued to the workers (update_search_index.delay) run as a map/reduce chord over ranges of
+  # this many article ids, so every worker tokenizes a share of the corpus (0 keeps the build on one worker)
+  INDEX_BUILD_CHUNK_SIZE: int = 5000
+  INDEX_BUILD_CHUNK_RETRIES: int = 3  # a failing range is retried on its own this many times
+
+  # Warm start: the index loads in the background, search endpoints answer 503 with this Retry-After until then
+  WARM_START_RETRY_AFTER_SECONDS: int = 5
+
+  # Logging: DEBUG shows per-document build output, INFO is the normal level
+  LOG_LEVEL: str = "INFO"
+
+  # Text analysis: stem tokens at index and query time (changing it triggers a full rebuild)
+  STEMMING_ENABLED: bool = False
+  STEM_CACHE_SIZE: int = 500_000  # distinct tokens whose stem is memoized
+
+  # Static index pruning, applied by the full build (the defaults keep everything)
+  PRUNE_MIN_DF: int = 1  # terms in fewer documents are left out (2 drops the single-occurrence ones)
+  PRUNE_MAX_DF_RATIO: float = 1.0  # terms in a larger share of the documents are left out (IDF ~ 0)
+  PRUNE_MAX_POSTINGS_PER_TERM: int = 0  # keep only this many highest scoring postings per term, 0 keeps all
+
+  # Spelling correction for query terms missing from the index
+  FUZZY_MATCHING_ENABLED: bool = True
+  FUZZY_TIME_BUDGET_MS: float = 5.0  # max time spent correcting one query
+
+  # Pagination: ranked results are kept briefly so later pages only hydrate documents
+  RESULT_CACHE_SIZE: int = 1000  # queries kept (LRU), 0 disables the cache
+  RESULT_CACHE_TTL_SECONDS: float = 60.0
+  RESULT_CACHE_DEPTH: int = 100  # ranked results kept per query (more when a deeper page is asked for)
+  SEARCH_MAX_RESULT_WINDOW: int = 1000  # offset + limit can't go past this
+
+  # Queries touching at least this many postings sum their scores with numpy instead of a dict (0: always)
+  SEARCH_VECTORIZED_MIN_POSTINGS: int = 1000
+  SEARCH_VECTORIZED_CACHED_TERMS: int = 5000  # terms whose postings arrays are kept (LRU), 0 keeps none
+  BOOLEAN_CACHED_TERMS: int = 5000  # terms whose doc-id ordered views boolean queries keep (LRU), 0 keeps none
+
+  # Admission control of /search (services/admission.py): SEARCH_MAX_CONCURRENCY searches run at once (0: no limit),
+  # up to SEARCH_MAX_QUEUED more wait for a slot, later ones get a 429. SEARCH_DEADLINE_MS bounds the whole search,
+  # queue wait and run: one that couldn't start, or is still running, by then gets a 503 (0: no deadline).
+  # Both come with Retry-After: SEARCH_RETRY_AFTER_SECONDS
+  SEARCH_MAX_CONCURRENCY: int = 4
+  SEARCH_MAX_QUEUED: int = 16
+  SEARCH_DEADLINE_MS: float = 500.0
+  SEARCH_RETRY_AFTER_SECONDS: int = 1
+  # While no slot is free, queries whose terms have this many postings together don't queue at full cost, they run
+  # degraded right away: each term only visits its best SEARCH_DEGRADED_POSTINGS_PER_TERM postings (0: never degrade).
+  # They have SEARCH_MAX_DEGRADED_CONCURRENCY slots of their own, when those are busy too they get a 429
+  SEARCH_DEGRADE_MIN_COST: int = 20_000
+  SEARCH_DEGRADED_POSTINGS_PER_TERM: int = 1000
+  SEARCH_MAX_DEGRADED_CONCURRENCY: int = 2
+
+  # Similar documents (/documents/{id}/similar): the document's best terms are searched as the query
+  SIMILAR_QUERY_TERMS: int = 25  # top weighted terms of the document used
+  SIMILAR_POSTINGS_PER_TERM: int = 1000  # only the highest scoring postings of each of them are visited
+
+  # Search diagnostics
+  SEARCH_DEBUG_ENABLED: bool = False  # allows ?debug=true / X-Search-Debug on /search
+  SLOW_QUERY_THRESHOLD_MS: float = 250.0  # queries slower than this are written to the slow query log
+  SLOW_QUERY_PROFILE_SAMPLE_RATE: float = 0.01  # fraction of queries run under cProfile
+
+  # Admin endpoints (/admin/index/stats): they expose index internals and can take seconds on a big index
+  ADMIN_ENDPOINTS_ENABLED: bool = False
+
   class Config: 
     env_file = ".env"
     env_file_encoding = "utf-8"
@@ -17,4 +100,4 @@ class Settings(BaseSettings):
 
 settings = Settings()
 
-# print(f"Database file configured at: {settings.SQLITE_DB}")
\ No newline at end of file
+# print(f"Database file configured at: {settings.SQLITE_DB}")
@@ -0,0 +1,15 @@
+# Leveled logging for the app
+# print() on the search path is slow under load and can't be filtered, so everything
+# that runs per request or per build goes through the standard logging module instead
+
+import logging
+from app.core.config import settings
+
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+
+def setup_logging():
+  """Configure the root logger once using LOG_LEVEL from settings"""
+  level = getattr(logging, settings.LOG_LEVEL.upper(), logging.INFO)
+  logging.basicConfig(level=level, format=LOG_FORMAT)
+  logging.getLogger("app").setLevel(level)
@@ -0,0 +1,75 @@
+# Prometheus metrics shared across the app
+# Exposed in text format by the /metrics endpoint in main.py
+
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple
+from prometheus_client import Counter, Gauge, Histogram
+
+# Buckets tuned for a search path that should finish well under 100ms,
+# with a long tail for Redis loads and SQLite hydration
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+BUILD_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+# Search path
+SEARCH_STAGE_SECONDS = Histogram(
+  "search_stage_seconds",
+  "Time spent in each stage of perform_search",
+  ["stage"],
+  buckets=STAGE_BUCKETS,
+)
+SEARCH_REQUEST_SECONDS = Histogram(
+  "search_request_seconds",
+  "End to end time of perform_search",
+  buckets=STAGE_BUCKETS,
+)
+# Admission control of /search (services/admission.py): admitted, degraded, rejected_queue_full, rejected_deadline
+SEARCH_ADMISSIONS = Counter("search_admissions_total", "Searches by admission outcome", ["outcome"])
+SEARCH_QUEUE_WAIT_SECONDS = Histogram(
+  "search_queue_wait_seconds",
+  "Time a search waited for a slot before running",
+  buckets=STAGE_BUCKETS,
+)
+SEARCH_RUNNING = Gauge("search_running", "Searches running right now")
+SEARCH_QUEUED = Gauge("search_queued", "Searches waiting for a slot right now")
+
+# Index build
+INDEX_BUILD_PHASE_SECONDS = Histogram(
+  "index_build_phase_seconds",
+  "Time spent in each phase of the TF-IDF and inverted index builds",
+  ["build", "phase"],
+  buckets=BUILD_BUCKETS,
+)
+
+# Caches: the Redis index caches and the in-process ranked result cache
+CACHE_HITS = Counter("cache_hits_total", "Cache hits", ["cache"])
+CACHE_MISSES = Counter("cache_misses_total", "Cache misses", ["cache"])
+REDIS_ERRORS = Counter("redis_errors_total", "Errors talking to Redis", ["operation"])
+
+# Index size, the values are computed lazily at scrape time (see set_function in the services)
+INDEX_TERMS = Gauge("index_terms", "Number of terms in the inverted index")
+INDEX_POSTINGS = Gauge("index_postings", "Total number of postings in the inverted index")
+INDEX_DOCUMENTS = Gauge("index_documents", "Number of documents in the TF-IDF statistics")
+INDEX_GENERATION = Gauge("index_generation", "Generation of the index currently loaded")
+INDEX_SEGMENTS = Gauge("index_segments", "Number of live segments in the loaded index")
+APP_READY = Gauge("app_ready", "1 once the search index is loaded and searches are served")
+# Write amplification: postings written per reason (build, new_documents, merge, compact)
+INDEX_POSTINGS_WRITTEN = Counter("index_postings_written_total", "Postings written into new index segments", ["reason"])
+
+
+# The latest time observed per (histogram, labels): a histogram only keeps sums and bucket counts,
+# the index report (services/index_stats.py) also wants how long the last build took
+last_observed: Dict[Tuple[Histogram, Tuple[str, ...]], float] = {}
+
+
+@contextmanager
+def time_stage(histogram: Histogram, *labels: str):
+  """Observe the wall time of the with-block into histogram (labelled by labels)"""
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    target = histogram.labels(*labels) if labels else histogram
+    target.observe(elapsed)
+    last_observed[(histogram, labels)] = elapsed
@@ -1,12 +1,17 @@
 import requests
 import json
 import asyncio
+import hashlib
 import aiohttp
 from aiohttp import ClientTimeout, ClientError
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timezone
 
+from app.crawler.scheduler import CrawlScheduler, MAX_CONCURRENCY, parse_retry_after
+
 # --- Configuration ---
 URL_WIKI = "https://en.wikipedia.org"
 URL_FEAT_ARTICLES = "https://en.wikipedia.org/wiki/Wikipedia:Featured_articles"
@@ -14,6 +19,19 @@ HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36"
 }
 
+# HTML parsing is CPU bound, so it runs in worker processes instead of on the event loop
+PARSE_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+# lxml is several times faster than Python's html.parser, fall back if it isn't installed
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# Only the article body is parsed into a tree, the navigation, sidebars and footer are skipped
+CONTENT_STRAINER = SoupStrainer("div", id="mw-content-text")
+
 # Path Setup
 try:
     PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
@@ -24,12 +42,87 @@ DATA_DIR = os.path.join(PROJECT_ROOT, "data")
 os.makedirs(DATA_DIR, exist_ok=True)
 
 FEATURED_ARTICLES_LIST_PATH = os.path.join(DATA_DIR, "featured_articles_list.json")
-FETCHED_SAMPLE_ARTICLES_PATH = os.path.join(DATA_DIR, "fetched_sample_articles.json")
+# One JSON object per line, appended as each article arrives so a crash keeps everything fetched so far
+FETCHED_SAMPLE_ARTICLES_PATH = os.path.join(DATA_DIR, "fetched_sample_articles.jsonl")
+
+# --- JSONL checkpoint helpers ---
+def repair_partial_jsonl_tail(path):
+    """Drop a half-written last line (left by a crash mid-write) so appends start on a clean line"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) == b"\n":
+            return
+        # Walk back to the last complete line and cut everything after it
+        f.seek(0)
+        data = f.read()
+        last_newline = data.rfind(b"\n")
+        f.truncate(last_newline + 1 if last_newline >= 0 else 0)
+        print(f"Removed a partially written record from the end of '{path}'")
+
+def load_fetched_urls(path):
+    """URLs already saved in the JSONL checkpoint, used to resume an interrupted crawl"""
+    fetched_urls = set()
+    if not os.path.exists(path):
+        return fetched_urls
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("url"):
+                fetched_urls.add(record["url"])
+    return fetched_urls
+
+def append_article_jsonl(f, article):
+    """Write one article as a JSON line and flush it straight to disk"""
+    f.write(json.dumps(article, ensure_ascii=False) + "\n")
+    f.flush()
+
+# --- HTML parsing (runs in the parse process pool) ---
+def extract_article_text(html_content):
+    """Extract the paragraph text of a Wikipedia article body.
+
+    Module level so it can be pickled and sent to ProcessPoolExecutor workers.
+    """
+    soup = BeautifulSoup(html_content, HTML_PARSER, parse_only=CONTENT_STRAINER)
+    paragraphs = soup.find_all("p")
+    return "".join(p.get_text(separator=" ", strip=True) + "\n\n" for p in paragraphs)
+
+def content_hash(text):
+    """Stable fingerprint of extracted article text, used to detect changed pages on recrawl"""
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+def create_parse_pool():
+    """Process pool for HTML parsing.
+
+    Celery's prefork workers are daemonic processes, which may not start children of their own,
+    so a crawl running inside a Celery task parses on a background thread instead.
+    """
+    if multiprocessing.current_process().daemon:
+        return ThreadPoolExecutor(max_workers=1)
+    return ProcessPoolExecutor(max_workers=PARSE_WORKERS)
 
 # --- Improved Helper Functions with Retry Logic ---
-async def scrap_article_content(session, url, title, max_retries=3):
-    """Fetches and extracts content for a single Wikipedia article with retry logic."""
+async def scrap_article_content(session, url, title, max_retries=3, parse_pool=None, validators=None, host_policy=None):
+    """Fetches and extracts content for a single Wikipedia article with retry logic.
+
+    parse_pool: executor the HTML is parsed in (None uses the event loop's default executor)
+    validators: optional {"etag", "last_modified"} from a previous fetch, sent as a conditional GET.
+                A 304 answer returns {"not_modified": True} without downloading or parsing the page.
+    host_policy: optional scheduler.HostPolicy; every attempt waits for a slot and a token from it
+                 and reports its latency, status and Retry-After back (parsing happens outside the slot)
+    """
     print(f"Fetching content for: {title}")
+
+    request_headers = dict(HEADERS)
+    if validators:
+        if validators.get("etag"):
+            request_headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            request_headers["If-Modified-Since"] = validators["last_modified"]
     
     for attempt in range(1, max_retries + 1):
         try:
@@ -40,31 +133,52 @@ async def scrap_article_content(session, url, title, max_retries=3):
                 sock_read=20   # Socket read timeout: 20 seconds
             )
             
-            async with session.get(url, headers=HEADERS, timeout=timeout) as response:
-                response.raise_for_status()
-                html_content = await response.text()
-                soup = BeautifulSoup(html_content, "html.parser")
-                
-                content_div = soup.find("div", id="mw-content-text")
-                article_text = ""
-                if content_div:
-                    paragraphs = content_div.find_all("p")
-                    for p in paragraphs:
-                        article_text += p.get_text(separator=" ", strip=True) + "\n\n"
-                
-                if not article_text.strip():
-                    print(f"Warning: No paragraph text extracted for {title}")
+            status = None
+            retry_after = None
+            started_at = await host_policy.acquire() if host_policy else None
+            try:
+                async with session.get(url, headers=request_headers, timeout=timeout) as response:
+                    status = response.status
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    if response.status == 304:
+                        print(f"Not modified: {title}")
+                        return {
+                            "title": title,
+                            "url": url,
+                            "content": None,
+                            "not_modified": True,
+                            "etag": response.headers.get("ETag") or (validators or {}).get("etag"),
+                            "last_modified": response.headers.get("Last-Modified") or (validators or {}).get("last_modified")
+                        }
+                    response.raise_for_status()
+                    html_content = await response.text()
+                    etag = response.headers.get("ETag")
+                    last_modified = response.headers.get("Last-Modified")
+            finally:
+                if host_policy:
+                    await host_policy.release(started_at, status=status, retry_after=retry_after, failed=status is None)
 
-                retrieved_at_utc = datetime.now(timezone.utc).isoformat()
-                
-                print(f"Successfully fetched: {title}")
-                return {
-                    "title": title,
-                    "url": url,
-                    "content": article_text.strip() if article_text else None,
-                    "retrieved_at": retrieved_at_utc
-                }
+            # The connection is already back in the pool, parse without blocking the event loop
+            loop = asyncio.get_running_loop()
+            article_text = await loop.run_in_executor(parse_pool, extract_article_text, html_content)
                 
+            if not article_text.strip():
+                print(f"Warning: No paragraph text extracted for {title}")
+
+            retrieved_at_utc = datetime.now(timezone.utc).isoformat()
+            content = article_text.strip() if article_text else None
+            
+            print(f"Successfully fetched: {title}")
+            return {
+                "title": title,
+                "url": url,
+                "content": content,
+                "retrieved_at": retrieved_at_utc,
+                "etag": etag,
+                "last_modified": last_modified,
+                "content_hash": content_hash(content) if content is not None else None
+            }
+            
         except (ClientError, asyncio.TimeoutError) as e:
             print(f"Attempt {attempt}/{max_retries} failed for {title}: {type(e).__name__}")
             if attempt == max_retries:
@@ -77,8 +191,8 @@ async def scrap_article_content(session, url, title, max_retries=3):
                     "error": f"Failed after {max_retries} attempts: {str(e)}"
                 }
             
-            # Exponential backoff: wait longer between retries
-            wait_time = 2 ** attempt  # 2, 4, 8 seconds
+            # Exponential backoff: wait longer between retries, or as long as the server asked for
+            wait_time = retry_after if retry_after else 2 ** attempt  # 2, 4, 8 seconds
             print(f"⏳ Waiting {wait_time} seconds before retry...")
             await asyncio.sleep(wait_time)
             
@@ -92,74 +206,109 @@ async def scrap_article_content(session, url, title, max_retries=3):
                 "error": str(e)
             }
 
-async def fetch_content_for_articles_async(articles_to_fetch_list):
-    """Asynchronously fetches content with improved concurrency control and error handling."""
-    fetched_data = []
+async def fetch_articles_async(articles_to_fetch_list, on_result, validators_by_url=None):
+    """Fetches every article with concurrency control and awaits on_result(result) as each one completes.
+
+    This is the shared crawl loop: the first-time crawl, the incremental recrawl and the streaming
+    pipeline only differ in what on_result does with each fetched article.
+    validators_by_url: {url: {"etag", "last_modified"}} turning those fetches into conditional GETs.
+    Returns (successful, failed) counts, a 304 Not Modified counts as successful.
+    """
+    validators_by_url = validators_by_url or {}
+    total = len(articles_to_fetch_list)
+    counts = {"successful": 0, "failed": 0}
     
-    # Reduce concurrency to avoid overwhelming Wikipedia
-    semaphore = asyncio.Semaphore(5)  # Only 5 concurrent requests
+    # Per-host token bucket + AIMD concurrency limit replace the old fixed semaphore and batch sleeps
+    scheduler = CrawlScheduler()
     
     # Set session-level timeout and connection limits
     timeout = ClientTimeout(total=60)  # Overall session timeout
     connector = aiohttp.TCPConnector(
-        limit=20,           # Total connection pool size
-        limit_per_host=5,   # Max connections per Wikipedia
+        limit=MAX_CONCURRENCY,          # Total connection pool size
+        limit_per_host=MAX_CONCURRENCY, # The host policy decides how many of these are actually used
         ttl_dns_cache=300,  # DNS cache TTL (5 minutes)
         use_dns_cache=True,
         enable_cleanup_closed=True
     )
     
-    async with aiohttp.ClientSession(
-        timeout=timeout, 
-        connector=connector,
-        headers=HEADERS
-    ) as session:
-        
-        async def sem_fetch(article_info):
-            """Fetch with semaphore control"""
-            async with semaphore:
-                return await scrap_article_content(
-                    session, 
-                    article_info["link"], 
-                    article_info["title"]
-                )
-        
-        # Process in smaller batches to avoid overwhelming the server
-        batch_size = 100
-        total_batches = (len(articles_to_fetch_list) + batch_size - 1) // batch_size
-        
-        for i in range(0, len(articles_to_fetch_list), batch_size):
-            batch = articles_to_fetch_list[i:i + batch_size]
-            batch_num = i // batch_size + 1
-            
-            print(f"Processing batch {batch_num}/{total_batches}: {len(batch)} articles")
-            
-            tasks = [sem_fetch(article_info) for article_info in batch]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # Process results
-            successful = 0
-            failed = 0
-            for result in results:
-                if isinstance(result, Exception):
-                    print(f"Task failed with exception: {result}")
-                    failed += 1
-                elif result and result.get("content") is not None:
-                    fetched_data.append(result)
-                    successful += 1
-                elif result:
-                    print(f"No content for: {result.get('title', 'Unknown')} - {result.get('error', 'Content was None')}")
-                    failed += 1
+    # Sliding window: a fixed set of workers keeps pulling the next article, so a slow page
+    # never holds up a whole batch and a freed slot is reused immediately
+    pending = iter(articles_to_fetch_list)
+    
+    # Fetch coroutines hand the downloaded HTML to this pool, so parsing never stalls the network side
+    with create_parse_pool() as parse_pool:
+        async with aiohttp.ClientSession(
+            timeout=timeout, 
+            connector=connector,
+            headers=HEADERS
+        ) as session:
             
-            print(f"Batch {batch_num} complete: {successful} successful, {failed} failed")
+            async def worker():
+                for article_info in pending:
+                    try:
+                        result = await scrap_article_content(
+                            session, 
+                            article_info["link"], 
+                            article_info["title"],
+                            parse_pool=parse_pool,
+                            validators=validators_by_url.get(article_info["link"]),
+                            host_policy=scheduler.policy_for(article_info["link"])
+                        )
+                        # The worker doesn't pick up its next article until on_result returns: if on_result
+                        # waits (a full downstream queue), fetching slows down with it (backpressure)
+                        if result:
+                            await on_result(result)
+                    except Exception as e:
+                        print(f"Task failed with exception: {e}")
+                        counts["failed"] += 1
+                        continue
+                    
+                    if result and (result.get("content") is not None or result.get("not_modified")):
+                        counts["successful"] += 1
+                    else:
+                        if result:
+                            print(f"No content for: {result.get('title', 'Unknown')} - {result.get('error', 'Content was None')}")
+                        counts["failed"] += 1
+                    
+                    done = counts["successful"] + counts["failed"]
+                    if done % 100 == 0:
+                        print(f"Progress: {done}/{total} articles ({counts['successful']} successful, {counts['failed']} failed), {scheduler.describe()}")
             
-            # Add delay between batches to be respectful to Wikipedia
-            if i + batch_size < len(articles_to_fetch_list):
-                print("⏳ Waiting 3 seconds before next batch...")
-                await asyncio.sleep(3)
+            await asyncio.gather(*(worker() for _ in range(min(MAX_CONCURRENCY, total))))
+
+    total_successful = counts["successful"]
+    total_failed = counts["failed"]
+    return total_successful, total_failed
+
+async def fetch_content_for_articles_async(articles_to_fetch_list, output_path=FETCHED_SAMPLE_ARTICLES_PATH, on_article=None):
+    """Asynchronously fetches content and streams every article to a JSONL checkpoint as it completes.
+
+    Articles whose URL is already in output_path are skipped, so re-running after a crash resumes the crawl.
+    on_article: optional coroutine function awaited with each saved article (the streaming setup pipeline)
+    Returns the number of articles saved during this run.
+    """
+    # Resume: skip everything that already made it to the checkpoint
+    repair_partial_jsonl_tail(output_path)
+    already_fetched = load_fetched_urls(output_path)
+    if already_fetched:
+        articles_to_fetch_list = [a for a in articles_to_fetch_list if a["link"] not in already_fetched]
+        print(f"Resuming crawl: {len(already_fetched)} articles already in '{output_path}', {len(articles_to_fetch_list)} left to fetch")
+
+    saved_count = 0
+
+    with open(output_path, "a", encoding="utf-8") as output_file:
+        async def save_result(result):
+            nonlocal saved_count
+            if result.get("content") is not None:
+                append_article_jsonl(output_file, result)
+                saved_count += 1
+                if on_article is not None:
+                    await on_article(result)
+
+        await fetch_articles_async(articles_to_fetch_list, save_result)
     
-    print(f"\nFetching complete! Successfully retrieved {len(fetched_data)} articles")
-    return fetched_data
+    print(f"\nFetching complete! Saved {saved_count} new articles to '{output_path}'")
+    return saved_count
 
 # --- Sync helper functions for setup script (unchanged) ---
 def get_featured_articles_list_sync():
@@ -250,16 +399,15 @@ def sample_articles_sync(all_featured_articles):
 
     return sampled_articles_to_fetch
 
-def save_articles_to_json_sync(articles_with_content):
-    """Sync function to save articles to JSON"""
-    print(f"\nStep 4: Saving fetched article content.")
-    if articles_with_content:
-        with open(FETCHED_SAMPLE_ARTICLES_PATH, "w", encoding="utf-8") as f:
-            json.dump(articles_with_content, f, indent=4, ensure_ascii=False)
-        print(f"Successfully saved content for {len(articles_with_content)} articles to '{FETCHED_SAMPLE_ARTICLES_PATH}'.")
-        print("Each article includes: title, url, content, retrieved_at.")
+def report_fetched_articles_sync(saved_count, output_path=FETCHED_SAMPLE_ARTICLES_PATH):
+    """Sync function to summarise what the crawl wrote to the JSONL file"""
+    print(f"\nStep 4: Fetched article content is saved.")
+    total = len(load_fetched_urls(output_path))
+    if total:
+        print(f"'{output_path}' holds {total} articles ({saved_count} added in this run).")
+        print("Each line is one article with: title, url, content, retrieved_at.")
     else:
-        print(f"No content was successfully fetched for any of the selected sample articles. '{FETCHED_SAMPLE_ARTICLES_PATH}' not created or updated.")
+        print(f"No content was successfully fetched for any of the selected sample articles. '{output_path}' is empty.")
 
 # --- Main Crawler Logic ---
 async def run_crawler_operations_async():
@@ -280,10 +428,11 @@ async def run_crawler_operations_async():
     # Step 3: Fetch content (async operation with improved error handling)
     print(f"\nStep 3: Fetching content for {len(sampled_articles_to_fetch)} selected articles...")
     print("Using improved timeout handling and retry logic...")
-    articles_with_content = await fetch_content_for_articles_async(sampled_articles_to_fetch)
+    # Every article is appended to the JSONL file as soon as it is fetched
+    saved_count = await fetch_content_for_articles_async(sampled_articles_to_fetch)
 
-    # Step 4: Save to JSON (sync operation)
-    save_articles_to_json_sync(articles_with_content)
+    # Step 4: Report what was saved
+    report_fetched_articles_sync(saved_count)
     
     print("\n--- Crawler operations complete ---")
 
@@ -304,10 +453,10 @@ def run_crawler_operations():
 
     # Step 3: Fetch content (this uses asyncio.run for standalone execution)
     print(f"\nStep 3: Fetching content for {len(sampled_articles_to_fetch)} selected articles...")
-    articles_with_content = asyncio.run(fetch_content_for_articles_async(sampled_articles_to_fetch))
+    saved_count = asyncio.run(fetch_content_for_articles_async(sampled_articles_to_fetch))
 
-    # Step 4: Save to JSON
-    save_articles_to_json_sync(articles_with_content)
+    # Step 4: Report what was saved
+    report_fetched_articles_sync(saved_count)
     
     print("\n--- Crawler operations complete ---")
 
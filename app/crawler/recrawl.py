@@ -0,0 +1,113 @@
+# Incremental recrawl: revisit already crawled articles with conditional GETs
+# and forward only the new or changed ones to ingestion (and from there to indexing)
+#
+# For every URL the crawl_state table keeps the ETag/Last-Modified validators and a hash of the
+# extracted text. Pages that answer 304 Not Modified cost one tiny response, pages that come back
+# with the same content hash are also treated as unchanged.
+
+import asyncio
+from datetime import datetime, timezone
+
+from app.crawler.crawler import content_hash, fetch_articles_async
+from app.db.database_utils import (
+    fetch_article_sources,
+    fetch_article_content_by_url,
+    fetch_crawl_state,
+    save_crawl_state,
+    upsert_articles,
+)
+
+
+async def recrawl_articles_async(articles_to_check=None):
+    """Recrawl articles and write only new or changed ones to the database.
+
+    articles_to_check: [{"title", "link"}] to visit, defaults to every article already in the db
+    Returns a summary with counts and the ids of the articles that were written
+    (changed_doc_ids, new_doc_ids is the part of them that wasn't in the db before).
+    """
+    if articles_to_check is None:
+        articles_to_check = [{"title": a["title"], "link": a["url"]} for a in fetch_article_sources()]
+
+    state = fetch_crawl_state()
+    validators_by_url = {
+        url: {"etag": entry["etag"], "last_modified": entry["last_modified"]}
+        for url, entry in state.items()
+        if entry["etag"] or entry["last_modified"]
+    }
+
+    now = datetime.now(timezone.utc).isoformat()
+    summary = {"checked": len(articles_to_check), "not_modified": 0, "unchanged": 0, "changed": 0, "new": 0, "failed": 0}
+    changed_articles = []
+    new_urls = set()
+    state_updates = []
+
+    async def classify(result):
+        url = result["url"]
+        previous = state.get(url, {})
+
+        if result.get("not_modified"):
+            summary["not_modified"] += 1
+            state_updates.append({
+                "url": url,
+                "etag": result.get("etag"),
+                "last_modified": result.get("last_modified"),
+                "content_hash": previous.get("content_hash"),
+                "last_checked": now,
+                "last_changed": None,
+            })
+            return
+
+        if result.get("content") is None:
+            summary["failed"] += 1
+            return
+
+        # No stored hash yet (first recrawl after the initial crawl): compare against the db copy
+        previous_hash = previous.get("content_hash")
+        is_new = False
+        if previous_hash is None:
+            stored_content = fetch_article_content_by_url(url)
+            is_new = stored_content is None
+            previous_hash = content_hash(stored_content) if stored_content is not None else None
+
+        changed = previous_hash != result["content_hash"]
+        if changed:
+            changed_articles.append(result)
+            if is_new:
+                new_urls.add(url)
+            summary["new" if is_new else "changed"] += 1
+        else:
+            summary["unchanged"] += 1
+
+        state_updates.append({
+            "url": url,
+            "etag": result.get("etag"),
+            "last_modified": result.get("last_modified"),
+            "content_hash": result["content_hash"],
+            "last_checked": now,
+            "last_changed": now if changed else None,
+        })
+
+    print(f"Recrawling {len(articles_to_check)} articles ({len(validators_by_url)} with stored validators)...")
+    await fetch_articles_async(articles_to_check, classify, validators_by_url)
+
+    # Only new or changed articles reach the database
+    summary["changed_doc_ids"] = upsert_articles(changed_articles)
+    summary["new_doc_ids"] = [
+        doc_id for doc_id, article in zip(summary["changed_doc_ids"], changed_articles) if article["url"] in new_urls
+    ]
+    save_crawl_state(state_updates)
+
+    print(
+        f"Recrawl complete: {summary['not_modified']} not modified, {summary['unchanged']} unchanged, "
+        f"{summary['changed']} changed, {summary['new']} new, {summary['failed']} failed"
+    )
+    return summary
+
+
+def run_recrawl():
+    """Sync entry point for scripts and Celery tasks"""
+    return asyncio.run(recrawl_articles_async())
+
+
+if __name__ == "__main__":
+    run_recrawl()
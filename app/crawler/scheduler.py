@@ -0,0 +1,152 @@
+# Politeness and adaptive concurrency for the crawler
+#
+# Every host gets a HostPolicy made of:
+#   - a token bucket capping the request rate (and pausing the host for Retry-After)
+#   - an AIMD concurrency limit: +1 per window of successful requests, cut multiplicatively
+#     on 429/5xx/timeouts or when latency climbs well above the best latency seen
+# fetch_articles_async runs a fixed pool of workers that continuously pull the next article,
+# so there are no batch barriers or fixed sleeps; a worker just waits for its host's policy.
+
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+# Defaults, tuned to stay polite towards Wikipedia
+MIN_CONCURRENCY = 1
+INITIAL_CONCURRENCY = 5
+MAX_CONCURRENCY = 16
+REQUESTS_PER_SECOND = 10.0  # per host
+BURST = 10  # token bucket capacity
+BACKOFF_FACTOR = 0.5  # on 429 / 5xx / timeout
+LATENCY_BACKOFF_FACTOR = 0.9  # when latency rises above LATENCY_TOLERANCE x baseline
+LATENCY_TOLERANCE = 3.0
+BASELINE_DECAY = 1.01  # lets the latency baseline drift up slowly if the origin gets slower for good
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, at most `capacity` saved up"""
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause_until(self, deadline):
+        """Stop handing out tokens until deadline (monotonic time), used for Retry-After"""
+        self.paused_until = max(self.paused_until, deadline)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AIMDLimiter:
+    """Concurrency limit that grows additively while the host is healthy and shrinks multiplicatively when it isn't"""
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.baseline_latency = None
+        self.last_decrease_at = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency, overloaded):
+        """Feed back one request: its latency and whether the host signalled overload"""
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+            if latency is None and not overloaded:
+                return  # cancelled before it was sent, nothing learned
+            now = time.monotonic()
+
+            if latency is not None and not overloaded:
+                if self.baseline_latency is None or latency < self.baseline_latency:
+                    self.baseline_latency = latency
+                else:
+                    self.baseline_latency *= BASELINE_DECAY
+
+            slow = latency is not None and self.baseline_latency is not None and latency > LATENCY_TOLERANCE * self.baseline_latency
+            # Decrease at most once per round trip so a burst of bad answers from one window counts once
+            can_decrease = now - self.last_decrease_at > (latency or 0)
+
+            if overloaded and can_decrease:
+                self.limit = max(self.minimum, self.limit * BACKOFF_FACTOR)
+                self.last_decrease_at = now
+            elif slow and can_decrease:
+                self.limit = max(self.minimum, self.limit * LATENCY_BACKOFF_FACTOR)
+                self.last_decrease_at = now
+            elif not overloaded and not slow:
+                # +1 per full window of successful requests
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+
+class HostPolicy:
+    """Rate limit + adaptive concurrency for one host"""
+
+    def __init__(self):
+        self.bucket = TokenBucket()
+        self.limiter = AIMDLimiter()
+
+    async def acquire(self):
+        await self.limiter.acquire()
+        try:
+            await self.bucket.acquire()
+        except BaseException:
+            # Cancelled while waiting for a token: give the slot back
+            await self.limiter.release(None, False)
+            raise
+        return time.monotonic()
+
+    async def release(self, started_at, status=None, retry_after=None, failed=False):
+        """status: HTTP status (None if the request failed before one arrived)"""
+        latency = time.monotonic() - started_at
+        overloaded = failed or status == 429 or (status is not None and status >= 500)
+        if retry_after:
+            self.bucket.pause_until(time.monotonic() + retry_after)
+        await self.limiter.release(None if failed else latency, overloaded)
+
+
+class CrawlScheduler:
+    """Hands out the HostPolicy for each URL's host"""
+
+    def __init__(self):
+        self.hosts = {}
+
+    def policy_for(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = HostPolicy()
+        return self.hosts[host]
+
+    def describe(self):
+        return ", ".join(f"{host}: limit {policy.limiter.limit:.1f}" for host, policy in self.hosts.items())
+
+
+def parse_retry_after(value):
+    """Retry-After in seconds (only the delta-seconds form is used by Wikipedia)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
@@ -2,8 +2,9 @@
 
 import sqlite3
 import os
+from contextlib import contextmanager
 from app.core.config import settings  # The settings instance that we created
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 
 def get_db_connection():
   
@@ -16,6 +17,36 @@ def get_db_connection():
   return conn
 
 
+@contextmanager
+def bulk_load_connection():
+  """
+  Connection tuned for loading lots of rows, the pragmas are put back afterwards
+  - WAL journal: a commit appends to the log instead of rewriting pages, and readers (the API) aren't blocked
+  - synchronous=OFF: no fsync per commit, an application crash still can't corrupt the db (a power loss can
+    lose the last chunks, which a re-run reloads since inserts skip existing urls)
+  - a bigger page cache and in-memory temp storage for the url index updates
+  """
+  conn = get_db_connection()
+  journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+  synchronous = conn.execute("PRAGMA synchronous").fetchone()[0]
+  try:
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA cache_size = -65536")  # 64 MB (negative means KiB)
+    conn.execute("PRAGMA temp_store = MEMORY")
+    yield conn
+    conn.commit()
+  finally:
+    try:
+      conn.execute(f"PRAGMA synchronous = {synchronous}")
+      if journal_mode.lower() != "wal":
+        conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+    except sqlite3.Error as e:
+      # Switching back out of WAL needs the db to ourselves, WAL is fine to keep otherwise
+      print(f"Could not restore journal_mode={journal_mode} after bulk load: {e}")
+    conn.close()
+
+
 def create_articles_table():
   try:
     with get_db_connection() as conn: # 'with' statement ensures connection is closed
@@ -38,6 +69,31 @@ def create_articles_table():
     print(f"An unexpected error occurred during table creation: {e}")
 
 
+def create_crawl_state_table():
+  # Per-URL validators from the last crawl, so recrawls can send conditional GETs
+  # and tell changed pages apart from unchanged ones
+  try:
+    with get_db_connection() as conn:
+      cursor = conn.cursor()
+      cursor.execute("""
+          CREATE TABLE IF NOT EXISTS crawl_state (
+              url TEXT PRIMARY KEY,
+              etag TEXT,
+              last_modified TEXT,
+              content_hash TEXT,
+              last_checked TEXT,
+              last_changed TEXT
+          );
+      """)
+      conn.commit()
+      print("Table 'crawl_state' checked/created successfully.")
+
+  except sqlite3.Error as e:
+    print(f"SQLite error when creating 'crawl_state' table: {e}")
+  except Exception as e:
+    print(f"An unexpected error occurred during table creation: {e}")
+
+
 def init_db():
   """
   Initializes the database. Currently, this just means creating the tables.
@@ -45,21 +101,23 @@ def init_db():
   # Use the updated setting name: settings.SQLITE_DB
   print(f"Attempting to initialize database at: {settings.SQLITE_DB}")
   create_articles_table()
+  create_crawl_state_table()
   print("Database initialization process complete.")
 
 
 def fetch_all_articles() -> List[Dict[str, Any]]:
-  """Fetch all articles with id, title, and content from database"""
+  """Fetch all articles with id, title, url and content from database"""
   articles = []
   try:
     with get_db_connection() as conn:
       cursor = conn.cursor()
-      cursor.execute("SELECT id, title, content FROM articles WHERE content IS NOT NULL")
+      cursor.execute("SELECT id, title, url, content FROM articles WHERE content IS NOT NULL")
       rows = cursor.fetchall()
       for row in rows:
         articles.append({
           'id': row['id'],
           'title': row['title'],
+          'url': row['url'],
           'content': row['content']
         })
   except Exception as e:
@@ -89,3 +147,171 @@ def fetch_documents_by_ids(doc_ids: List[int]) -> List[Dict[str, Any]]:
   except Exception as e:
     print(f"Error fetching documents by IDs: {e}")
   return articles
+
+
+def fetch_article_sources() -> List[Dict[str, Any]]:
+  """Fetch id, title and url of every article, the list a recrawl revisits"""
+  sources = []
+  try:
+    with get_db_connection() as conn:
+      cursor = conn.cursor()
+      cursor.execute("SELECT id, title, url FROM articles")
+      for row in cursor.fetchall():
+        sources.append({'id': row['id'], 'title': row['title'], 'url': row['url']})
+  except Exception as e:
+    print(f"Error fetching article sources: {e}")
+  return sources
+
+
+def fetch_article_content_by_url(url: str) -> Optional[str]:
+  """Fetch the stored content of one article, None if the url isn't in the db"""
+  try:
+    with get_db_connection() as conn:
+      row = conn.execute("SELECT content FROM articles WHERE url = ?", (url,)).fetchone()
+      return row['content'] if row else None
+  except Exception as e:
+    print(f"Error fetching article content for {url}: {e}")
+    return None
+
+
+def fetch_crawl_state() -> Dict[str, Dict[str, Any]]:
+  """Fetch the stored validators for every crawled URL: {url: {etag, last_modified, content_hash, ...}}"""
+  state = {}
+  try:
+    with get_db_connection() as conn:
+      cursor = conn.cursor()
+      cursor.execute("SELECT url, etag, last_modified, content_hash, last_checked, last_changed FROM crawl_state")
+      for row in cursor.fetchall():
+        state[row['url']] = dict(row)
+  except Exception as e:
+    print(f"Error fetching crawl state: {e}")
+  return state
+
+
+def save_crawl_state(entries: List[Dict[str, Any]]):
+  """Insert or update crawl state rows (each with url, etag, last_modified, content_hash, last_checked, last_changed)"""
+  if not entries:
+    return
+  with get_db_connection() as conn:
+    conn.executemany("""
+      INSERT INTO crawl_state (url, etag, last_modified, content_hash, last_checked, last_changed)
+      VALUES (:url, :etag, :last_modified, :content_hash, :last_checked, :last_changed)
+      ON CONFLICT(url) DO UPDATE SET
+        etag = excluded.etag,
+        last_modified = excluded.last_modified,
+        content_hash = excluded.content_hash,
+        last_checked = excluded.last_checked,
+        last_changed = COALESCE(excluded.last_changed, crawl_state.last_changed)
+    """, entries)
+    conn.commit()
+
+
+def upsert_articles(articles: List[Dict[str, Any]]) -> List[int]:
+  """
+  Insert new articles and replace title/content of existing ones (matched by url)
+  Returns the ids of every written article
+  """
+  if not articles:
+    return []
+  doc_ids = []
+  with get_db_connection() as conn:
+    cursor = conn.cursor()
+    for article in articles:
+      cursor.execute("""
+        INSERT INTO articles (title, url, content, retrieved_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(url) DO UPDATE SET
+          title = excluded.title,
+          content = excluded.content,
+          retrieved_at = excluded.retrieved_at
+      """, (article['title'], article['url'], article['content'], article['retrieved_at']))
+      row = cursor.execute("SELECT id FROM articles WHERE url = ?", (article['url'],)).fetchone()
+      doc_ids.append(row['id'])
+    conn.commit()
+  return doc_ids
+
+
+def insert_articles(articles: List[Dict[str, Any]]) -> List[Tuple[int, Dict[str, Any]]]:
+  """
+  Insert a batch of articles in one transaction, skipping urls that already exist
+  Returns (id, article) for the rows that were actually inserted
+  """
+  inserted = []
+  with get_db_connection() as conn:
+    cursor = conn.cursor()
+    for article in articles:
+      cursor.execute(
+        "INSERT OR IGNORE INTO articles (title, url, content, retrieved_at) VALUES (?, ?, ?, ?)",
+        (article['title'], article['url'], article['content'], article['retrieved_at'])
+      )
+      if cursor.rowcount == 1:
+        inserted.append((cursor.lastrowid, article))
+    conn.commit()
+  return inserted
+
+
+def fetch_articles_by_ids(doc_ids: List[int]) -> List[Dict[str, Any]]:
+  """Fetch id, title, url and the full content of specific articles (missing ids are left out)"""
+  if not doc_ids:
+    return []
+  placeholders = ','.join(['?' for _ in doc_ids])
+  with get_db_connection() as conn:
+    rows = conn.execute(
+      f"SELECT id, title, url, content FROM articles WHERE content IS NOT NULL AND id IN ({placeholders})", doc_ids
+    ).fetchall()
+  return [{'id': row['id'], 'title': row['title'], 'url': row['url'], 'content': row['content']} for row in rows]
+
+
+def fetch_articles_after(doc_id: int) -> List[Dict[str, Any]]:
+  """Fetch id, title, url and content of the articles added after doc_id (ids only ever grow)"""
+  with get_db_connection() as conn:
+    rows = conn.execute(
+      "SELECT id, title, url, content FROM articles WHERE content IS NOT NULL AND id > ? ORDER BY id", (doc_id,)
+    ).fetchall()
+  return [{'id': row['id'], 'title': row['title'], 'url': row['url'], 'content': row['content']} for row in rows]
+
+
+def fetch_article_id_range() -> Tuple[int, int]:
+  """Lowest and highest id of the articles with content, (0, 0) when there are none"""
+  with get_db_connection() as conn:
+    first_id, last_id = conn.execute("SELECT MIN(id), MAX(id) FROM articles WHERE content IS NOT NULL").fetchone()
+  return first_id or 0, last_id or 0
+
+
+def fetch_articles_in_range(first_id: int, last_id: int) -> List[Dict[str, Any]]:
+  """Fetch id, title, url and content of the articles with first_id <= id <= last_id, in id order"""
+  with get_db_connection() as conn:
+    rows = conn.execute(
+      "SELECT id, title, url, content FROM articles WHERE content IS NOT NULL AND id BETWEEN ? AND ? ORDER BY id",
+      (first_id, last_id)
+    ).fetchall()
+  return [{'id': row['id'], 'title': row['title'], 'url': row['url'], 'content': row['content']} for row in rows]
+
+
+def count_articles() -> int:
+  """Number of articles with content, i.e. the documents the index covers"""
+  with get_db_connection() as conn:
+    return conn.execute("SELECT COUNT(*) FROM articles WHERE content IS NOT NULL").fetchone()[0]
+
+
+def update_article(doc_id: int, title: str, url: str, content: str, retrieved_at: str) -> bool:
+  """Replace an article's fields, False if there is no article with that id"""
+  with get_db_connection() as conn:
+    cursor = conn.execute(
+      "UPDATE articles SET title = ?, url = ?, content = ?, retrieved_at = ? WHERE id = ?",
+      (title, url, content, retrieved_at, doc_id)
+    )
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+def delete_article(doc_id: int) -> Optional[str]:
+  """Delete an article (and the crawl state of its url), returns its url or None if it didn't exist"""
+  with get_db_connection() as conn:
+    row = conn.execute("SELECT url FROM articles WHERE id = ?", (doc_id,)).fetchone()
+    if row is None:
+      return None
+    conn.execute("DELETE FROM articles WHERE id = ?", (doc_id,))
+    conn.execute("DELETE FROM crawl_state WHERE url = ?", (row['url'],))
+    conn.commit()
+    return row['url']
@@ -1,77 +1,130 @@
-# This is a script to ingest or populate our database from featured_sample_articles.json 
-# So ealier our ingest articles used to create a post request for every article that has to be added 
-# But now it directly adds data to our db instead of adding it through our api 
+# This is a script to ingest or populate our database from fetched_sample_articles.jsonl
+# So ealier our ingest articles used to create a post request for every article that has to be added
+# But now it directly adds data to our db instead of adding it through our api
+# The file is read one line (one article) at a time, so it never has to fit in memory as a whole
+# and rows are inserted in chunks of INGEST_CHUNK_SIZE, one transaction per chunk
 
 import json
 import sqlite3
 from app.core.config import settings
 from datetime import datetime, timezone
+from itertools import islice
 from pathlib import Path
-from app.db.database_utils import get_db_connection
+from app.db.database_utils import bulk_load_connection, get_db_connection
+from typing import Dict, Any, Iterator, TextIO
+
+INSERT_SQL = """
+  INSERT OR IGNORE INTO articles (title, url, content, retrieved_at)
+  VALUES (?, ?, ?, ?)
+"""
+
+
+def iter_json_array(f: TextIO, read_size: int = 1 << 20) -> Iterator[Any]:
+  """
+  Yield the elements of a top level JSON array one at a time
+  Only the current element (plus one read_size block) is held in memory, not the whole file
+  """
+  decoder = json.JSONDecoder()
+  buffer = f.read(read_size).lstrip()
+  if not buffer.startswith("["):
+    raise json.JSONDecodeError("Expected a JSON array", buffer, 0)
+  buffer = buffer[1:]
+  eof = False
+
+  while True:
+    buffer = buffer.lstrip().lstrip(",").lstrip()
+    if buffer.startswith("]"):
+      return
+    try:
+      item, end = decoder.raw_decode(buffer)
+    except json.JSONDecodeError:
+      # The element continues past the current buffer, read more
+      if eof:
+        raise
+      chunk = f.read(read_size)
+      eof = not chunk
+      buffer += chunk
+      continue
+    yield item
+    buffer = buffer[end:]
+
+
+def iter_fetched_articles(path: str) -> Iterator[Dict[str, Any]]:
+  """
+  Yield articles from the crawler's JSONL output one at a time
+  Lines that don't parse (e.g. a record cut off by a crash) are skipped
+  A legacy JSON array file (the old crawler format) is still accepted, and also streamed
+  """
+  with open(path, "r", encoding="utf-8") as f:
+    first_char = f.read(1)
+    f.seek(0)
+    if first_char == "[":
+      print(f"{path} is a JSON array (old crawler format), streaming its elements")
+      yield from iter_json_array(f)
+      return
+
+    for line_number, line in enumerate(f, start=1):
+      line = line.strip()
+      if not line:
+        continue
+      try:
+        yield json.loads(line)
+      except json.JSONDecodeError:
+        print(f"Skipping malformed line {line_number} in {path}")
+
+
+def iter_article_rows(articles: Iterator[Dict[str, Any]], counts: Dict[str, int]) -> Iterator[tuple]:
+  """Turn articles into insert rows, counting the ones without content instead of inserting them"""
+  for article in articles:
+    counts["read"] += 1
+    if not article.get('content'):  # Only insert articles with content
+      counts["skipped_no_content"] += 1
+      continue
+    # Ensure retrieved_at is in proper format
+    retrieved_at = article.get('retrieved_at') or datetime.now(timezone.utc).isoformat()
+    yield (article['title'], article['url'], article['content'], retrieved_at)
+
+
+def load_articles(path: str, chunk_size: int = None) -> Dict[str, int]:
+  """
+  Stream articles from path into the db, one transaction per chunk_size rows
+  Returns counts: read, inserted, skipped_duplicate (url already in the db), skipped_no_content
+  """
+  chunk_size = chunk_size or settings.INGEST_CHUNK_SIZE
+  counts = {"read": 0, "inserted": 0, "skipped_duplicate": 0, "skipped_no_content": 0}
+  rows = iter_article_rows(iter_fetched_articles(path), counts)
+
+  with bulk_load_connection() as conn:
+    while True:
+      chunk = list(islice(rows, chunk_size))
+      if not chunk:
+        break
+      # cursor.rowcount isn't reliable for executemany with OR IGNORE, total_changes counts real inserts
+      changes_before = conn.total_changes
+      conn.executemany(INSERT_SQL, chunk)
+      conn.commit()
+      inserted = conn.total_changes - changes_before
+      counts["inserted"] += inserted
+      counts["skipped_duplicate"] += len(chunk) - inserted
+      print(f"Loaded {counts['read']} articles so far ({counts['inserted']} inserted)")
+
+  return counts
 
 
 def main():
   """Main function to ingest articles directly into database"""
   JSON_FILE_PATH = settings.FETCHED_ARTICLES
 
-  # Load articles from JSON file
-  try:
-    with open(JSON_FILE_PATH, "r", encoding="utf-8") as f:
-      articles = json.load(f)
-    print(f"Loaded {len(articles)} articles from {JSON_FILE_PATH}")
-  except FileNotFoundError:
+  if not Path(JSON_FILE_PATH).exists():
     print(f"Error: {JSON_FILE_PATH} not found. Make sure you run the crawler first.")
     return
+
+  # Bulk insert into database, in chunked transactions
+  try:
+    counts = load_articles(JSON_FILE_PATH)
   except json.JSONDecodeError:
     print(f"Error: Invalid JSON in {JSON_FILE_PATH}. Please check the file.")
     return
-
-  # Prepare data for bulk insertion
-  articles_data = []
-  for article in articles:
-    if article.get('content'):  # Only insert articles with content
-      # Ensure retrieved_at is in proper format
-      retrieved_at = article.get('retrieved_at')
-      if not retrieved_at:
-        retrieved_at = datetime.now(timezone.utc).isoformat()
-      
-      articles_data.append((
-        article['title'],
-        article['url'], 
-        article['content'],
-        retrieved_at
-      ))
-
-  if not articles_data:
-    print("No valid articles found to insert.")
-    return
-
-  # Bulk insert into database
-  try:
-    with get_db_connection() as conn:
-      cursor = conn.cursor()
-      
-      # Use executemany for efficient bulk insertion
-      insert_sql = """
-        INSERT OR IGNORE INTO articles (title, url, content, retrieved_at) 
-        VALUES (?, ?, ?, ?)
-      """
-      
-      cursor.executemany(insert_sql, articles_data)
-      conn.commit()
-      
-      # Get count of inserted rows
-      inserted_count = cursor.rowcount
-      print(f"Successfully inserted {len(articles_data)} articles into database")
-      
-      # Verify total count in database
-      cursor.execute("SELECT COUNT(*) FROM articles")
-      total_count = cursor.fetchone()[0]
-      print(f"Database now contains {total_count} total articles")
-      
-  except sqlite3.IntegrityError as e:
-    print(f"Database integrity error: {e}")
-    print("Some articles may have duplicate URLs (this is normal)")
   except sqlite3.Error as e:
     print(f"Database error during bulk insertion: {e}")
     raise
@@ -79,7 +132,22 @@ def main():
     print(f"Unexpected error during article ingestion: {e}")
     raise
 
+  if counts["read"] == counts["skipped_no_content"]:
+    print("No valid articles found to insert.")
+    return counts
+
+  print(
+    f"Inserted {counts['inserted']} articles, skipped {counts['skipped_duplicate']} already in the database "
+    f"and {counts['skipped_no_content']} without content"
+  )
+
+  # Verify total count in database
+  with get_db_connection() as conn:
+    total_count = conn.execute("SELECT COUNT(*) FROM articles").fetchone()[0]
+  print(f"Database now contains {total_count} total articles")
+
   print("Finished ingesting all articles directly into database.")
+  return counts
 
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  main()
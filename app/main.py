@@ -1,6 +1,13 @@
 # Starting up FASTAPI app instance
+import asyncio
+import logging
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from fastapi.responses import JSONResponse
+
+# Leveled logging and prometheus metrics
+from app.core.logging_config import setup_logging
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
 # importing the pydantic models to be used
 from app.models.article import Article, ArticleCreate
@@ -11,98 +18,82 @@ from app.db.database_utils import init_db, get_db_connection
 
 # Sending and recieving from db and managing responses
 import sqlite3
-from fastapi import HTTPException
+from fastapi import HTTPException, Header, Query, Depends
+from typing import Optional
 
-# Building and getting TF-IDF scores 
-from app.services.build_tfidf_data import get_prebuilt_tfidf_data, get_tfidf_data
-from app.services.tfidf import calculate_tfidf, preprocess_text
+from app.core.config import settings
 
-# Building inv index 
-from app.services.build_inv_index import get_prebuilt_inv_index
+# Tokenizing replaced documents
+from app.services.tfidf import preprocess_text
 
 # Performing Search
-from app.services.search_logic import perform_search
+from app.services.search_logic import perform_search, perform_similar_search
+from app.services.result_cache import decode_cursor
+from app.services.suggest import suggest
+
+# Admission control: concurrency limit, bounded queue and degrading expensive queries under load
+from app.services.admission import search_admission, AdmissionRejected
+
+# Index statistics and memory footprint for /admin/index/stats
+from app.services.index_stats import index_report
 
 # adding celery tasks to update search index or inverted index in background when a new document is added
-from app.tasks.indexing_tasks import update_search_index
+from app.tasks.indexing_tasks import index_new_documents, compact_index
+
+# Deleting / replacing documents without a rebuild
+from app.db.database_utils import update_article, delete_article
+from app.services.tombstones import mark_deleted, mark_updated
+from app.services.redis_client import count_dirty_docs
 
-# for checking cache staleness
-from app.db.database_utils import fetch_all_articles
-from app.services.redis_client import get_redis_client
+# Loading the index in the background, readiness for /status
+from app import warm_start
 
 # for setting up for new user
 from app.setup import is_first_time, starting_setup
+from app.pipeline import start_pipelined_setup
+
+setup_logging()
+logger = logging.getLogger(__name__)
 
 
 # App startup defined 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
   # Setting up for first time
-  print("Output", is_first_time())
-
+  pipeline_task = None
   if is_first_time():
-    print("New Setup detected - fetching articles and setting up db")
-    await starting_setup()
+    if settings.PIPELINED_SETUP:
+      # Crawl, ingest and index stream in the background, the API serves results as they arrive
+      logger.info("New Setup detected - starting the streaming crawl/ingest/index pipeline")
+      pipeline_task = await start_pipelined_setup()
+    else:
+      logger.info("New Setup detected - fetching articles and setting up db")
+      await starting_setup()
   else:
-    print("Starting...")
+    logger.info("Starting...")
 
-  print("FastAPI application startup: Initializing database via lifespan...")
+  logger.info("FastAPI application startup: Initializing database via lifespan...")
   init_db()
-  print("Database initialization complete via lifespan.")
-
-  # Checking for cache stalness
-  should_refresh = await check_cache_freshness()
-  print(should_refresh)
-  if should_refresh:
-    print("Cache appears stale - refreshing synchronously...")
-    update_search_index() # Using it as a normal fn 
-    print("Cache refresh completed.")
-
-  # The order matters here since first we need to build our tfidf_data
-  # Then only we can build the inverted index according to it
-
-  # Build TF-IDF data structures
-  print("Building TF-IDF data structures...")
-  get_prebuilt_tfidf_data()
-
-  print("TF-IDF data structures ready.")
-
-  # Build inverted index
-  print("Building inverted index...")
-  get_prebuilt_inv_index()
-
-  print("Inverted index ready.")
+  logger.info("Database initialization complete via lifespan.")
+
+  # The pipeline builds and publishes the index itself
+  warm_start_task = None
+  if pipeline_task is None:
+    # Loading from Redis (or rebuilding a stale cache) happens in the background, the app answers right away:
+    # searches get a 503 until an index is loaded, a stale one is served while it's being rebuilt
+    warm_start_task = warm_start.start_warm_start()
+  else:
+    warm_start.mark_ready_for_pipeline()
 
   yield
 
   # Code to run on shutdown (if any)
-  print("FastAPI application shutdown.")
-
-
-async def check_cache_freshness() -> bool:
-  """Check if cache needs refresh based on document count mismatch"""
-  try:    
-    # Get actual document count from database
-    db_articles = fetch_all_articles()
-    db_count = len(db_articles)
-    
-    # Get cached document count
-    client = get_redis_client()
-    if client is None:
-      return True  # No Redis, need to refresh
-    
-    cached_count_raw = client.get("tfidf:total_documents")
-    cached_count = int(cached_count_raw) if cached_count_raw else 0
-    
-    # If counts don't match, cache is stale
-    if db_count != cached_count:
-      print(f"Cache mismatch: DB has {db_count} docs, cache has {cached_count}")
-      return True
-    
-    return False
-  except Exception as e:
-    print(f"Error checking cache freshness: {e}")
-    return True  # On error refresh just to be safe
+  if warm_start_task is not None and not warm_start_task.done():
+    warm_start_task.cancel()  # a rebuild thread already running finishes on its own
+  if pipeline_task is not None and not pipeline_task.done():
+    logger.info("Stopping the setup pipeline, the next start resumes from the crawl checkpoint")
+    pipeline_task.cancel()
+  logger.info("FastAPI application shutdown.")
 
 
 # Creating FASTAPI app instance 
@@ -133,39 +124,107 @@ async def greet_user():
   tags=["General"]
 )
 async def get_status():
-  # Return status of the api 
+  # Return status of the api, the app answers as soon as it started so this also tells whether searches work yet
   return {
     "status": "API is up and running",
-    "message": "Operational"
+    "message": "Operational" if warm_start.is_ready() else "Loading the search index",
+    **warm_start.status(),
   }
 
-# /documents: will be used add document to our db. It'll be a POST request
-# The data for the new document (title, URL, and content) will be sent in the request body as JSON.
-@app.post(
-  "/documents",
-  response_model=Article,  # Defines the model for response of the post request
-  status_code=201,
-  summary="Add a new document", 
-  tags=["Documents"]
+# /ready: readiness probe, 200 once searches are served (possibly from a stale index), 503 before
+@app.get(
+  "/ready",
+  summary="Readiness probe",
+  tags=["General"]
 )
-async def add_document(article_data: ArticleCreate):
-  print(f"Received document to add: '{article_data.title}' at URL: {article_data.url}")
+async def get_readiness():
+  if not warm_start.is_ready():
+    return JSONResponse(
+      status_code=503,
+      content=warm_start.status(),
+      headers={"Retry-After": str(settings.WARM_START_RETRY_AFTER_SECONDS)},
+    )
+  return warm_start.status()
 
-  final_retrieved_at: datetime
+
+def require_ready():
+  """Dependency of the search endpoints: 503 with Retry-After while the index is still loading"""
+  if not warm_start.is_ready():
+    raise HTTPException(
+      status_code=503,
+      detail=f"The search index is still loading ({warm_start.phase}), retry shortly",
+      headers={"Retry-After": str(settings.WARM_START_RETRY_AFTER_SECONDS)},
+    )
+
+# /metrics: prometheus scrape endpoint (search stage latencies, build phases, cache and index stats)
+@app.get(
+  "/metrics",
+  summary="Prometheus metrics",
+  tags=["General"]
+)
+async def get_metrics():
+  return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+# /admin/index/stats: vocabulary, postings length histogram, heaviest terms, memory per structure, build phases
+@app.get(
+  "/admin/index/stats",
+  summary="Index statistics and memory footprint",
+  tags=["Admin"],
+  dependencies=[Depends(require_ready)],
+)
+async def get_index_stats(top: int = Query(default=20, ge=1, le=1000), serialized: bool = True):
+  """See services/index_stats.py. serialized=false skips the pickled / Redis sizes, much faster on a big index"""
+  if not settings.ADMIN_ENDPOINTS_ENABLED:
+    raise HTTPException(
+      status_code=403,
+      detail="Admin endpoints are disabled. Set ADMIN_ENDPOINTS_ENABLED to allow them."
+    )
+  # Walking the whole index takes a while, the event loop keeps serving searches meanwhile
+  return await asyncio.to_thread(index_report, top, serialized)
+
+def resolve_retrieved_at(article_data: ArticleCreate) -> datetime:
+  """The client's retrieved_at in UTC, or now"""
   # Checking if the retrieved_at was provided by the client or not
   # This is just to remove variations in timezone so that all the retrieved_at are in UTC 
   if article_data.retrieved_at:
     if article_data.retrieved_at.tzinfo is None:
       # This case is less likely if your JSON always has TZ, but good for safety.
-      print(f"Warning: Received naive datetime for retrieved_at: {article_data.retrieved_at}. Assuming UTC.")
+      logger.warning(f"Received naive datetime for retrieved_at: {article_data.retrieved_at}. Assuming UTC.")
       final_retrieved_at = article_data.retrieved_at.replace(tzinfo=timezone.utc)
     else:
       final_retrieved_at = article_data.retrieved_at
-    print(f"Using provided retrieved_at: {final_retrieved_at.isoformat()}")
+    logger.debug(f"Using provided retrieved_at: {final_retrieved_at.isoformat()}")
   else:
     # If not provided, generate it now as UTC.
     final_retrieved_at = datetime.now(timezone.utc)
-    print(f"Generated new retrieved_at (UTC): {final_retrieved_at.isoformat()}")
+    logger.debug(f"Generated new retrieved_at (UTC): {final_retrieved_at.isoformat()}")
+  return final_retrieved_at
+
+
+def schedule_compaction():
+  """Queue the compaction task once enough deleted / updated documents are waiting"""
+  if count_dirty_docs() >= settings.COMPACTION_MIN_DIRTY_DOCS:
+    try:
+      compact_index.delay()
+      logger.info("Queued index compaction")
+    except Exception as e:
+      # The periodic compaction will get to it
+      logger.warning(f"Could not queue index compaction: {e}")
+
+
+# /documents: will be used add document to our db. It'll be a POST request
+# The data for the new document (title, URL, and content) will be sent in the request body as JSON.
+@app.post(
+  "/documents",
+  response_model=Article,  # Defines the model for response of the post request
+  status_code=201,
+  summary="Add a new document", 
+  tags=["Documents"]
+)
+async def add_document(article_data: ArticleCreate):
+  logger.info(f"Received document to add: '{article_data.title}' at URL: {article_data.url}")
+
+  final_retrieved_at = resolve_retrieved_at(article_data)
 
   # Convert datetime object to ISO 8601 string for database storage
   retrieved_at_iso_string = final_retrieved_at.isoformat()
@@ -189,29 +248,29 @@ async def add_document(article_data: ArticleCreate):
       ))
       conn.commit()
       actual_id_from_db = cursor.lastrowid # Get the ID of the newly inserted row
-      print(f"Article '{article_data.title}' inserted into DB with ID: {actual_id_from_db}")
+      logger.info(f"Article '{article_data.title}' inserted into DB with ID: {actual_id_from_db}")
 
-      # Celery task to handle rebuilding the inv_index
-      # Trigger background re-indexing (async)
-      print("Triggering background index update via Celery...")
-      update_search_index.delay()
-      print("Background task queued successfully.")
+      # Celery task to index the new article into a small segment of its own
+      # Trigger background indexing (async), the rest of the index is left as it is
+      logger.info("Triggering background indexing of the new document via Celery...")
+      index_new_documents.delay()
+      logger.info("Background task queued successfully.")
       
   except sqlite3.IntegrityError as e:
     # commonly occurs if the URL (which is UNIQUE) already exists
-    print(f"Database IntegrityError (e.g., URL already exists): {e}")
+    logger.warning(f"Database IntegrityError (e.g., URL already exists): {e}")
     raise HTTPException(
       status_code=409, # Conflict
       detail=f"Article with this URL already exists or other integrity constraint failed: {str(article_data.url)}"
     )
   except sqlite3.Error as e:
-    print(f"Database error during article insertion: {e}")
+    logger.error(f"Database error during article insertion: {e}")
     raise HTTPException(
       status_code=500, # Internal Server Error
       detail="An error occurred while inserting the article into the database."
     )
   except Exception as e:
-    print(f"An unexpected error occurred during article insertion: {e}")
+    logger.exception(f"An unexpected error occurred during article insertion: {e}")
     raise HTTPException(
       status_code=500,
       detail="An unexpected error occurred."
@@ -226,14 +285,140 @@ async def add_document(article_data: ArticleCreate):
     retrieved_at=final_retrieved_at # Return the datetime object
   )
 
+# /suggest: type-ahead completions of a prefix, most common terms first
+@app.get(
+  "/suggest",
+  summary="Autocomplete a search term",
+  tags=["Search"],
+  dependencies=[Depends(require_ready)],
+)
+async def suggest_terms(prefix: str, limit: int = 10):
+  """Terms starting with prefix, ranked by how many documents contain them"""
+  return {
+    "prefix": prefix,
+    "suggestions": [
+      {"term": term, "document_frequency": df}
+      for term, df in suggest(prefix, limit)
+    ]
+  }
+
+# /documents/{id}: replace an article, searchable with its new content straight away
+@app.put(
+  "/documents/{doc_id}",
+  response_model=Article,
+  summary="Replace a document",
+  tags=["Documents"]
+)
+async def replace_document(doc_id: int, article_data: ArticleCreate):
+  logger.info(f"Received replacement for document {doc_id}: '{article_data.title}'")
+  final_retrieved_at = resolve_retrieved_at(article_data)
+
+  try:
+    updated = update_article(doc_id, article_data.title, str(article_data.url), article_data.content, final_retrieved_at.isoformat())
+  except sqlite3.IntegrityError as e:
+    logger.warning(f"Database IntegrityError while replacing document {doc_id}: {e}")
+    raise HTTPException(
+      status_code=409,
+      detail=f"Another article already has this URL: {str(article_data.url)}"
+    )
+  except sqlite3.Error as e:
+    logger.error(f"Database error while replacing document {doc_id}: {e}")
+    raise HTTPException(status_code=500, detail="An error occurred while updating the article in the database.")
+
+  if not updated:
+    raise HTTPException(status_code=404, detail=f"Document {doc_id} not found")
+
+  # Old postings are tombstoned, the new content goes into the overlay until compaction
+  tokens = preprocess_text(f"{article_data.title} {article_data.title} {article_data.content}")
+  mark_updated(doc_id, tokens, article_data.title, str(article_data.url), article_data.content)
+  schedule_compaction()
+
+  return Article(
+    id=doc_id,
+    title=article_data.title,
+    url=article_data.url,
+    content=article_data.content,
+    retrieved_at=final_retrieved_at
+  )
+
+# /documents/{id}/similar: "more like this", ranked by cosine similarity to the document
+@app.get(
+  "/documents/{doc_id}/similar",
+  summary="Find documents similar to a document",
+  tags=["Search"],
+  dependencies=[Depends(require_ready)],
+)
+async def similar_documents(doc_id: int, limit: int = Query(default=10, ge=1, le=100)):
+  """The document's highest weighted terms are searched, see services/similar.py"""
+  # In a worker thread like searches, it may have to wait for the index lock
+  result = await asyncio.to_thread(perform_similar_search, doc_id, limit)
+  if result is None:
+    raise HTTPException(status_code=404, detail=f"Document {doc_id} is not in the search index")
+  return result
+
+# /documents/{id}: delete an article, it disappears from search results immediately
+@app.delete(
+  "/documents/{doc_id}",
+  status_code=204,
+  summary="Delete a document",
+  tags=["Documents"]
+)
+async def remove_document(doc_id: int):
+  try:
+    deleted_url = delete_article(doc_id)
+  except sqlite3.Error as e:
+    logger.error(f"Database error while deleting document {doc_id}: {e}")
+    raise HTTPException(status_code=500, detail="An error occurred while deleting the article from the database.")
+
+  if deleted_url is None:
+    raise HTTPException(status_code=404, detail=f"Document {doc_id} not found")
+
+  logger.info(f"Deleted document {doc_id} ({deleted_url})")
+  mark_deleted(doc_id)
+  schedule_compaction()
+  return Response(status_code=204)
+
 @app.get(
   "/search", 
   summary="Search for documents",
   tags=["Search"],
+  dependencies=[Depends(require_ready)],
 )
-async def search_documents(query: str, limit: int = 10):
-  """Search for documents using TF-IDF scoring and inverted index"""
-  print(f"Received search query: '{query}'")
+async def search_documents(
+  query: str,
+  limit: int = Query(default=10, ge=1),
+  offset: int = Query(default=0, ge=0),
+  cursor: Optional[str] = None,
+  debug: bool = False,
+  x_search_debug: Optional[str] = Header(default=None)
+):
+  """Search for documents using TF-IDF scoring and inverted index
+
+  offset skips that many ranked results; cursor (next_cursor of the previous page) does the same
+  and takes precedence. Later pages of a query are served from a short-lived ranked result cache.
+  debug=true (or the X-Search-Debug header) adds a per-stage timing breakdown,
+  postings touched and candidate count; only allowed when SEARCH_DEBUG_ENABLED is set.
+  """
+  logger.debug(f"Received search query: '{query}'")
+
+  debug_requested = debug or (x_search_debug or "").lower() in ("1", "true", "yes")
+  if debug_requested and not settings.SEARCH_DEBUG_ENABLED:
+    raise HTTPException(
+      status_code=403,
+      detail="Search debug mode is disabled. Set SEARCH_DEBUG_ENABLED to allow it."
+    )
+
+  if cursor:
+    try:
+      offset = decode_cursor(query, cursor)
+    except ValueError as e:
+      raise HTTPException(status_code=400, detail=str(e))
+
+  if offset + limit > settings.SEARCH_MAX_RESULT_WINDOW:
+    raise HTTPException(
+      status_code=400,
+      detail=f"offset + limit must not exceed {settings.SEARCH_MAX_RESULT_WINDOW}"
+    )
 
   # Later on we will process this query 
   # Use the TF-IDF scores to search for matching documents
@@ -241,9 +426,22 @@ async def search_documents(query: str, limit: int = 10):
   # Return the list of documents
 
   # All these above tasks are now being done by our search_logic.py
-  
-  # Call your search logic
-  search_result = perform_search(query, limit)
-  
-  return search_result
 
+  def search(admission):
+    # Call your search logic, in a worker thread so the event loop keeps admitting and rejecting meanwhile
+    search_result = perform_search(
+      query, limit, debug_requested, offset, admission.max_postings_per_term, admission.deadline
+    )
+    if debug_requested:
+      search_result["debug"]["queue_ms"] = round(admission.waited_ms, 3)
+    return search_result
+
+  # Wait for a slot (see services/admission.py), no room or a passed deadline is answered right away
+  try:
+    return await search_admission.run(query, search)
+  except AdmissionRejected as e:
+    raise HTTPException(
+      status_code=e.status_code,
+      detail=e.detail,
+      headers={"Retry-After": str(e.retry_after)},
+    )
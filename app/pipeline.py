@@ -0,0 +1,144 @@
+# Streaming first-time setup: crawl -> ingest -> index as one pipeline
+#
+# The phased setup (setup.starting_setup) crawls everything, then ingests the whole file, then builds
+# the index, so nothing is searchable until the crawl has finished. Here every fetched article flows
+# through a bounded queue into batched SQLite inserts and incremental index updates, while the API is
+# already serving. When the queue is full the fetchers wait (see crawler.fetch_articles_async), so
+# memory stays bounded however large the crawl is.
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List, Tuple
+
+from app.core.config import settings
+from app.crawler.crawler import (
+  FETCHED_SAMPLE_ARTICLES_PATH,
+  fetch_content_for_articles_async,
+  get_featured_articles_list_sync,
+  load_fetched_urls,
+  sample_articles_sync,
+)
+from app.db.database_utils import init_db, insert_articles
+from app.ingest_articles import main as ingest_main
+from app.services.build_inv_index import add_documents_to_index, set_incremental_updates
+from app.services.tfidf import preprocess_text
+from app.setup import setup_database, mark_as_initialized
+from app.tasks.indexing_tasks import update_search_index
+
+logger = logging.getLogger(__name__)
+
+# Put on the queue by the crawler side once every article has been fetched
+END_OF_CRAWL = object()
+
+
+def tokenize_documents(inserted: List[Tuple[int, Dict[str, Any]]]) -> List[Tuple[int, List[str]]]:
+  """Same weighting as the full build: title twice plus content"""
+  return [
+    (doc_id, preprocess_text(f"{article['title']} {article['title']} {article['content']}"))
+    for doc_id, article in inserted
+  ]
+
+
+async def next_batch(queue: asyncio.Queue) -> Tuple[List[Dict[str, Any]], bool]:
+  """Wait for up to PIPELINE_BATCH_SIZE articles, returns (batch, crawl_finished)"""
+  first = await queue.get()
+  if first is END_OF_CRAWL:
+    return [], True
+
+  batch = [first]
+  deadline = time.monotonic() + settings.PIPELINE_BATCH_WAIT_SECONDS
+  while len(batch) < settings.PIPELINE_BATCH_SIZE:
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+      break
+    try:
+      item = await asyncio.wait_for(queue.get(), timeout=remaining)
+    except asyncio.TimeoutError:
+      break
+    if item is END_OF_CRAWL:
+      return batch, True
+    batch.append(item)
+  return batch, False
+
+
+async def ingest_and_index(queue: asyncio.Queue, started_at: float) -> int:
+  """Consumer side: batched SQLite inserts followed by incremental index updates"""
+  indexed = 0
+  while True:
+    batch, crawl_finished = await next_batch(queue)
+    if batch:
+      # Disk and CPU heavy steps run off the event loop. Searches run in worker threads, so the index mutation
+      # takes the index write lock (see services/index_lock.py) and runs in a thread too: waiting for the
+      # searches in flight to finish doesn't block the event loop, and no search sees a half-updated postings list
+      inserted = await asyncio.to_thread(insert_articles, batch)
+      documents = await asyncio.to_thread(tokenize_documents, inserted)
+      await asyncio.to_thread(add_documents_to_index, documents)
+
+      if indexed == 0 and documents:
+        logger.info(f"First documents searchable {time.perf_counter() - started_at:.1f}s after the pipeline started")
+      indexed += len(documents)
+      logger.info(f"Pipeline: {indexed} documents ingested and indexed ({queue.qsize()} waiting)")
+
+    if crawl_finished:
+      return indexed
+
+
+async def run_pipeline(articles_to_fetch: List[Dict[str, str]]) -> int:
+  """Crawl, ingest and index articles_to_fetch as a stream, then publish an exact index"""
+  started_at = time.perf_counter()
+  queue: asyncio.Queue = asyncio.Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+  set_incremental_updates(True)
+  try:
+    # Resuming an interrupted setup: load what the checkpoint already holds first
+    if os.path.exists(FETCHED_SAMPLE_ARTICLES_PATH) and load_fetched_urls(FETCHED_SAMPLE_ARTICLES_PATH):
+      logger.info("Pipeline: ingesting and indexing articles from the previous crawl checkpoint...")
+      await asyncio.to_thread(ingest_main)
+      await asyncio.to_thread(update_search_index)
+
+    producer = asyncio.create_task(fetch_content_for_articles_async(articles_to_fetch, on_article=queue.put))
+    consumer = asyncio.create_task(ingest_and_index(queue, started_at))
+    try:
+      done, _ = await asyncio.wait({producer, consumer}, return_when=asyncio.FIRST_COMPLETED)
+      if consumer in done:
+        # The consumer only stops before the end-of-crawl marker when it failed
+        producer.cancel()
+        consumer.result()
+      await producer
+      await queue.put(END_OF_CRAWL)
+      indexed = await consumer
+    finally:
+      for task in (producer, consumer):
+        if not task.done():
+          task.cancel()
+
+    # Incremental updates used the IDF known at the time, one full build makes every score exact
+    logger.info(f"Pipeline: crawl finished with {indexed} new documents, publishing the exact index...")
+    await asyncio.to_thread(update_search_index)
+    logger.info(f"Pipeline finished in {time.perf_counter() - started_at:.1f}s")
+    return indexed
+  finally:
+    set_incremental_updates(False)
+
+
+async def run_pipelined_setup(articles_to_fetch: List[Dict[str, str]]):
+  await run_pipeline(articles_to_fetch)
+  mark_as_initialized()
+
+
+async def start_pipelined_setup() -> "asyncio.Task | None":
+  """
+  Prepare the database, ask which articles to fetch, then run the pipeline in the background
+  Returns the running task (None when there is nothing to fetch)
+  """
+  setup_database()
+  init_db()
+
+  all_featured_articles = get_featured_articles_list_sync()
+  if not all_featured_articles:
+    logger.warning("No featured articles to process, skipping the setup pipeline")
+    return None
+
+  articles_to_fetch = sample_articles_sync(all_featured_articles)
+  return asyncio.create_task(run_pipelined_setup(articles_to_fetch))
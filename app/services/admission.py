@@ -0,0 +1,183 @@
+# Admission control and load shedding for /search
+#
+# Every /search used to run to completion however many arrived at once, so under a traffic spike all of them
+# got slower together, and broad queries (huge postings lists) slowed everyone down the most. Now:
+# - at most SEARCH_MAX_CONCURRENCY searches run at once, each in a worker thread so the event loop stays free
+#   to answer (and turn away) the requests behind them
+# - up to SEARCH_MAX_QUEUED more wait for a slot in arrival order. Anything beyond that is turned away at once
+#   with 429. Both carry Retry-After, a client backing off is cheaper than a request timing out in the queue
+# - SEARCH_DEADLINE_MS bounds the whole search from its arrival: a search that couldn't start in time gets a 503,
+#   and one still running at the deadline stops itself between two steps (SearchTrace.check_deadline) and gets
+#   a 503 as well
+# - the cost of a query is estimated before it runs: the summed document frequencies of its terms, i.e. the
+#   postings a full search visits. While every slot is busy, a query costing SEARCH_DEGRADE_MIN_COST or more doesn't
+#   queue, it runs degraded straight away on one of SEARCH_MAX_DEGRADED_CONCURRENCY slots of its own: each term only
+#   visits its best SEARCH_DEGRADED_POSTINGS_PER_TERM postings (lists are sorted by score, see
+#   search_logic.search_terms), so the top results barely change. When the degraded slots are busy too it gets a 429.
+# - a slot is held until the search thread is done, not until the request is: a client that disconnects cancels
+#   the request, but its thread runs on and keeps counting against the limit
+# Boolean queries are admitted the same way but never degraded, they are matched on the full doc id ordered lists:
+# however broad, they wait in the queue (or get a 429 when it is full) like any other search.
+
+import asyncio
+import logging
+import time
+from typing import Callable, Optional, TypeVar
+
+from app.core.config import settings
+from app.core.metrics import SEARCH_ADMISSIONS, SEARCH_QUEUE_WAIT_SECONDS, SEARCH_RUNNING, SEARCH_QUEUED
+from app.services import build_inv_index
+from app.services.boolean_query import is_boolean_query
+from app.services.search_trace import SearchDeadlineExceeded
+from app.services.tfidf import preprocess_text
+
+logger = logging.getLogger(__name__)
+
+Result = TypeVar("Result")
+
+
+class AdmissionRejected(Exception):
+  """A search turned away: status_code 429 (no room) or 503 (deadline passed), retry after retry_after seconds"""
+
+  def __init__(self, status_code: int, detail: str):
+    super().__init__(detail)
+    self.status_code = status_code
+    self.detail = detail
+    self.retry_after = settings.SEARCH_RETRY_AFTER_SECONDS
+
+
+class Admission:
+  """
+  What the admitted search may do: max_postings_per_term > 0 when it is degraded, and it must be done by
+  deadline (a time.perf_counter() value, None without a deadline). semaphore is the slot it holds
+  """
+
+  __slots__ = ("max_postings_per_term", "waited_ms", "deadline", "semaphore")
+
+  def __init__(self, max_postings_per_term: int, waited_ms: float, deadline: Optional[float], semaphore: Optional[asyncio.Semaphore]):
+    self.max_postings_per_term = max_postings_per_term
+    self.waited_ms = waited_ms
+    self.deadline = deadline
+    self.semaphore = semaphore
+
+
+def estimate_query_cost(query: str) -> int:
+  """Postings a full search of query visits: the summed document frequencies of its terms"""
+  index = build_inv_index.inverted_index  # no generation check, an estimate from the loaded index is enough
+  return sum(index.document_frequency(term) for term in set(preprocess_text(query)))
+
+
+def deadline_message() -> str:
+  return f"The search could not be answered within {settings.SEARCH_DEADLINE_MS:.0f}ms, retry shortly"
+
+
+class AdmissionController:
+  """Concurrency limit with a bounded FIFO wait queue, for the searches of one event loop"""
+
+  def __init__(self):
+    self.running = 0
+    self.waiting = 0
+    self.semaphore: Optional[asyncio.Semaphore] = None
+    self.degraded_semaphore: Optional[asyncio.Semaphore] = None
+    self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+  def get_semaphores(self):
+    # An asyncio.Semaphore belongs to one event loop, a new loop (tests, a benchmark) gets new ones
+    loop = asyncio.get_running_loop()
+    if self.semaphore is None or self.loop is not loop:
+      self.semaphore = asyncio.Semaphore(settings.SEARCH_MAX_CONCURRENCY)
+      self.degraded_semaphore = asyncio.Semaphore(settings.SEARCH_MAX_DEGRADED_CONCURRENCY)
+      self.loop = loop
+    return self.semaphore, self.degraded_semaphore
+
+  async def admit(self, query: str) -> Admission:
+    """
+    Take a slot for query (waiting for one if needed), give it back with release
+    Raises AdmissionRejected when there is no room or the deadline passes first
+    """
+    start = time.perf_counter()
+    deadline = start + settings.SEARCH_DEADLINE_MS / 1000 if settings.SEARCH_DEADLINE_MS > 0 else None
+    if settings.SEARCH_MAX_CONCURRENCY <= 0:
+      # No limit configured: everything runs straight away, like before admission control
+      SEARCH_ADMISSIONS.labels("admitted").inc()
+      return self.started(Admission(0, 0.0, deadline, None))
+
+    semaphore, degraded_semaphore = self.get_semaphores()
+    if not (semaphore.locked() or self.waiting > 0):
+      await semaphore.acquire()  # a slot is free, this returns without suspending
+      SEARCH_QUEUE_WAIT_SECONDS.observe(0.0)
+      SEARCH_ADMISSIONS.labels("admitted").inc()
+      return self.started(Admission(0, 0.0, deadline, semaphore))
+
+    # Everything is busy. Expensive queries don't queue to run at full cost, they run degraded on their own slots.
+    # Only estimated now: an immediately admitted search shouldn't pay for the estimate. Boolean queries can't be
+    # degraded (search_boolean matches the full lists), so they always take the queue below
+    if (
+      settings.SEARCH_DEGRADE_MIN_COST > 0 and settings.SEARCH_DEGRADED_POSTINGS_PER_TERM > 0
+      and settings.SEARCH_MAX_DEGRADED_CONCURRENCY > 0 and not is_boolean_query(query)
+      and estimate_query_cost(query) >= settings.SEARCH_DEGRADE_MIN_COST
+    ):
+      if degraded_semaphore.locked():
+        SEARCH_ADMISSIONS.labels("rejected_degraded_busy").inc()
+        raise AdmissionRejected(429, "Every search slot is busy and this query is too broad to queue, retry shortly")
+      await degraded_semaphore.acquire()  # not locked, returns without suspending
+      SEARCH_QUEUE_WAIT_SECONDS.observe(0.0)
+      SEARCH_ADMISSIONS.labels("degraded").inc()
+      return self.started(Admission(settings.SEARCH_DEGRADED_POSTINGS_PER_TERM, 0.0, deadline, degraded_semaphore))
+
+    if self.waiting >= settings.SEARCH_MAX_QUEUED:
+      SEARCH_ADMISSIONS.labels("rejected_queue_full").inc()
+      raise AdmissionRejected(429, f"Every search slot is busy and {self.waiting} searches are waiting, retry shortly")
+
+    self.waiting += 1
+    try:
+      await asyncio.wait_for(semaphore.acquire(), timeout=None if deadline is None else deadline - start)
+    except asyncio.TimeoutError:
+      SEARCH_ADMISSIONS.labels("rejected_deadline").inc()
+      raise AdmissionRejected(503, deadline_message())
+    finally:
+      self.waiting -= 1
+    waited = time.perf_counter() - start
+    SEARCH_QUEUE_WAIT_SECONDS.observe(waited)
+    SEARCH_ADMISSIONS.labels("admitted").inc()
+    return self.started(Admission(0, waited * 1000, deadline, semaphore))
+
+  def started(self, admission: Admission) -> Admission:
+    self.running += 1
+    return admission
+
+  def release(self, admission: Admission):
+    self.running -= 1
+    if admission.semaphore is not None:
+      admission.semaphore.release()
+
+  async def run(self, query: str, search: Callable[[Admission], Result]) -> Result:
+    """
+    Admit query, then run search(admission) in a worker thread and return what it returns
+    Raises AdmissionRejected when it is turned away, or when the search stops at its deadline
+    """
+    admission = await self.admit(query)
+    task = asyncio.ensure_future(asyncio.to_thread(search, admission))
+
+    def search_done(finished: asyncio.Future):
+      # Called on the event loop once the thread is done. Also the only place the error of a search whose
+      # client went away is seen, so it is logged here instead of as a never retrieved exception
+      self.release(admission)
+      if not finished.cancelled():
+        error = finished.exception()
+        if error is not None and not isinstance(error, SearchDeadlineExceeded):
+          logger.debug(f"Search for {query!r} failed: {error!r}")
+
+    task.add_done_callback(search_done)
+    try:
+      # shield: cancelling the request (client disconnect) must not give the slot back while the thread still runs
+      return await asyncio.shield(task)
+    except SearchDeadlineExceeded:
+      SEARCH_ADMISSIONS.labels("timed_out").inc()
+      raise AdmissionRejected(503, deadline_message())
+
+
+search_admission = AdmissionController()
+
+SEARCH_RUNNING.set_function(lambda: search_admission.running)
+SEARCH_QUEUED.set_function(lambda: search_admission.waiting)
@@ -0,0 +1,43 @@
+# Rebuilding a helper structure (spelling correction, suggestions) off the request path
+#
+# Those structures follow the loaded index, and rebuilding one takes far longer than a search or a keystroke
+# may. So a request that finds one out of date only triggers a rebuild here and carries on with the previous
+# structure, which the rebuild swaps out once it is done.
+
+import logging
+import threading
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundRebuild:
+  """Runs rebuild(*args) in a daemon thread, one run at a time. trigger() never waits for it"""
+
+  def __init__(self, name: str, rebuild: Callable[..., None]):
+    self.name = name
+    self.rebuild = rebuild
+    self._lock = threading.Lock()
+    self._thread: Optional[threading.Thread] = None
+
+  def trigger(self, *args) -> bool:
+    """Start a rebuild unless one is running already. Returns whether one was started"""
+    with self._lock:
+      if self._thread is not None and self._thread.is_alive():
+        return False
+      self._thread = threading.Thread(target=self._run, args=args, name=self.name, daemon=True)
+      self._thread.start()
+      return True
+
+  def wait(self, timeout: Optional[float] = None):
+    """Until the running rebuild (if any) is done"""
+    thread = self._thread
+    if thread is not None:
+      thread.join(timeout)
+
+  def _run(self, *args):
+    try:
+      self.rebuild(*args)
+    except Exception as e:
+      # Nobody waits for the thread, so this is the only place the error shows. The next trigger tries again
+      logger.exception(f"Background rebuild {self.name} failed: {e}")
@@ -0,0 +1,337 @@
+# Boolean queries: AND, OR, NOT, -term and parentheses
+#
+#   solar AND (panel OR cell) -roof
+#
+# Operators are only recognised in capitals, so a plain query keeps working exactly as before
+# (terms next to each other are OR'ed and their scores summed). NOT / -term removes documents from the
+# group it appears in, so "a b -c" means (a OR b) without c.
+#
+# The inverted index keeps each postings list sorted by score (best documents first), which is what ranking
+# wants but makes intersecting lists expensive. For boolean queries each term also gets a view sorted by
+# doc id with skip pointers, built lazily the first time the term is used. A view takes 12 bytes per posting, so
+# only the BOOLEAN_CACHED_TERMS most recently used are kept (LRU), until a new index generation is loaded.
+# An AND then walks the shortest list and lets the longer ones skip ahead, so it costs about the size of the
+# shortest list instead of the sum of all of them.
+# The views only hold the index's postings. Deleted / updated documents are masked when they match (evaluate)
+# and the current content of updated documents is matched on its own from the overlay, so a DELETE or PUT
+# never throws the views away.
+
+import math
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.services import build_inv_index, tombstones
+from app.services.segments import SegmentedIndex
+from app.services.tfidf import preprocess_text
+
+OPERATORS = {"AND", "OR", "NOT"}
+TOKEN_PATTERN = re.compile(r"\(|\)|[^\s()]+")
+
+
+class DocPostings:
+  """Postings sorted by doc id, with a skip pointer every sqrt(n) entries"""
+
+  __slots__ = ("doc_ids", "scores", "skip_step", "skip_docs")
+
+  def __init__(self, doc_ids: array, scores: array):
+    self.doc_ids = doc_ids
+    self.scores = scores
+    self.skip_step = max(1, int(math.sqrt(len(doc_ids))))
+    self.skip_docs = doc_ids[::self.skip_step]
+
+  @classmethod
+  def from_pairs(cls, pairs: List[Tuple[int, float]]) -> "DocPostings":
+    """pairs: (doc_id, score) in any order, e.g. an impact-sorted postings list"""
+    pairs = sorted(pairs)
+    return cls(array("i", (doc_id for doc_id, _ in pairs)), array("d", (score for _, score in pairs)))
+
+  def __len__(self):
+    return len(self.doc_ids)
+
+
+class Cursor:
+  """Position in a DocPostings that only moves forward"""
+
+  __slots__ = ("postings", "pos")
+
+  def __init__(self, postings: DocPostings):
+    self.postings = postings
+    self.pos = 0
+
+  @property
+  def exhausted(self) -> bool:
+    return self.pos >= len(self.postings.doc_ids)
+
+  @property
+  def doc_id(self) -> int:
+    return self.postings.doc_ids[self.pos]
+
+  def advance(self, target: int):
+    """Move to the first doc id >= target"""
+    doc_ids = self.postings.doc_ids
+    if self.pos >= len(doc_ids) or doc_ids[self.pos] >= target:
+      return
+    # Follow skip pointers while they don't overshoot, then search inside the block they lead to
+    step = self.postings.skip_step
+    skip_docs = self.postings.skip_docs
+    block = self.pos // step
+    while block + 1 < len(skip_docs) and skip_docs[block + 1] <= target:
+      block += 1
+    start = max(self.pos, block * step)
+    self.pos = bisect_left(doc_ids, target, start, min(len(doc_ids), (block + 1) * step))
+
+
+# --- Doc-id ordered views of the index, built lazily per term ---
+
+doc_ordered_cache: "OrderedDict[str, Tuple[int, DocPostings]]" = OrderedDict()  # term -> (length of the source list, view)
+cache_generation: Optional[int] = -1  # index generation the cached views are valid for
+cache_lock = threading.Lock()  # searches run in worker threads, they share the cache
+
+
+def doc_ordered_postings(term: str, inverted_index: SegmentedIndex) -> Optional[DocPostings]:
+  """The index's postings of term sorted by doc id, None if it has none"""
+  global cache_generation
+
+  generation = build_inv_index.loaded_generation
+  with cache_lock:
+    if cache_generation != generation:
+      doc_ordered_cache.clear()
+      cache_generation = generation
+    cached = doc_ordered_cache.get(term)
+    if cached is not None:
+      doc_ordered_cache.move_to_end(term)
+
+  source_length = inverted_index.document_frequency(term)
+  if not source_length:
+    return None
+  # Documents added in memory (setup pipeline) grow the list without a new generation
+  if cached is None or cached[0] != source_length:
+    # Every segment's live postings of the term, the view sorts them by doc id anyway. Documents deleted from
+    # their segment only change with a new generation, tombstones are left to evaluate
+    postings = [
+      posting
+      for segment_postings, deleted in inverted_index.postings_lists(term)
+      for posting in segment_postings
+      if not deleted or posting[0] not in deleted
+    ]
+    cached = (source_length, DocPostings.from_pairs(postings))
+    # Built outside the lock (two threads may build the same view, both are right). Only kept if no newer
+    # generation came in meanwhile, a view of the old index must not land in the new cache
+    with cache_lock:
+      if cache_generation == generation and settings.BOOLEAN_CACHED_TERMS > 0:
+        doc_ordered_cache[term] = cached
+        while len(doc_ordered_cache) > settings.BOOLEAN_CACHED_TERMS:
+          doc_ordered_cache.popitem(last=False)
+  return cached[1]
+
+
+# --- Parsing ---
+
+def is_boolean_query(query: str) -> bool:
+  """True if the query uses any boolean syntax, plain queries keep the old implicit-OR path"""
+  for token in TOKEN_PATTERN.findall(query):
+    if token in OPERATORS or token in ("(", ")") or (token.startswith("-") and len(token) > 1):
+      return True
+  return False
+
+
+def parse_query(query: str):
+  """
+  Parse into a tree of ("term", term), ("and", positives, negatives) and ("or", positives, negatives)
+  Words are run through preprocess_text like documents are, stop words drop out of the query
+  """
+  tokens = TOKEN_PATTERN.findall(query)
+  position = 0
+
+  def peek():
+    return tokens[position] if position < len(tokens) else None
+
+  def take():
+    nonlocal position
+    position += 1
+    return tokens[position - 1]
+
+  def parse_group(closing: Optional[str]):
+    positives, negatives = [], []
+    while peek() is not None and peek() != closing:
+      if peek() in ("OR", ")"):  # explicit OR means the same as writing the terms next to each other
+        take()  # (an unmatched closing parenthesis is ignored)
+        continue
+      node, negated = parse_and()
+      if node is not None:
+        (negatives if negated else positives).append(node)
+    if closing and peek() == closing:
+      take()
+    return combine("or", positives, negatives)
+
+  def parse_and():
+    node, negated = parse_unary()
+    positives, negatives = [], []
+    if node is not None:
+      (negatives if negated else positives).append(node)
+    while peek() == "AND":
+      take()
+      node, negated = parse_unary()
+      if node is not None:
+        (negatives if negated else positives).append(node)
+    if len(positives) + len(negatives) == 1 and not positives:
+      return negatives[0], True  # a lone NOT, excluded from the surrounding group
+    return combine("and", positives, negatives), False
+
+  def parse_unary():
+    token = peek()
+    if token is None or token == ")":
+      return None, False
+    take()
+    if token == "NOT":
+      node, negated = parse_unary()
+      return node, not negated
+    if token == "(":
+      return parse_group(")"), False
+    if token in OPERATORS:  # a dangling AND, skip it
+      return None, False
+    negated = token.startswith("-") and len(token) > 1
+    words = preprocess_text(token[1:] if negated else token)
+    return combine("or", [("term", word) for word in words], []), negated
+
+  return parse_group(None)
+
+
+def combine(kind: str, positives: list, negatives: list):
+  if not positives and not negatives:
+    return None
+  if len(positives) == 1 and not negatives:
+    return positives[0]
+  return (kind, positives, negatives)
+
+
+def query_terms(node) -> List[str]:
+  """Every term in the tree, for spelling correction and the debug trace"""
+  if node is None:
+    return []
+  if node[0] == "term":
+    return [node[1]]
+  return [term for child in node[1] + node[2] for term in query_terms(child)]
+
+
+def replace_terms(node, replacements: Dict[str, str]):
+  if node is None:
+    return None
+  if node[0] == "term":
+    return ("term", replacements.get(node[1], node[1]))
+  return (node[0], [replace_terms(child, replacements) for child in node[1]], [replace_terms(child, replacements) for child in node[2]])
+
+
+def remove_terms(node, terms: set):
+  """The tree without terms, groups left empty drop out like a query of only stop words does"""
+  if node is None:
+    return None
+  if node[0] == "term":
+    return None if node[1] in terms else node
+  positives = [child for child in (remove_terms(child, terms) for child in node[1]) if child is not None]
+  negatives = [child for child in (remove_terms(child, terms) for child in node[2]) if child is not None]
+  return combine(node[0], positives, negatives)
+
+
+# --- Evaluation ---
+
+EMPTY = DocPostings(array("i"), array("d"))
+
+
+def evaluate(node, inverted_index: SegmentedIndex) -> DocPostings:
+  """Matching documents with the summed tf-idf scores of the query terms they contain"""
+  matches = evaluate_tree(node, lambda term: doc_ordered_postings(term, inverted_index))
+  if tombstones.active:
+    # Deleted documents and the old content of updated ones, masked as they match instead of in the views
+    live = [i for i, doc_id in enumerate(matches.doc_ids) if not tombstones.is_tombstoned(doc_id)]
+    if len(live) < len(matches):
+      matches = DocPostings(array("i", (matches.doc_ids[i] for i in live)), array("d", (matches.scores[i] for i in live)))
+  if not tombstones.overlay_index:
+    return matches
+
+  # The current content of updated documents, matched on its own. Those documents are tombstoned, so none of them
+  # is in matches any more, and the tree is evaluated per document, so matching them apart gives the same result
+  overlay_matches = evaluate_tree(node, overlay_postings)
+  if not len(overlay_matches):
+    return matches
+  return DocPostings.from_pairs(list(zip(matches.doc_ids, matches.scores)) + list(zip(overlay_matches.doc_ids, overlay_matches.scores)))
+
+
+def overlay_postings(term: str) -> Optional[DocPostings]:
+  """The overlay postings of term sorted by doc id. A writer swaps a term's list for a new one, never changes it"""
+  postings = tombstones.overlay_index.get(term)
+  return DocPostings.from_pairs(postings) if postings else None
+
+
+def evaluate_tree(node, term_postings: Callable[[str], Optional[DocPostings]]) -> DocPostings:
+  """The tree over one source of postings, term_postings(term) gives a term's postings sorted by doc id"""
+  if node is None:
+    return EMPTY
+  if node[0] == "term":
+    return term_postings(node[1]) or EMPTY
+
+  kind, positives, negatives = node
+  if not positives:
+    return EMPTY  # nothing to match, only exclusions
+  lists = [evaluate_tree(child, term_postings) for child in positives]
+  excluded = [evaluate_tree(child, term_postings) for child in negatives]
+  if kind == "and":
+    return intersect(lists, excluded)
+  return union(lists, excluded)
+
+
+def intersect(lists: List[DocPostings], excluded: List[DocPostings]) -> DocPostings:
+  """Docs in every list and in none of excluded, driven by the shortest list"""
+  lists = sorted(lists, key=len)
+  if not lists or not len(lists[0]):
+    return EMPTY
+  lead = Cursor(lists[0])
+  others = [Cursor(postings) for postings in lists[1:]]
+  exclusions = [Cursor(postings) for postings in excluded]
+
+  doc_ids = array("i")
+  scores = array("d")
+  while not lead.exhausted:
+    doc_id = lead.doc_id
+    matched = True
+    for cursor in others:
+      cursor.advance(doc_id)
+      if cursor.exhausted:
+        return DocPostings(doc_ids, scores)
+      if cursor.doc_id != doc_id:
+        # Leapfrog: nothing before this cursor's doc can match, skip the lead list there
+        lead.advance(cursor.doc_id)
+        matched = False
+        break
+    if not matched:
+      continue
+    if not is_excluded(doc_id, exclusions):
+      doc_ids.append(doc_id)
+      scores.append(lead.postings.scores[lead.pos] + sum(c.postings.scores[c.pos] for c in others))
+    lead.pos += 1
+  return DocPostings(doc_ids, scores)
+
+
+def union(lists: List[DocPostings], excluded: List[DocPostings]) -> DocPostings:
+  """Docs in any list and in none of excluded, scores of a doc found in several lists are summed"""
+  totals: Dict[int, float] = {}
+  for postings in lists:
+    for doc_id, score in zip(postings.doc_ids, postings.scores):
+      totals[doc_id] = totals.get(doc_id, 0.0) + score
+  exclusions = [Cursor(postings) for postings in excluded]
+  pairs = [(doc_id, score) for doc_id, score in sorted(totals.items()) if not is_excluded(doc_id, exclusions)]
+  return DocPostings(array("i", (doc_id for doc_id, _ in pairs)), array("d", (score for _, score in pairs)))
+
+
+def is_excluded(doc_id: int, exclusions: List[Cursor]) -> bool:
+  """Candidates arrive in doc id order, so the exclusion cursors only ever move forward"""
+  for cursor in exclusions:
+    cursor.advance(doc_id)
+    if not cursor.exhausted and cursor.doc_id == doc_id:
+      return True
+  return False
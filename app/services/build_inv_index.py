@@ -1,85 +1,485 @@
 # Structure of inverted index we are trying to build 
 # term -> [(doc_id, tf_idf_score),(doc_id, tf_idf_score),(doc_id, tf_idf_score),...]
+#
+# The index is kept as a list of immutable segments, each one such a structure over part of the documents
+# (see segments.py). Everything that writes the index works on whole segments:
+# - build_inverted_index: the whole corpus into one segment with exact scores, replacing all others
+# - index_new_documents: articles added since the last segment into a new small segment
+# - merge_segments: the tiered merge policy, keeps the number of live segments logarithmic
+# - compact_index: folds deleted / updated documents in, rewriting only the segments that hold them
 
-from typing import Dict, List, Tuple
-from app.db.database_utils import fetch_all_articles 
+import logging
+import threading
+from array import array
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from app.core.config import settings
+from app.core.metrics import (
+  INDEX_BUILD_PHASE_SECONDS, INDEX_TERMS, INDEX_POSTINGS, INDEX_SEGMENTS, INDEX_POSTINGS_WRITTEN, time_stage
+)
+from app.db.database_utils import fetch_all_articles, fetch_articles_by_ids, fetch_articles_after, count_articles
 from app.services.tfidf import preprocess_text, calculate_tfidf
-from app.services.build_tfidf_data import get_tfidf_data
-from app.services.redis_client import save_inv_index_to_redis, load_inv_index_from_redis
+from app.services.build_tfidf_data import (
+  get_tfidf_data, get_prebuilt_tfidf_data, build_tfidf_data, add_documents_to_tfidf_data,
+  apply_document_frequency_changes, replace_tfidf_data, publish_tfidf_data
+)
+from app.services.redis_client import (
+  get_index_generation, claim_dirty_docs, finish_dirty_docs, clear_tombstones, next_segment_id, save_segment, load_segments,
+  delete_segments, publish_segment_manifest, load_segment_manifest, index_write_lock, get_running_build
+)
+from app.services.docstore import DocStore, make_preview
+from app.services.index_lock import index_lock
+from app.services.segments import INDEX_FORMAT, ForwardIndexBuilder, Segment, SegmentedIndex, plan_merge
+from app.services.tombstones import reload_tombstones
 
-# Global inverted index
-# Later on we will keep in this in some sort of file or mem to be easily accessible 
-# rather than recreating it on every server restart
-inverted_index: Dict[str, List[Tuple[int, float]]] = {}
+logger = logging.getLogger(__name__)
 
+# Global inverted index: the live segments, searched as one index
+inverted_index: SegmentedIndex = SegmentedIndex([])
 
-def get_prebuilt_inv_index():
-  global inverted_index
+# Generation (see redis_client.INDEX_GENERATION_KEY) of the index held in memory,
+# the index is only reloaded from Redis when a newer one has been published
+loaded_generation: int = -1
+
+# While documents are being added incrementally (streaming setup pipeline) the in-memory
+# index is ahead of Redis and must not be replaced by a reload
+incremental_updates_active: bool = False
+
+# Searches run in several threads at once, only one of them reloads a newly published index
+reload_lock = threading.Lock()
+
+# What prune_postings left out of the last full build (terms / postings before and after)
+pruning_stats: Dict[str, int] = {}
 
+# Computed only when /metrics is scraped, never on the search path
+INDEX_TERMS.set_function(lambda: len(inverted_index))
+INDEX_POSTINGS.set_function(lambda: inverted_index.postings_count())
+INDEX_SEGMENTS.set_function(lambda: len(inverted_index.segments))
+
+
+def get_prebuilt_inv_index():
   # Trying to load from Redis
-  print("Trying to fetch Inverted Index data from Redis...")
-  cached_inv_index = load_inv_index_from_redis()
+  logger.debug("Trying to fetch the index segments from Redis...")
+  manifest, generation = load_segment_manifest()
 
-  if cached_inv_index: 
-    # using the found data in redis
-    inverted_index = cached_inv_index
-    print("Using cached Inverted Index data from Redis")
-    return 
+  if manifest is not None and not analyzer_matches(manifest):
+    # Stemmed terms can't answer unstemmed queries (or the other way round), older segments lack the forward index
+    logger.warning(
+      f"The published index doesn't match STEMMING_ENABLED={settings.STEMMING_ENABLED} / format {INDEX_FORMAT}, rebuilding it..."
+    )
+    build_tfidf_data()
+    build_inverted_index()
+  elif manifest is not None:
+    # using the segments published in redis
+    if load_published_segments(manifest, generation):
+      logger.debug("Using cached index segments from Redis")
+  else:
+    # No data found - build from scratch 
+    logger.info("No cached data found. Building Inverted Index from scratch...")
+    build_inverted_index()
 
-  # No data found - build from scratch 
-  print("No cached data found. Building Inverted Index from scratch...")
-  build_inverted_index()
+  # Deletes / updates made since this index was published
+  reload_tombstones()
 
 
-def build_inverted_index():
-  """Build the inverted index using existing TF-IDF data"""
-  global inverted_index
-  
-  print("Building inverted index...")
+def analyzer_matches(manifest: Dict) -> bool:
+  """True if the published index was built with the text analysis and segment format this process expects"""
+  return manifest.get("stemming", False) == settings.STEMMING_ENABLED and manifest.get("format", 1) == INDEX_FORMAT
+
+
+def load_published_segments(manifest: Dict, generation: int) -> bool:
+  """
+  Swap in the segments listed by manifest
+  Segments never change, so only the ones this process doesn't hold yet are fetched from Redis
+  """
+  global inverted_index, loaded_generation
+
+  held = {segment.segment_id: segment for segment in inverted_index.segments}
+  wanted = [info["id"] for info in manifest["segments"]]
+  held.update(load_segments([segment_id for segment_id in wanted if segment_id not in held]))
+
+  missing = [segment_id for segment_id in wanted if segment_id not in held]
+  if missing:
+    # Merged away between reading the manifest and the segments, the next request retries with the newer one
+    logger.warning(f"Segments {missing} of index generation {generation} are gone, keeping the loaded index")
+    return False
+
+  deleted = {info["id"]: frozenset(info.get("deleted", ())) for info in manifest["segments"]}
+  inverted_index = SegmentedIndex([held[segment_id] for segment_id in wanted], manifest["max_doc_id"], deleted)
+  loaded_generation = generation
+  return True
+
+
+def load_published_index() -> bool:
+  """Writers start from what is published, not from whatever this process last loaded"""
+  manifest, generation = load_segment_manifest()
+  return manifest is not None and analyzer_matches(manifest) and load_published_segments(manifest, generation)
+
+
+def publish_segments(
+  segments: List[Segment], max_doc_id: int, deleted: Dict[int, frozenset],
+  new_segments: List[Segment], retired_ids: List[int], reason: str
+) -> bool:
+  """
+  Make segments the live index: in this process straight away, for everyone else through the manifest
+  Only new_segments are written, retired_ids are deleted once no published manifest refers to them
+  """
+  global inverted_index, loaded_generation
+
+  inverted_index = SegmentedIndex(segments, max_doc_id, deleted)
+  for segment in new_segments:
+    INDEX_POSTINGS_WRITTEN.labels(reason).inc(segment.postings_count())
+
+  if all(save_segment(segment) for segment in new_segments):
+    generation = publish_segment_manifest(inverted_index.manifest())
+    if generation:
+      loaded_generation = generation
+      delete_segments(retired_ids)
+      return True
+
+  # Not published: treat whatever Redis holds as seen so searches don't keep reloading it
+  loaded_generation = get_index_generation() or 0
+  return False
+
+
+def build_inverted_index() -> bool:
+  """
+  Build the inverted index using existing TF-IDF data, as one segment replacing every published one
+  Returns True once it is published
+  """
+
+  logger.info("Building inverted index...")
 
   # Get pre-calculated IDF scores
   tfidf_data = get_tfidf_data()
   if not tfidf_data['idf_scores']:
-    print("No TF-IDF data available. Run build_tfidf_data first!")
-    return
+    logger.warning("No TF-IDF data available. Run build_tfidf_data first!")
+    return False
   
   # Fetch all articles using the database utility
-  all_articles = fetch_all_articles()
+  with time_stage(INDEX_BUILD_PHASE_SECONDS, "inv_index", "fetch_articles"):
+    all_articles = fetch_all_articles()
   
-  for article in all_articles:
-    doc_id = article['id']
-    
-    # Same business logic: combine title and content
-    combined_text = f"{article['title']} {article['title']} {article['content']}"
-    tokens = preprocess_text(combined_text)
-    tfidf_scores = calculate_tfidf(tokens, tfidf_data['idf_scores'])  # From our tfidf.py
-    
-    # Build inverted index
-    for term, tf_idf_score in tfidf_scores.items():
-      if term not in inverted_index:
-        inverted_index[term] = []
-      inverted_index[term].append((doc_id, tf_idf_score))
-    
-    print(f"Processed document {doc_id}: '{article['title'][:50]}...'")
+  # Built into a fresh dict and swapped in at the end, so searches keep using the
+  # previous index meanwhile and a rebuild never appends onto old postings
+  new_index: Dict[str, List[Tuple[int, float]]] = {}
+  doc_ids = array("i")
+  forward = ForwardIndexBuilder()  # doc -> terms, for similar documents and cheap deletes
+  display = []  # (doc_id, title, url, content) for the docstore, search results are hydrated from it
+
+  with time_stage(INDEX_BUILD_PHASE_SECONDS, "inv_index", "postings"):
+    for article in all_articles:
+      doc_id = article['id']
+      doc_ids.append(doc_id)
+      
+      # Same business logic: combine title and content
+      combined_text = f"{article['title']} {article['title']} {article['content']}"
+      tokens = preprocess_text(combined_text)
+      tfidf_scores = calculate_tfidf(tokens, tfidf_data['idf_scores'])  # From our tfidf.py
+      forward.add(doc_id, tfidf_scores)
+      display.append((doc_id, article['title'], article['url'], make_preview(article['content'])))
+      
+      # Build inverted index
+      for term, tf_idf_score in tfidf_scores.items():
+        if term not in new_index:
+          new_index[term] = []
+        new_index[term].append((doc_id, tf_idf_score))
+      
+      logger.debug(f"Processed document {doc_id}: '{article['title'][:50]}...'")
   
   # Sort postings by TF-IDF score (highest first)
   
   # This is a very important part of building an efficient inverted index. 
   # What is code does is for a single term it sorts it's list in descending order according the tf_idf scores
   # This gives us an idea of which document has the highest tf_idf score for that term
-  for term in inverted_index:
-    inverted_index[term].sort(key=lambda x: x[1], reverse=True)
+  with time_stage(INDEX_BUILD_PHASE_SECONDS, "inv_index", "sort"):
+    for term in new_index:
+      new_index[term].sort(key=lambda x: x[1], reverse=True)
 
-  
-  print(f"Inverted index built with {len(inverted_index)} terms")
+  with time_stage(INDEX_BUILD_PHASE_SECONDS, "inv_index", "prune"):
+    record_pruning_stats(prune_postings(new_index, len(all_articles)))
+
+  segment = Segment(next_segment_id(), new_index, forward.build(), DocStore.from_documents(display))
+  logger.info(f"Inverted index built with {len(new_index)} terms")
+
+  # Saving the built inverted index into redis, the segments it replaces are dropped
+  logger.info("Saving the Inverted Index to Redis")
+  previous_manifest, _ = load_segment_manifest()
+  retired_ids = [info["id"] for info in previous_manifest["segments"]] if previous_manifest else []
+  with time_stage(INDEX_BUILD_PHASE_SECONDS, "inv_index", "save"):
+    return publish_segments([segment], max(doc_ids, default=0), {}, [segment], retired_ids, "build")
+
+
+def display_fields(articles: List[Dict]) -> List[Tuple[int, str, str, str]]:
+  """What the docstore keeps of each article (the preview is cut right away, the full content isn't held on to)"""
+  return [(article['id'], article['title'], article['url'], make_preview(article['content'])) for article in articles]
+
+
+def prune_postings(
+  index: Dict[str, List[Tuple[int, float]]], total_documents: int,
+  document_frequencies: Optional[Dict[str, int]] = None, max_postings: Optional[int] = None
+) -> Dict[str, int]:
+  """
+  Static pruning by the PRUNE_* settings, in place (lists must already be sorted by score)
+  - terms in fewer than PRUNE_MIN_DF documents: mostly numbers, typos and URL fragments, the bulk of the vocabulary
+  - terms in more than PRUNE_MAX_DF_RATIO of the documents: their IDF is ~0 so they hardly move a ranking,
+    but they have the longest postings lists
+  - longer lists than PRUNE_MAX_POSTINGS_PER_TERM keep only their highest impact postings
+  The document frequencies keep every term, that's how searches recognise a pruned one (see search_logic.py)
+  document_frequencies: the corpus-wide df when index only covers part of the corpus (a distributed build's chunk),
+  otherwise the length of a postings list is the term's df
+  max_postings: overrides PRUNE_MAX_POSTINGS_PER_TERM. A chunk holds only part of each list, so a distributed
+  build passes 0 here and cuts the lists across all its segments when publishing (see distributed_build.py)
+  Returns what was left out, for record_pruning_stats
+  """
+  min_df = settings.PRUNE_MIN_DF
+  max_df = settings.PRUNE_MAX_DF_RATIO * total_documents
+  if max_postings is None:
+    max_postings = settings.PRUNE_MAX_POSTINGS_PER_TERM
+  stats = Counter(terms_before=len(index), postings_before=sum(len(postings) for postings in index.values()))
+
+  for term in list(index):
+    postings = index[term]
+    df = document_frequencies[term] if document_frequencies is not None else len(postings)
+    if df < min_df:
+      stats["rare_terms_dropped"] += 1
+      del index[term]
+    elif settings.PRUNE_MAX_DF_RATIO < 1.0 and df > max_df:
+      stats["common_terms_dropped"] += 1
+      del index[term]
+    elif max_postings and len(postings) > max_postings:
+      stats["terms_truncated"] += 1
+      del postings[max_postings:]
 
-  # Saving the built inverted index into redis
-  print("Saving the Inverted Index to Redis")
-  save_inv_index_to_redis(inverted_index)
+  stats["terms_after"] = len(index)
+  stats["postings_after"] = sum(len(postings) for postings in index.values())
+  return dict(stats)
+
+
+def record_pruning_stats(stats: Dict[str, int]):
+  """Keep what the last full build pruned (pruning_stats) and log it"""
+  global pruning_stats
+
+  pruning_stats = dict(stats)
+  stats = Counter(stats)  # counts that stayed 0 are missing
+  if stats["terms_after"] != stats["terms_before"] or stats["postings_after"] != stats["postings_before"]:
+    logger.info(
+      f"Pruned the index: {stats['terms_before']} -> {stats['terms_after']} terms "
+      f"({stats['rare_terms_dropped']} rare, {stats['common_terms_dropped']} common), "
+      f"{stats['postings_before']} -> {stats['postings_after']} postings ({stats['terms_truncated']} lists truncated)"
+    )
+
+
+def index_new_documents() -> int:
+  """
+  Index the articles added since the last published segment into one new small segment
+  Only these documents are tokenized and written, scored with the current IDF (like the setup
+  pipeline does, see services/readme.md), nothing else in the index is touched.
+  Returns the number of documents indexed
+  """
+  with index_write_lock():
+    if not load_published_index():
+      # Nothing published yet, the first build covers every document
+      build_tfidf_data()
+      build_inverted_index()
+      return inverted_index.doc_count
+
+    with time_stage(INDEX_BUILD_PHASE_SECONDS, "new_documents", "fetch_articles"):
+      new_articles = fetch_articles_after(inverted_index.max_doc_id)
+    if not new_articles:
+      return 0
+
+    with time_stage(INDEX_BUILD_PHASE_SECONDS, "new_documents", "postings"):
+      get_prebuilt_tfidf_data()
+      documents = [(article['id'], preprocess_text(f"{article['title']} {article['title']} {article['content']}")) for article in new_articles]
+      idf = add_documents_to_tfidf_data([tokens for _, tokens in documents])
+      segment = Segment.from_documents(
+        next_segment_id(), ((doc_id, calculate_tfidf(tokens, idf)) for doc_id, tokens in documents), display_fields(new_articles)
+      )
+
+    with time_stage(INDEX_BUILD_PHASE_SECONDS, "new_documents", "save"):
+      publish_tfidf_data()
+      publish_segments(inverted_index.segments + [segment], new_articles[-1]['id'], inverted_index.deleted, [segment], [], "new_documents")
+
+  logger.info(f"Indexed {len(new_articles)} new documents into segment {segment.segment_id}")
+  return len(new_articles)
+
+
+def merge_needed() -> bool:
+  return bool(plan_merge(inverted_index.segments))
+
+
+def merge_segments() -> int:
+  """
+  Apply the tiered merge policy (segments.plan_merge) until no size tier is over full
+  Merging only interleaves already sorted postings (dropping those of deleted documents), nothing is tokenized or re-scored.
+  Returns the number of merges done
+  """
+  merges = 0
+  with index_write_lock():
+    if not load_published_index():
+      return 0
+
+    while True:
+      group = plan_merge(inverted_index.segments)
+      if not group:
+        break
+      with time_stage(INDEX_BUILD_PHASE_SECONDS, "merge", "postings"):
+        merged = Segment.merge(next_segment_id(), group, inverted_index.deleted)
+
+      # The merged segment takes the place of the first segment it replaces
+      merged_ids = [segment.segment_id for segment in group]
+      segments = []
+      for segment in inverted_index.segments:
+        if segment.segment_id not in merged_ids:
+          segments.append(segment)
+        elif merged not in segments:
+          segments.append(merged)
+
+      with time_stage(INDEX_BUILD_PHASE_SECONDS, "merge", "save"):
+        if not publish_segments(segments, inverted_index.max_doc_id, inverted_index.deleted, [merged], merged_ids, "merge"):
+          break
+      merges += 1
+      logger.info(f"Merged segments {merged_ids} into segment {merged.segment_id} ({merged.doc_count} documents)")
+
+  return merges
+
+
+def compact_index() -> int:
+  """
+  Fold deleted and updated documents (see tombstones.py) into the published index
+  Their postings are added to the deleted list of the segments holding them, a segment is only rewritten
+  once half of its documents are deleted. Only the changed documents are tokenized again (together with
+  any articles added since the last segment, so nothing is indexed twice). Document frequencies are corrected
+  and every IDF recomputed; postings of untouched documents keep their scores (see services/readme.md).
+  Returns the number of documents compacted
+  """
+  with index_write_lock():
+    if get_running_build():
+      # A distributed build read the articles before these changes and replaces the whole index when it's done,
+      # so they stay queued (and tombstoned) until the next run
+      logger.info("A distributed build is in progress, compaction waits for it")
+      return 0
+    # Taken off the queue only once the index holding their changes is published (finish_dirty_docs),
+    # a compaction that returns early, fails or dies leaves them to the next run
+    dirty_doc_ids = claim_dirty_docs()
+    if not dirty_doc_ids:
+      return 0
+    logger.info(f"Compacting {len(dirty_doc_ids)} deleted/updated documents into the index...")
+
+    if not load_published_index():
+      logger.warning("No published index to compact, building from scratch instead")
+      build_tfidf_data()
+      if not build_inverted_index():
+        return 0
+      # Every article was indexed with its current content, the updated ones (still in the database) are current
+      updated_ids = [article['id'] for article in fetch_articles_by_ids(dirty_doc_ids)]
+      if clear_tombstones(updated_ids):
+        finish_dirty_docs(dirty_doc_ids)
+      return len(dirty_doc_ids)
+    previous_stats = get_tfidf_data()  # replaced, not changed in place, by the document frequency changes below
+
+    dirty = set(dirty_doc_ids)
+    max_doc_id = inverted_index.max_doc_id
+    with time_stage(INDEX_BUILD_PHASE_SECONDS, "compact", "fetch_articles"):
+      updated_articles = fetch_articles_by_ids([doc_id for doc_id in dirty_doc_ids if doc_id <= max_doc_id])
+      new_articles = fetch_articles_after(max_doc_id)
+
+    # Mark the stale postings of dirty documents deleted in their segments, counting them per term for the document frequencies
+    removed_df: Counter = Counter()
+    deleted = dict(inverted_index.deleted)
+    segments, new_segments, retired_ids = [], [], []
+    with time_stage(INDEX_BUILD_PHASE_SECONDS, "compact", "filter"):
+      for segment in inverted_index.segments:
+        already_deleted = deleted.get(segment.segment_id, frozenset())
+        stale = {doc_id for doc_id in dirty_doc_ids if doc_id not in already_deleted and segment.contains_doc(doc_id)}
+        if not stale:
+          segments.append(segment)
+          continue
+        segment.count_postings(stale, removed_df)
+        deleted[segment.segment_id] = already_deleted | stale
+        if 2 * len(deleted[segment.segment_id]) < segment.doc_count:
+          segments.append(segment)
+          continue
+        # Mostly dead: write the live rest into a new segment
+        retired_ids.append(segment.segment_id)
+        rewritten = segment.without_documents(next_segment_id(), deleted[segment.segment_id])
+        if rewritten.doc_count:
+          segments.append(rewritten)
+          new_segments.append(rewritten)
+
+    # Re-index the current content of the updated ones into a fresh segment
+    with time_stage(INDEX_BUILD_PHASE_SECONDS, "compact", "reindex"):
+      documents = []
+      added_df: Counter = Counter()
+      for article in updated_articles + new_articles:
+        tokens = preprocess_text(f"{article['title']} {article['title']} {article['content']}")
+        documents.append((article['id'], tokens))
+        added_df.update(set(tokens))
+
+      idf = apply_document_frequency_changes(removed_df, added_df, count_articles())
+      if documents:
+        fresh = Segment.from_documents(
+          next_segment_id(), ((doc_id, calculate_tfidf(tokens, idf)) for doc_id, tokens in documents),
+          display_fields(updated_articles + new_articles)
+        )
+        segments.append(fresh)
+        new_segments.append(fresh)
+      if new_articles:
+        max_doc_id = new_articles[-1]['id']
+
+    with time_stage(INDEX_BUILD_PHASE_SECONDS, "compact", "save"):
+      if not publish_segments(segments, max_doc_id, deleted, new_segments, retired_ids, "compact"):
+        # The next run counts these documents' frequency changes again, so put the statistics back as they were
+        replace_tfidf_data(previous_stats['total_documents'], previous_stats['document_frequencies'])
+        logger.warning("Compaction could not publish the index, the documents stay queued for the next run")
+        return 0
+      # Only now are the updated documents' postings in the published index current. Deleted documents keep
+      # their bits: SQLite never reuses their ids and a process still on the old index needs them
+      if clear_tombstones([doc_id for doc_id, _ in documents if doc_id in dirty]):
+        finish_dirty_docs(dirty_doc_ids)
+
+  reindexed = sum(1 for doc_id, _ in documents if doc_id in dirty)
+  logger.info(
+    f"Compaction done: {len(dirty) - reindexed} deleted, {reindexed} re-indexed, "
+    f"{len(retired_ids)} segments rewritten"
+  )
+  return len(dirty_doc_ids)
+
+
+def add_documents_to_index(documents: List[Tuple[int, List[str]]]):
+  """
+  Add already tokenized documents [(doc_id, tokens)] to the in-memory index without a rebuild
+  New postings go into the memtable, inserted at their place in the score-sorted lists
+  Nothing is written to Redis, the next full build publishes the exact index
+  The lists and statistics change in place, so searches (reading in worker threads) wait meanwhile
+  """
+  with index_lock.writing():
+    idf = add_documents_to_tfidf_data([tokens for _, tokens in documents])
+
+    for doc_id, tokens in documents:
+      for term, tf_idf_score in calculate_tfidf(tokens, idf).items():
+        inverted_index.add_posting(term, (doc_id, tf_idf_score))
+
+
+def set_incremental_updates(active: bool):
+  """Pin the in-memory index while documents are being added to it incrementally"""
+  global incremental_updates_active
+  incremental_updates_active = active
 
 
 def get_inverted_index():
   """Return the current inverted index"""
+  if incremental_updates_active:
+    return inverted_index
+
   # Using the redis cache after celery worker is done updating the redis cache with new data
-  get_prebuilt_inv_index()
+  # Only the small generation counter is read per call, the index itself is
+  # reloaded only when a newer one has been published
+  published_generation = get_index_generation()
+  if not inverted_index or (published_generation is not None and published_generation != loaded_generation):
+    with reload_lock:
+      # Another search may have reloaded it while this one waited for the lock
+      if not inverted_index or (published_generation is not None and published_generation != loaded_generation):
+        get_prebuilt_inv_index()
   return inverted_index
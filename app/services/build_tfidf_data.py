@@ -1,75 +1,212 @@
-from typing import Dict, List
+import logging
+import math
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from app.core.config import settings
+from app.core.metrics import INDEX_BUILD_PHASE_SECONDS, INDEX_DOCUMENTS, time_stage
 from app.db.database_utils import fetch_all_articles
-from app.services.tfidf import preprocess_text, calculate_idf_with_freq
-from app.services.redis_client import save_tfidf_data_to_redis, load_tfidf_data_from_redis
+from app.services.tfidf import preprocess_text, stem, surface_forms as most_common_surface_forms, calculate_idf_with_freq, idf_from_document_frequencies
+from app.services.redis_client import save_tfidf_stats, load_tfidf_stats, get_tfidf_version
+
+logger = logging.getLogger(__name__)
 
 # Setting as global vars later we can store it using Redis
 total_document_count: int = 0
 document_frequencies: Dict[str, int] = {}  # df_t: how many docs contain each term
-idf_scores: Dict[str, float] = {}  # current IDF scores
+idf_scores: Dict[str, float] = {}  # current IDF scores, derived from the two above (never stored)
+loaded_version: int = 0  # version of the stats in Redis these are (see redis_client.TFIDF_VERSION_KEY)
+# With stemming: stem -> the word people typed, for showing terms (/suggest), only where the two differ.
+# Set by full builds; stems added later (setup pipeline) are shown as they are until the next one
+surface_forms: Dict[str, str] = {}
+
+# Vocabulary / postings with and without stemming, filled by build_tfidf_data when STEMMING_ENABLED
+stemming_stats: Dict[str, Any] = {}
+
+# Read at scrape time so the gauge always reflects the loaded data
+INDEX_DOCUMENTS.set_function(lambda: total_document_count)
 
 
 def get_prebuilt_tfidf_data():
-  global total_document_count, document_frequencies, idf_scores
-  
+  global total_document_count, document_frequencies, idf_scores, loaded_version, surface_forms
+
+  # Only the small version key is read when nothing new was published, so calling this often is cheap
+  published_version = get_tfidf_version()
+  if published_version and published_version == loaded_version and document_frequencies:
+    return
+
   # Trying to load from Redis 
-  print("Checking Redis for cached TF-IDF data...")
-  cached_total, cached_doc_freq, cached_idf = load_tfidf_data_from_redis()
+  logger.debug("Checking Redis for cached TF-IDF data...")
+  stats = load_tfidf_stats()
   
-  if cached_total > 0 and cached_doc_freq and cached_idf:
+  if stats is not None and stats[1] > 0 and stats[2]:
     # Data found in Redis - using it!
-    total_document_count = cached_total
-    document_frequencies = cached_doc_freq
-    idf_scores = cached_idf
-    print("Using cached TF-IDF data from Redis")
+    version, total, terms, dfs, forms = stats
+    # IDF follows from df and N: computed for the whole vocabulary at once instead of being stored
+    idf = idf_from_document_frequencies(total, np.frombuffer(dfs, dtype=np.uint32))
+    total_document_count = total
+    document_frequencies = dict(zip(terms, dfs.tolist()))
+    idf_scores = dict(zip(terms, idf.tolist()))
+    surface_forms = forms
+    loaded_version = version
+    logger.debug("Using cached TF-IDF data from Redis")
     return
   
   # No cached data found - build from scratch
-  print("No cached data found. Building TF-IDF data from database...")
+  logger.info("No cached data found. Building TF-IDF data from database...")
 
   build_tfidf_data()
 
 
 def build_tfidf_data():
   """Build all TF-IDF related data structures"""
-  global total_document_count, document_frequencies, idf_scores
+  global total_document_count, document_frequencies, idf_scores, surface_forms
   
-  all_articles = fetch_all_articles() 
+  with time_stage(INDEX_BUILD_PHASE_SECONDS, "tfidf", "fetch_articles"):
+    all_articles = fetch_all_articles() 
   
   if not all_articles:
-    print("No articles found in database!")
+    logger.warning("No articles found in database!")
     return
 
-  print(f"Found {len(all_articles)} articles. Processing...")
+  logger.info(f"Found {len(all_articles)} articles. Processing...")
 
   # Process articles to create combined content for TF-IDF
   corpus_tokens = []
-  for article in all_articles:
-    # Combining title and content to give title extra weight
-    combined_text = f"{article['title']} {article['title']} {article['content']}"
-    tokens = preprocess_text(combined_text)
-    corpus_tokens.append(tokens)
+  # With stemming on, the unstemmed tokens are counted on the side: in how many documents each occurs, for the
+  # report (what the index would look like without stemming) and the surface forms
+  token_frequencies: Counter = Counter()
+  with time_stage(INDEX_BUILD_PHASE_SECONDS, "tfidf", "tokenize"):
+    for article in all_articles:
+      # Combining title and content to give title extra weight
+      combined_text = f"{article['title']} {article['title']} {article['content']}"
+      if settings.STEMMING_ENABLED:
+        raw_tokens = preprocess_text(combined_text, stemming=False)
+        token_frequencies.update(set(raw_tokens))
+        tokens = [stem(token) for token in raw_tokens]
+      else:
+        tokens = preprocess_text(combined_text)
+      corpus_tokens.append(tokens)
 
-  total_document_count = len(corpus_tokens)
-  idf_scores, document_frequencies = calculate_idf_with_freq(corpus_tokens)
+  with time_stage(INDEX_BUILD_PHASE_SECONDS, "tfidf", "idf"):
+    total_document_count = len(corpus_tokens)
+    idf_scores, document_frequencies = calculate_idf_with_freq(corpus_tokens)
 
-  print(f"Built TF-IDF data:")
-  print(f"  - Total documents: {total_document_count}")
-  print(f"  - Unique terms: {len(idf_scores)}")
+  logger.info(f"Built TF-IDF data: {total_document_count} documents, {len(idf_scores)} unique terms")
+  surface_forms = most_common_surface_forms(token_frequencies) if settings.STEMMING_ENABLED else {}
+  if settings.STEMMING_ENABLED:
+    report_stemming(len(token_frequencies), sum(token_frequencies.values()))
 
   # Save to Redis for next time
-  print("Saving TF-IDF data to Redis...")
-  save_tfidf_data_to_redis(total_document_count, document_frequencies, idf_scores)
+  logger.info("Saving TF-IDF data to Redis...")
+  with time_stage(INDEX_BUILD_PHASE_SECONDS, "tfidf", "save"):
+    publish_tfidf_data()
+
+
+def report_stemming(unstemmed_term_count: int, unstemmed_postings: int):
+  """Log (and keep in stemming_stats) how much stemming shrank the vocabulary and the postings"""
+  global stemming_stats
+
+  postings = sum(document_frequencies.values())  # one posting per (term, document)
+  cache = stem.cache_info()
+  stemming_stats = {
+    "terms_before": unstemmed_term_count,
+    "terms_after": len(document_frequencies),
+    "postings_before": unstemmed_postings,
+    "postings_after": postings,
+    "stem_cache_hit_rate": round(cache.hits / max(cache.hits + cache.misses, 1), 4),
+    "stem_cache_size": cache.currsize,
+  }
+  logger.info(
+    f"Stemming: {unstemmed_term_count} -> {len(document_frequencies)} terms "
+    f"({_change(unstemmed_term_count, len(document_frequencies))}), "
+    f"{unstemmed_postings} -> {postings} postings ({_change(unstemmed_postings, postings)}), "
+    f"stem cache hit rate {stemming_stats['stem_cache_hit_rate']:.1%}"
+  )
+
+
+def _change(before: int, after: int) -> str:
+  return f"{(after - before) / max(before, 1):+.1%}"
+
+
+def add_documents_to_tfidf_data(corpus_tokens: List[List[str]]) -> Dict[str, float]:
+  """
+  Fold a batch of newly added documents into the in-memory statistics
+  Only the IDF of terms that occur in the batch is recomputed, the rest stays as it was
+  (the same trade-off as indexing new documents with the previous IDF, see services/readme.md);
+  a full build_tfidf_data() makes everything exact again
+  Returns the updated idf_scores
+  """
+  global total_document_count, document_frequencies, idf_scores
+
+  total_document_count += len(corpus_tokens)
+  touched_terms = set()
+  for tokens in corpus_tokens:
+    for term in set(tokens):
+      document_frequencies[term] = document_frequencies.get(term, 0) + 1
+      touched_terms.add(term)
+
+  for term in touched_terms:
+    idf_scores[term] = math.log(total_document_count / document_frequencies[term])
+
+  return idf_scores
+
+
+def publish_tfidf_data():
+  """Save the in-memory statistics to Redis, e.g. after add_documents_to_tfidf_data in a segment flush"""
+  global loaded_version
+  # Only the document frequencies are stored, IDF is derived again by whoever loads them
+  loaded_version = save_tfidf_stats(total_document_count, document_frequencies, surface_forms)
+
+
+def apply_document_frequency_changes(removed: Dict[str, int], added: Dict[str, int], new_total_documents: int) -> Dict[str, float]:
+  """
+  Used by index compaction: subtract the document frequencies of removed postings, add those of
+  re-indexed documents and recompute every IDF for the new document count
+  Terms no document contains any more are dropped. The result is saved to Redis.
+  Returns the updated idf_scores
+  """
+  frequencies = dict(document_frequencies)
+  for term, count in removed.items():
+    frequencies[term] = frequencies.get(term, 0) - count
+  for term, count in added.items():
+    frequencies[term] = frequencies.get(term, 0) + count
+  frequencies = {term: df for term, df in frequencies.items() if df > 0}
+  return replace_tfidf_data(new_total_documents, frequencies)
+
+
+def replace_tfidf_data(new_total_documents: int, frequencies: Dict[str, int], new_surface_forms: Optional[Dict[str, str]] = None) -> Dict[str, float]:
+  """
+  Make frequencies (counted by compaction or by the reduce step of a distributed build) the current statistics:
+  every IDF is recomputed in one go and the result is saved to Redis. The surface forms stay unless new ones
+  are given (a distributed build counts them, compaction doesn't)
+  Returns the new idf_scores
+  """
+  global total_document_count, document_frequencies, idf_scores, surface_forms
+
+  total = max(new_total_documents, 1)
+  terms = list(frequencies)
+  idf = idf_from_document_frequencies(total, np.fromiter(frequencies.values(), dtype=np.float64, count=len(terms)))
+  document_frequencies = frequencies
+  idf_scores = dict(zip(terms, idf.tolist()))
+  total_document_count = new_total_documents
+  if new_surface_forms is not None:
+    surface_forms = new_surface_forms
+
+  publish_tfidf_data()
+  return idf_scores
 
 
 def get_tfidf_data():
   """Return the current TF-IDF data structures"""
-  # update the data if the redis cache is updated by the celery worker 
+  # update the data if the redis cache is updated by the celery worker (a version check when it wasn't)
   get_prebuilt_tfidf_data()
   return {
     'total_documents': total_document_count,
     'document_frequencies': document_frequencies,
-    'idf_scores': idf_scores
+    'idf_scores': idf_scores,
+    'surface_forms': surface_forms,
   }
 
 
@@ -81,4 +218,4 @@ if __name__ == "__main__":
   for i, (term, score) in enumerate(data['idf_scores'].items()):
     if i >= 5:
       break
-    print(f"  {term}: {score:.4f}")
\ No newline at end of file
+    print(f"  {term}: {score:.4f}")
@@ -0,0 +1,263 @@
+# Full index build as a map/reduce over the Celery workers
+#
+# build_tfidf_data + build_inverted_index run on a single worker however many there are, and tokenize every
+# article twice (once to count document frequencies, once to score). Here the articles are split into ranges
+# of INDEX_BUILD_CHUNK_SIZE ids and the build runs as two Celery chords (see tasks/indexing_tasks.py):
+# 1. map, one task per range on any worker: tokenize the range once, keep the term frequencies of its documents
+#    and count its document frequencies (map_chunk)
+#    reduce, once every range is done: add the document frequencies up (count_document_frequencies)
+# 2. one task per range again: score the range's term frequencies with the IDF of the whole corpus into a
+#    segment (score_chunk)
+#    reduce: publish the TF-IDF statistics and the segments as the new index (publish_build)
+# Every score is the one a single-worker build gives, the index just comes in one segment per range, which the
+# tiered merge policy folds together later like any other segments. Pruning (PRUNE_*) leaves the same postings too:
+# terms are dropped by their corpus-wide document frequency in each range, and PRUNE_MAX_POSTINGS_PER_TERM is
+# applied by publish_build to each term's postings across all the ranges (a range only holds part of a list). Only adding up the document frequencies and
+# publishing are left to one worker, so the wall-clock time of a build drops with the number of workers.
+# The tasks pass their results on through Redis (redis_client.BUILD_CHUNK_KEY_PREFIX), a failing task is retried
+# on its own and just overwrites what an earlier attempt left.
+# With stemming the map step also counts the unstemmed tokens, so the reduce can pick the surface form of each
+# stem for /suggest (tfidf.surface_forms) like a single-worker build does.
+
+import heapq
+import logging
+from collections import Counter
+from itertools import islice
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from app.core.config import settings
+from app.core.metrics import INDEX_BUILD_PHASE_SECONDS, INDEX_POSTINGS_WRITTEN, time_stage
+from app.db.database_utils import fetch_article_id_range, fetch_articles_in_range
+from app.services.build_inv_index import display_fields, prune_postings, publish_segments, record_pruning_stats
+from app.services.build_tfidf_data import get_tfidf_data, replace_tfidf_data
+from app.services.redis_client import (
+  BUILD_CHUNK_KEY_PREFIX, save_build_chunk, load_build_chunks, delete_build_chunks, release_build,
+  next_segment_id, save_segment, load_segments, load_segment_manifest, index_write_lock
+)
+from app.services.segments import Segment
+from app.services.tfidf import preprocess_text, stem, surface_forms, calculate_tf, idf_from_document_frequencies
+
+logger = logging.getLogger(__name__)
+
+
+def plan_chunks(chunk_size: int) -> List[Tuple[int, int]]:
+  """The (first_id, last_id) ranges covering every article right now, articles added later go into new segments"""
+  first_id, last_id = fetch_article_id_range()
+  if not last_id:
+    return []
+  return [(start, min(start + chunk_size - 1, last_id)) for start in range(first_id, last_id + 1, chunk_size)]
+
+
+def stats_key(build_id: str) -> str:
+  return f"{BUILD_CHUNK_KEY_PREFIX}{build_id}:stats"
+
+
+def map_chunk(build_id: str, first_id: int, last_id: int) -> Dict[str, Any]:
+  """
+  Tokenize the articles with ids in [first_id, last_id], saving under the chunk's keys
+  - documents: {"documents": [(doc_id, {term: tf})], "display": [(doc_id, title, url, preview)]}
+  - df: {term: df} of the range, kept apart since the first reduce only needs these
+  - tokens (stemming only): {unstemmed token: df} of the range, for the surface forms
+  Returns the small summary the chord passes on
+  """
+  with time_stage(INDEX_BUILD_PHASE_SECONDS, "distributed", "map"):
+    articles = fetch_articles_in_range(first_id, last_id)
+
+    documents = []
+    document_frequencies: Counter = Counter()
+    token_frequencies: Counter = Counter()
+    for article in articles:
+      # Same business logic as the single-worker build: title counted twice
+      combined_text = f"{article['title']} {article['title']} {article['content']}"
+      if settings.STEMMING_ENABLED:
+        raw_tokens = preprocess_text(combined_text, stemming=False)
+        token_frequencies.update(set(raw_tokens))
+        tokens = [stem(token) for token in raw_tokens]
+      else:
+        tokens = preprocess_text(combined_text)
+      term_frequencies = calculate_tf(tokens)
+      documents.append((article['id'], term_frequencies))
+      document_frequencies.update(term_frequencies.keys())
+
+    key = f"{BUILD_CHUNK_KEY_PREFIX}{build_id}:{first_id}"
+    saved = save_build_chunk(key, {"documents": documents, "display": display_fields(articles)})
+    saved = saved and save_build_chunk(f"{key}:df", dict(document_frequencies))
+    if settings.STEMMING_ENABLED:
+      saved = saved and save_build_chunk(f"{key}:tokens", dict(token_frequencies))
+    if not saved:
+      raise RuntimeError(f"Could not save build chunk {key}")  # the task retries
+
+  logger.info(f"Build {build_id}: tokenized articles {first_id}-{last_id} ({len(documents)} documents)")
+  return {"key": key, "documents": len(documents), "last_id": last_id}
+
+
+def count_document_frequencies(build_id: str, chunks: List[Dict[str, Any]]) -> int:
+  """
+  First reduce: the document count and frequencies (and with stemming the surface forms) of the whole corpus
+  from those of every range, saved for the scoring tasks and publish_build. Returns the number of documents
+  """
+  with time_stage(INDEX_BUILD_PHASE_SECONDS, "distributed", "frequencies"):
+    partials = load_build_chunks([f"{chunk['key']}:df" for chunk in chunks])
+    if any(partial is None for partial in partials):
+      raise RuntimeError(f"Document frequencies of build {build_id} are missing")  # the task retries
+
+    document_frequencies: Counter = Counter()
+    for partial in partials:
+      document_frequencies.update(partial)
+    total_documents = sum(chunk["documents"] for chunk in chunks)
+
+    forms: Dict[str, str] = {}
+    if settings.STEMMING_ENABLED:
+      token_partials = load_build_chunks([f"{chunk['key']}:tokens" for chunk in chunks])
+      if any(partial is None for partial in token_partials):
+        raise RuntimeError(f"Token counts of build {build_id} are missing")  # the task retries
+      token_frequencies: Counter = Counter()
+      for partial in token_partials:
+        token_frequencies.update(partial)
+      forms = surface_forms(token_frequencies)
+
+    stats = {"total_documents": total_documents, "df": dict(document_frequencies), "surface": forms}
+    if not save_build_chunk(stats_key(build_id), stats):
+      raise RuntimeError(f"Could not save the statistics of build {build_id}")
+
+  logger.info(f"Build {build_id}: {total_documents} documents, {len(document_frequencies)} terms")
+  return total_documents
+
+
+def score_chunk(build_id: str, chunk: Dict[str, Any]) -> Dict[str, Any]:
+  """
+  Score one range with the corpus-wide IDF into a segment and save it (not published yet)
+  Returns {"key", "segment_id"} for publish_build
+  """
+  with time_stage(INDEX_BUILD_PHASE_SECONDS, "distributed", "score"):
+    stats, partial = load_build_chunks([stats_key(build_id), chunk["key"]])
+    if stats is None or partial is None:
+      raise RuntimeError(f"Build chunk {chunk['key']} is missing")  # the task retries
+
+    # Only the IDF of the terms this range uses, in one numpy operation
+    frequencies = stats["df"]
+    terms = list({term for _, term_frequencies in partial["documents"] for term in term_frequencies})
+    idf = idf_from_document_frequencies(
+      stats["total_documents"], np.fromiter((frequencies[term] for term in terms), dtype=np.float64, count=len(terms))
+    )
+    idf_scores = dict(zip(terms, idf.tolist()))
+
+    # tf * idf is what calculate_tfidf gives, so the scores are the ones of a single-worker build
+    segment = Segment.from_documents(
+      next_segment_id(),
+      ((doc_id, {term: tf * idf_scores[term] for term, tf in term_frequencies.items()}) for doc_id, term_frequencies in partial["documents"]),
+      partial["display"]
+    )
+    # Rare / common terms only, the longest lists are cut over every range when publishing
+    prune_postings(segment.postings, stats["total_documents"], frequencies, max_postings=0)
+    if not save_segment(segment):
+      raise RuntimeError(f"Could not save segment {segment.segment_id} of build {build_id}")
+    INDEX_POSTINGS_WRITTEN.labels("build").inc(segment.postings_count())
+
+  return {"key": chunk["key"], "segment_id": segment.segment_id}
+
+
+def publish_build(build_id: str, chunks: List[Dict[str, Any]], max_doc_id: int) -> int:
+  """
+  Second reduce: publish the statistics and the segments of every range as the new index, replacing every
+  published segment. Returns the number of documents indexed
+  """
+  with index_write_lock():
+    with time_stage(INDEX_BUILD_PHASE_SECONDS, "distributed", "publish"):
+      (stats,) = load_build_chunks([stats_key(build_id)])
+      segment_ids = [chunk["segment_id"] for chunk in chunks]
+      segments = load_segments(segment_ids)
+      if stats is None or len(segments) != len(segment_ids):
+        raise RuntimeError(f"Statistics or segments of build {build_id} are missing")  # the task retries
+
+      build_segments = [segments[segment_id] for segment_id in segment_ids]
+      terms_truncated = 0
+      if settings.PRUNE_MAX_POSTINGS_PER_TERM > 0:
+        terms_truncated, changed = truncate_postings_lists(build_segments, settings.PRUNE_MAX_POSTINGS_PER_TERM)
+        # Not published yet, so they can still be overwritten (a retry finds them cut already, which changes nothing)
+        if not all(save_segment(segment) for segment in changed):
+          raise RuntimeError(f"Could not save the pruned segments of build {build_id}")
+
+      previous_stats = get_tfidf_data()
+      replace_tfidf_data(stats["total_documents"], stats["df"], stats["surface"])
+      previous_manifest, _ = load_segment_manifest()
+      retired_ids = [info["id"] for info in previous_manifest["segments"]] if previous_manifest else []
+      # The segments are saved already, only the manifest is written
+      if not publish_segments(build_segments, max_doc_id, {}, [], retired_ids, "build"):
+        # The published segments were scored with the old statistics, keep those with them until the retry
+        replace_tfidf_data(previous_stats["total_documents"], previous_stats["document_frequencies"], previous_stats["surface_forms"])
+        raise RuntimeError(f"Could not publish the manifest of build {build_id}")  # the task retries
+      record_pruning_stats(pruning_summary(stats["df"], stats["total_documents"], build_segments, terms_truncated))
+
+  # Only once it is published: the chunks and statistics are what a retry needs
+  finish_build(build_id, chunks)
+  logger.info(f"Build {build_id} published: {stats['total_documents']} documents in {len(chunks)} segments")
+  return stats["total_documents"]
+
+
+def _ranked_postings(postings, position: int):
+  # heapq.merge key of each posting: best score first, equal scores by doc id like a single-worker build's sort
+  return ((-score, doc_id, position) for doc_id, score in postings)
+
+
+def truncate_postings_lists(segments: List[Segment], max_postings: int) -> Tuple[int, List[Segment]]:
+  """
+  PRUNE_MAX_POSTINGS_PER_TERM over the ranges together, in place: a term whose postings in all of segments are more
+  than max_postings keeps its max_postings best, the same ones a single-worker build keeps. Each segment's list is
+  sorted by score, so it keeps the prefix that is among them.
+  Returns the number of terms truncated and the segments that changed
+  """
+  lengths: Counter = Counter()
+  for segment in segments:
+    for term, term_postings in segment.postings.items():
+      lengths[term] += len(term_postings)
+
+  truncated = 0
+  changed: Dict[int, Segment] = {}
+  for term, length in lengths.items():
+    if length <= max_postings:
+      continue
+    truncated += 1
+    holders = [segment for segment in segments if term in segment.postings]
+    best = heapq.merge(*(_ranked_postings(segment.postings[term], position) for position, segment in enumerate(holders)))
+    kept = Counter(position for _, _, position in islice(best, max_postings))
+    for position, segment in enumerate(holders):
+      if kept[position] == len(segment.postings[term]):
+        continue
+      if kept[position]:
+        del segment.postings[term][kept[position]:]
+      else:
+        del segment.postings[term]
+      changed[segment.segment_id] = segment
+  return truncated, list(changed.values())
+
+
+def pruning_summary(document_frequencies: Dict[str, int], total_documents: int, segments: List[Segment], terms_truncated: int) -> Dict[str, int]:
+  """What the build pruned, counted over the whole corpus like prune_postings counts a single-worker build"""
+  max_df = settings.PRUNE_MAX_DF_RATIO * total_documents
+  rare = sum(1 for df in document_frequencies.values() if df < settings.PRUNE_MIN_DF)
+  common = sum(
+    1 for df in document_frequencies.values()
+    if df >= settings.PRUNE_MIN_DF and settings.PRUNE_MAX_DF_RATIO < 1.0 and df > max_df
+  )
+  stats = {
+    "terms_before": len(document_frequencies),
+    "postings_before": sum(document_frequencies.values()),  # a term's df is the length of its full list
+    "rare_terms_dropped": rare,
+    "common_terms_dropped": common,
+    "terms_truncated": terms_truncated,
+    "terms_after": len(set().union(*(segment.postings for segment in segments))),
+    "postings_after": sum(segment.postings_count() for segment in segments),
+  }
+  # Like prune_postings' Counter, a count that stayed 0 is left out
+  return {name: count for name, count in stats.items() if count or name.endswith(("_before", "_after"))}
+
+
+def finish_build(build_id: str, chunks: List[Dict[str, Any]]):
+  """Drop what the build left in Redis and let the next one start"""
+  keys = [stats_key(build_id)]
+  for chunk in chunks:
+    keys += [chunk["key"], f"{chunk['key']}:df", f"{chunk['key']}:tokens"]
+  delete_build_chunks(keys)
+  release_build()
@@ -0,0 +1,71 @@
+# Compact store of what a search result shows: title, url and a short preview of the content
+#
+# Hydrating a page of results used to open a SQLite connection and read the full content of every result
+# just to cut 200 characters out of it. Instead every segment carries the display fields of its documents
+# (written at build time, merged with the segment), so hydration is a lookup in memory.
+#
+# To stay small the fields aren't kept as millions of str objects: one document's fields are utf-8 encoded
+# and joined by a separator, all documents' records are concatenated into one bytes blob, and an array of
+# offsets says where each record starts. A lookup is a binary search on the doc ids plus decoding one record.
+
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+PREVIEW_LENGTH = 200  # characters of content shown in a search result
+SEPARATOR = b"\x00"
+
+
+def make_preview(content: str) -> str:
+  """The content_preview of a search result"""
+  return content[:PREVIEW_LENGTH] + '...' if len(content) > PREVIEW_LENGTH else content
+
+
+def _encode(title: str, url: str, preview: str) -> bytes:
+  # NUL doesn't occur in article text, strip it anyway so a record always splits into three fields
+  return SEPARATOR.join(field.replace("\x00", "").encode("utf-8") for field in (title, url, preview))
+
+
+class DocStore:
+  """Display fields of a set of documents: doc_ids sorted, record i is blob[offsets[i]:offsets[i + 1]]"""
+
+  __slots__ = ("doc_ids", "offsets", "blob")
+
+  def __init__(self, doc_ids: array, offsets: array, blob: bytes):
+    self.doc_ids = doc_ids
+    self.offsets = offsets
+    self.blob = blob
+
+  @classmethod
+  def from_documents(cls, documents: Iterable[Tuple[int, str, str, str]]) -> "DocStore":
+    """documents: (doc_id, title, url, content) in any order, the content is cut to the preview here"""
+    return cls._from_records([(doc_id, _encode(title, url or "", make_preview(content or ""))) for doc_id, title, url, content in documents])
+
+  @classmethod
+  def _from_records(cls, records: List[Tuple[int, bytes]]) -> "DocStore":
+    records.sort(key=lambda record: record[0])
+    offsets = array("q", [0])
+    for _, record in records:
+      offsets.append(offsets[-1] + len(record))
+    return cls(array("i", (doc_id for doc_id, _ in records)), offsets, b"".join(record for _, record in records))
+
+  @classmethod
+  def merge(cls, stores: List["DocStore"], deleted: List[frozenset]) -> "DocStore":
+    """The documents of all stores except the deleted ones (deleted[i] belongs to stores[i])"""
+    records = []
+    for store, doc_ids in zip(stores, deleted):
+      for position, doc_id in enumerate(store.doc_ids):
+        if doc_id not in doc_ids:
+          records.append((doc_id, store.blob[store.offsets[position]:store.offsets[position + 1]]))
+    return cls._from_records(records)
+
+  def get(self, doc_id: int) -> Optional[Dict[str, str]]:
+    """{id, title, url, content} like fetch_documents_by_ids (content being the preview), None if not here"""
+    position = bisect_left(self.doc_ids, doc_id)
+    if position >= len(self.doc_ids) or self.doc_ids[position] != doc_id:
+      return None
+    title, url, preview = self.blob[self.offsets[position]:self.offsets[position + 1]].decode("utf-8").split("\x00")
+    return {"id": doc_id, "title": title, "url": url, "content": preview}
+
+  def __len__(self) -> int:
+    return len(self.doc_ids)
@@ -0,0 +1,180 @@
+# Spelling correction for query terms that aren't in the index
+#
+# SymSpell-style symmetric delete index: at build time every term's prefix is stored together with every string
+# made by deleting up to two of its characters (one for short terms, see SHORT_TERM_LENGTH). At query time the
+# unknown term's prefix and its deletions are looked up the same way: two words within the edit distance allowed
+# always share such a variant (a substitution is a delete on both sides, a character shifted out of the prefix a
+# delete on one), so the lookup finds every candidate without ever scanning the vocabulary. Candidates are then
+# verified with a real edit distance.
+#
+# To keep memory small the variants aren't kept as strings: each one is packed with the id of its term into
+# a single 64 bit integer (40 bits of hash, 24 bits of term id) in one sorted array, 8 bytes per variant
+# (up to 29 variants for a 7 character prefix).
+# A hash collision only adds a candidate that the edit distance check then throws away.
+# Rebuilding takes seconds on a big vocabulary, so it never happens inside a search: warm start builds it, and a
+# search that finds it out of date (new index generation, vocabulary grown) only starts a background rebuild and
+# is corrected with the previous one meanwhile. The rebuild swaps in (terms, dfs, variants) as one tuple, so a
+# search running in another thread reads one build or the other, never a mix.
+
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from app.core.config import settings
+from app.services import build_inv_index
+from app.services.background_rebuild import BackgroundRebuild
+from app.services.index_lock import index_lock
+from app.services.segments import SegmentedIndex
+
+logger = logging.getLogger(__name__)
+
+PREFIX_LENGTH = 7  # only the start of a term is indexed, typos later in long words are still found via the verify step
+MAX_EDIT_DISTANCE = 2
+SHORT_TERM_LENGTH = 4  # terms this short only get corrections at distance 1 (and only 1-deletes), distance 2 changes half the word
+REBUILD_GROWTH = 1.2  # rebuild when the vocabulary grew by 20% without a new generation (setup pipeline)
+TERM_ID_BITS = 24  # up to 16M terms
+HASH_MASK = (1 << 40) - 1
+TERM_ID_MASK = (1 << TERM_ID_BITS) - 1
+
+FuzzyIndex = Tuple[List[str], array, array]  # terms, their document frequencies, sorted (variant hash << TERM_ID_BITS | term id)
+
+fuzzy_index: FuzzyIndex = ([], array("I"), array("Q"))
+built_for: Optional[Tuple[int, int]] = None  # (index generation, vocabulary size) fuzzy_index was built for
+build_lock = threading.Lock()  # one build at a time, warm start's or the background one
+
+
+def max_distance_for(word: str) -> int:
+  return 1 if len(word) <= SHORT_TERM_LENGTH else MAX_EDIT_DISTANCE
+
+
+def delete_variants(word: str) -> set:
+  """The word's prefix and every string made by deleting up to max_distance_for(word) characters from it"""
+  prefix = word[:PREFIX_LENGTH]
+  deletes = {prefix}
+  edge = {prefix}  # the variants with the most characters deleted so far
+  for _ in range(max_distance_for(word)):
+    edge = {variant[:i] + variant[i + 1:] for variant in edge for i in range(len(variant))}
+    deletes |= edge
+  return deletes
+
+
+def variant_key(variant: str) -> int:
+  return (hash(variant) & HASH_MASK) << TERM_ID_BITS
+
+
+def build_fuzzy_index(inverted_index: SegmentedIndex) -> FuzzyIndex:
+  """The delete-variant index over the vocabulary of inverted_index (df = postings length)"""
+  start = time.perf_counter()
+  # The setup pipeline adds terms to the memtable in place, the vocabulary is read like a search reads it
+  with index_lock.reading():
+    new_terms = list(inverted_index)
+    dfs = array("I", (inverted_index.document_frequency(term) for term in new_terms))
+
+  packed = array("Q")
+  for term_id, term in enumerate(new_terms):
+    for variant in delete_variants(term):
+      packed.append(variant_key(variant) | term_id)
+  # Sorted by numpy in place of sorted(): a list of millions of Python ints would take many times the array's memory
+  packed = array("Q", np.sort(np.frombuffer(packed, dtype=np.uint64)).tobytes())
+
+  logger.info(f"Fuzzy index built: {len(new_terms)} terms, {len(packed)} variants in {time.perf_counter() - start:.2f}s")
+  return new_terms, dfs, packed
+
+
+def is_stale(inverted_index: SegmentedIndex) -> bool:
+  """A new index generation was loaded since the last build, or the in-memory vocabulary grew a lot"""
+  return (
+    built_for is None
+    or built_for[0] != build_inv_index.loaded_generation
+    or len(inverted_index) > built_for[1] * REBUILD_GROWTH
+  )
+
+
+def refresh_fuzzy_index(force: bool = False):
+  """Rebuild over the loaded index in the calling thread if it is out of date (always with force), then swap it in"""
+  global fuzzy_index, built_for
+
+  with build_lock:
+    with index_lock.reading():
+      # The generation first: a reload swaps the index in before it sets the generation, so at worst the
+      # generation is older than the index and the next search triggers one rebuild too many
+      generation = build_inv_index.loaded_generation
+      inverted_index = build_inv_index.inverted_index
+      if not force and not is_stale(inverted_index):
+        return  # the build this one waited for was recent enough
+      key = (generation, len(inverted_index))
+    fuzzy_index = build_fuzzy_index(inverted_index)
+    built_for = key
+
+
+background_rebuild = BackgroundRebuild("fuzzy-rebuild", refresh_fuzzy_index)
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+  """Optimal string alignment distance (a transposition counts as one edit), max_distance + 1 once it's exceeded"""
+  if abs(len(a) - len(b)) > max_distance:
+    return max_distance + 1
+  previous_previous = None
+  previous = list(range(len(b) + 1))
+  for i in range(1, len(a) + 1):
+    current = [i] + [0] * len(b)
+    row_min = i
+    for j in range(1, len(b) + 1):
+      cost = 0 if a[i - 1] == b[j - 1] else 1
+      current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+      if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+        current[j] = min(current[j], previous_previous[j - 2] + 1)
+      row_min = min(row_min, current[j])
+    if row_min > max_distance:
+      return max_distance + 1
+    previous_previous, previous = previous, current
+  return previous[len(b)]
+
+
+def find_corrections(word: str, deadline: float, limit: int = 5, index: Optional[FuzzyIndex] = None) -> List[Tuple[str, int, int]]:
+  """Vocabulary terms close to word: (term, edit distance, document frequency), best first"""
+  terms, term_dfs, variants = index or fuzzy_index
+  max_distance = max_distance_for(word)
+
+  candidate_ids = set()
+  for variant in delete_variants(word):
+    key = variant_key(variant)
+    lo = bisect_left(variants, key)
+    hi = bisect_right(variants, key | TERM_ID_MASK, lo)
+    candidate_ids.update(packed & TERM_ID_MASK for packed in variants[lo:hi])
+
+  matches = []
+  for term_id in candidate_ids:
+    # Strict budget: return what was verified so far rather than blowing the query latency
+    if time.perf_counter() > deadline:
+      break
+    distance = edit_distance(word, terms[term_id], max_distance)
+    if distance <= max_distance:
+      matches.append((terms[term_id], distance, term_dfs[term_id]))
+
+  # Closest first, then the most common term
+  matches.sort(key=lambda match: (match[1], -match[2]))
+  return matches[:limit]
+
+
+def correct_terms(unknown_terms: List[str], inverted_index: SegmentedIndex) -> Dict[str, str]:
+  """Best in-vocabulary replacement for each unknown term that has one, within FUZZY_TIME_BUDGET_MS"""
+  if not settings.FUZZY_MATCHING_ENABLED or not unknown_terms:
+    return {}
+  if is_stale(inverted_index):
+    background_rebuild.trigger()  # this search goes on with the previous build
+
+  deadline = time.perf_counter() + settings.FUZZY_TIME_BUDGET_MS / 1000
+  index = fuzzy_index  # the same build for every term of the query
+  corrections = {}
+  for word in unknown_terms:
+    if time.perf_counter() > deadline:
+      break
+    matches = find_corrections(word, deadline, limit=1, index=index)
+    if matches:
+      corrections[word] = matches[0][0]
+  return corrections
@@ -0,0 +1,54 @@
+# Readers-writer lock over the in-memory index
+#
+# Searches run in worker threads (see admission.py) while the setup pipeline adds documents to the memtable and
+# to the TF-IDF statistics in place (build_inv_index.add_documents_to_index). Any number of searches can read at
+# once; a writer waits until they are done and then has the index to itself. New readers wait behind a waiting
+# writer, so a steady stream of searches can't starve it.
+# Everything else that changes the index swaps in a whole new object (a new SegmentedIndex, new segments,
+# new TF-IDF dicts), which needs no lock: a search keeps using the object it started with.
+
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+  """Many readers or one writer. Not reentrant: take it once per request, at the entry point"""
+
+  def __init__(self):
+    self._condition = threading.Condition()
+    self._readers = 0
+    self._writer = False
+    self._writers_waiting = 0
+
+  @contextmanager
+  def reading(self):
+    with self._condition:
+      while self._writer or self._writers_waiting:
+        self._condition.wait()
+      self._readers += 1
+    try:
+      yield
+    finally:
+      with self._condition:
+        self._readers -= 1
+        if not self._readers:
+          self._condition.notify_all()
+
+  @contextmanager
+  def writing(self):
+    with self._condition:
+      self._writers_waiting += 1
+      while self._writer or self._readers:
+        self._condition.wait()
+      self._writers_waiting -= 1
+      self._writer = True
+    try:
+      yield
+    finally:
+      with self._condition:
+        self._writer = False
+        self._condition.notify_all()
+
+
+# Searches, suggestions and the index report read, add_documents_to_index writes
+index_lock = ReadWriteLock()
@@ -0,0 +1,334 @@
+# Index statistics and memory footprint, for capacity planning and for checking memory optimizations
+#
+# Usage (from the project root, against the index published in Redis):
+#   python -m app.services.index_stats --top 20
+#   python -m app.services.index_stats --build --output report.json   (rebuild here first, to time the phases)
+# The running API serves the same report on GET /admin/index/stats when ADMIN_ENDPOINTS_ENABLED is set.
+#
+# The report has
+# - vocabulary: terms, postings, documents and segments of the loaded index
+# - postings_lengths: how many terms have 1, 2-3, 4-7, ... postings (powers of two) and percentiles of the lengths
+# - heaviest_terms: the top N terms by number of postings, their share of all postings and what they take in memory
+# - structures: in-memory, pickled and stored-in-Redis bytes of the inverted index (split into postings, forward
+#   index and docstore), idf_scores and document_frequencies
+# - build_phases: per build and phase, how long the last run took and how many runs this process timed
+#
+# In-memory sizes are estimates. Python objects are walked and measured with sys.getsizeof, except the postings:
+# hundreds of millions of tuples would take minutes to walk, and every posting is the same (doc_id, score) tuple,
+# so a list is measured as the list itself plus its length times the size of its first posting.
+# Every structure is measured on its own: a term string shared by two structures counts in both.
+
+import argparse
+import heapq
+import json
+import logging
+import pickle
+import sys
+import time
+from collections import Counter
+from operator import itemgetter
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from app.core.metrics import INDEX_BUILD_PHASE_SECONDS, last_observed
+from app.services import build_inv_index, build_tfidf_data
+from app.services.index_lock import index_lock
+from app.services.redis_client import get_stored_sizes, SEGMENT_KEY_PREFIX, TFIDF_STATS_KEY
+from app.services.segments import Postings, SegmentedIndex
+
+logger = logging.getLogger(__name__)
+
+
+# --- Sizes ---
+
+def postings_bytes(term_postings: Postings) -> int:
+  """Estimated memory of one postings list: the list plus len(list) times its first (doc_id, score) tuple"""
+  if not term_postings:
+    return sys.getsizeof(term_postings)
+  doc_id, score = term_postings[0]
+  per_posting = sys.getsizeof(term_postings[0]) + sys.getsizeof(doc_id) + sys.getsizeof(score)
+  return sys.getsizeof(term_postings) + len(term_postings) * per_posting
+
+
+def deep_sizeof(obj: Any) -> int:
+  """Memory of obj and everything it references (containers, strings, numbers, arrays), each object counted once"""
+  seen = set()
+  total = 0
+  stack = [obj]
+  while stack:
+    current = stack.pop()
+    if id(current) in seen:
+      continue
+    seen.add(id(current))
+    total += sys.getsizeof(current)
+    if isinstance(current, dict):
+      stack.extend(current.keys())
+      stack.extend(current.values())
+    elif isinstance(current, (list, tuple, set, frozenset)):
+      stack.extend(current)
+    elif hasattr(current, "__slots__"):
+      stack.extend(getattr(current, name) for name in current.__slots__ if hasattr(current, name))
+    elif hasattr(current, "__dict__"):
+      stack.append(current.__dict__)
+  return total
+
+
+def postings_dict_bytes(postings: Dict[str, Postings]) -> int:
+  """Memory of a term -> postings dict (a segment's or the memtable)"""
+  return sys.getsizeof(postings) + sum(sys.getsizeof(term) + postings_bytes(term_postings) for term, term_postings in postings.items())
+
+
+class _ByteCounter:
+  """A file that only counts what is written to it, so a pickle can be measured without being held in memory"""
+
+  def __init__(self):
+    self.count = 0
+
+  def write(self, data) -> int:
+    self.count += len(data)
+    return len(data)
+
+
+def pickled_size(obj: Any) -> int:
+  """Bytes of obj pickled (what it takes to ship or store it)"""
+  counter = _ByteCounter()
+  pickle.Pickler(counter, protocol=pickle.HIGHEST_PROTOCOL).dump(obj)
+  return counter.count
+
+
+def structure_sizes(index: SegmentedIndex, serialized: bool = True, tfidf: Optional[Dict[str, Dict]] = None) -> Dict[str, Dict[str, Any]]:
+  """
+  {structure: {"in_memory_bytes", "serialized_bytes", "redis_bytes"}} of the inverted index (with its parts:
+  postings, forward_index, docstore), idf_scores and document_frequencies. redis_bytes is None for what is
+  never stored on its own. serialized=False skips pickling and Redis, the slow part on a big index.
+  tfidf: {"idf_scores", "document_frequencies"} to measure, the loaded ones by default
+  """
+  segments = index.segments
+  parts = {
+    "postings": [segment.postings for segment in segments] + [index.memtable],
+    "forward_index": [segment.forward for segment in segments],
+    "docstore": [segment.documents for segment in segments],
+  }
+  if tfidf is None:
+    tfidf = {
+      "idf_scores": build_tfidf_data.idf_scores,
+      "document_frequencies": build_tfidf_data.document_frequencies,
+    }
+
+  part_sizes = {
+    "postings": {"in_memory_bytes": sum(postings_dict_bytes(postings) for postings in parts["postings"])},
+    "forward_index": {"in_memory_bytes": sum(deep_sizeof(forward) for forward in parts["forward_index"])},
+    "docstore": {"in_memory_bytes": sum(deep_sizeof(documents) for documents in parts["docstore"])},
+  }
+  sizes = {name: {"in_memory_bytes": deep_sizeof(data)} for name, data in tfidf.items()}
+  inverted_index: Dict[str, Any] = {"in_memory_bytes": sum(part["in_memory_bytes"] for part in part_sizes.values())}
+
+  if serialized:
+    for name, objects in parts.items():
+      part_sizes[name]["serialized_bytes"] = sum(pickled_size(obj) for obj in objects)
+    for name, data in tfidf.items():
+      sizes[name]["serialized_bytes"] = pickled_size(data)
+    inverted_index["serialized_bytes"] = sum(part["serialized_bytes"] for part in part_sizes.values())
+
+    # Segments are stored whole (their parts not on their own), the document frequencies as one compact
+    # array and the IDF not at all, it is derived on load (see redis_client)
+    segment_keys = [f"{SEGMENT_KEY_PREFIX}{segment.segment_id}" for segment in segments]
+    stored = get_stored_sizes(segment_keys + [TFIDF_STATS_KEY])
+    inverted_index["redis_bytes"] = sum(stored.get(key, 0) for key in segment_keys) if stored else None
+    sizes["document_frequencies"]["redis_bytes"] = stored.get(TFIDF_STATS_KEY)
+    sizes["idf_scores"]["redis_bytes"] = None
+
+  inverted_index["parts"] = part_sizes
+  return {"inverted_index": inverted_index, **sizes}
+
+
+# --- Postings lengths ---
+
+def term_postings_lengths(index: SegmentedIndex) -> Counter:
+  """Term -> number of postings over every segment and the memtable (deleted documents not purged yet included)"""
+  lengths: Counter = Counter()
+  for segment in index.segments:
+    for term, term_postings in segment.postings.items():
+      lengths[term] += len(term_postings)
+  for term, term_postings in index.memtable.items():
+    lengths[term] += len(term_postings)
+  return lengths
+
+
+def postings_histogram(lengths: Counter) -> Dict[str, Any]:
+  """Terms and postings per power of two bucket of postings list length, plus percentiles of the lengths"""
+  buckets: Dict[int, List[int]] = {}  # floor(log2(length)) -> [terms, postings]
+  for length in lengths.values():
+    bucket = buckets.setdefault(max(length, 1).bit_length() - 1, [0, 0])
+    bucket[0] += 1
+    bucket[1] += length
+
+  values = np.fromiter(lengths.values(), dtype=np.int64, count=len(lengths))
+  percentiles = {}
+  if len(values):
+    for name, value in zip(("p50", "p90", "p99"), np.percentile(values, [50, 90, 99])):
+      percentiles[name] = float(value)
+    percentiles["max"] = int(values.max())
+    percentiles["mean"] = round(float(values.mean()), 2)
+
+  return {
+    "buckets": [
+      {"min_postings": 1 << bucket, "max_postings": (1 << (bucket + 1)) - 1, "terms": terms, "postings": postings}
+      for bucket, (terms, postings) in sorted(buckets.items())
+    ],
+    **percentiles,
+  }
+
+
+def heaviest_terms(index: SegmentedIndex, lengths: Counter, count: int, idf_scores: Dict[str, float]) -> List[Dict[str, Any]]:
+  """The count terms with the most postings"""
+  total_postings = sum(lengths.values()) or 1
+  terms = []
+  for term, length in heapq.nlargest(count, lengths.items(), key=itemgetter(1)):
+    terms.append({
+      "term": term,
+      "postings": length,
+      "share_pct": round(length / total_postings * 100, 3),
+      "idf": idf_scores.get(term),
+      "in_memory_bytes": sum(postings_bytes(term_postings) for term_postings, _ in index.postings_lists(term)),
+    })
+  return terms
+
+
+# --- Build phases ---
+
+def build_phases() -> Dict[str, Dict[str, Dict[str, Any]]]:
+  """
+  {build: {phase: {"last_seconds", "runs", "total_seconds"}}} of the builds this process ran. Builds run by a
+  Celery worker are only seen in that worker's index_build_phase_seconds metric (or run the CLI with --build)
+  """
+  phases: Dict[str, Dict[str, Dict[str, Any]]] = {}
+  for metric in INDEX_BUILD_PHASE_SECONDS.collect():
+    for sample in metric.samples:
+      if not sample.name.endswith(("_count", "_sum")):
+        continue
+      build, phase = sample.labels["build"], sample.labels["phase"]
+      entry = phases.setdefault(build, {}).setdefault(phase, {
+        "last_seconds": round(last_observed.get((INDEX_BUILD_PHASE_SECONDS, (build, phase)), 0.0), 4)
+      })
+      if sample.name.endswith("_count"):
+        entry["runs"] = int(sample.value)
+      else:
+        entry["total_seconds"] = round(sample.value, 4)
+  return phases
+
+
+# --- The report ---
+
+def snapshot_index():
+  """
+  (index, tfidf) copies of what the setup pipeline changes in place: the memtable's lists and the TF-IDF dicts.
+  Segments never change, they are shared. Taken under the index read lock, which is released before the slow
+  measuring and pickling: a long read would hold up a waiting writer and every search queued behind it
+  """
+  with index_lock.reading():
+    index = build_inv_index.inverted_index  # a publish swaps in a new object, this one stays consistent
+    snapshot = SegmentedIndex(index.segments, index.max_doc_id, index.deleted)
+    snapshot.memtable = {term: list(term_postings) for term, term_postings in index.memtable.items()}
+    tfidf = {
+      "idf_scores": dict(build_tfidf_data.idf_scores),
+      "document_frequencies": dict(build_tfidf_data.document_frequencies),
+    }
+  return snapshot, tfidf
+
+
+def index_report(top_terms: int = 20, serialized: bool = True) -> Dict[str, Any]:
+  """Everything above for the index loaded in this process"""
+  start = time.perf_counter()
+  generation = build_inv_index.loaded_generation
+  index, tfidf = snapshot_index()
+  lengths = term_postings_lengths(index)
+  total_postings = sum(lengths.values())
+
+  report = {
+    "vocabulary": {
+      "terms": len(lengths),
+      "postings": total_postings,
+      "documents": index.doc_count,
+      "segments": len(index.segments),
+      "generation": generation,
+      "tfidf_terms": len(tfidf["document_frequencies"]),
+    },
+    "postings_lengths": postings_histogram(lengths),
+    "heaviest_terms": heaviest_terms(index, lengths, top_terms, tfidf["idf_scores"]),
+    "structures": structure_sizes(index, serialized, tfidf),
+    "build_phases": build_phases(),
+  }
+  report["report_seconds"] = round(time.perf_counter() - start, 3)
+  return report
+
+
+def _megabytes(size: Optional[int]) -> str:
+  return "-" if size is None else f"{size / (1 << 20):.2f} MB"
+
+
+def print_report(report: Dict[str, Any]):
+  """The report as readable text"""
+  vocabulary = report["vocabulary"]
+  print(
+    f"Index generation {vocabulary['generation']}: {vocabulary['documents']} documents in {vocabulary['segments']} segments, "
+    f"{vocabulary['terms']} terms, {vocabulary['postings']} postings"
+  )
+
+  lengths = report["postings_lengths"]
+  print(f"\nPostings per term: p50 {lengths.get('p50')}, p90 {lengths.get('p90')}, p99 {lengths.get('p99')}, max {lengths.get('max')}")
+  for bucket in lengths["buckets"]:
+    print(f"  {bucket['min_postings']:>9}-{bucket['max_postings']:<9} {bucket['terms']:>9} terms {bucket['postings']:>12} postings")
+
+  print("\nHeaviest terms:")
+  for term in report["heaviest_terms"]:
+    print(f"  {term['term']:<24} {term['postings']:>10} postings ({term['share_pct']}%) {_megabytes(term['in_memory_bytes']):>12}")
+
+  print(f"\n{'Structure':<24} {'in memory':>12} {'pickled':>12} {'in Redis':>12}")
+  structures = dict(report["structures"])
+  inverted_index = structures.pop("inverted_index")
+  rows = [("inverted_index", inverted_index)] + [(f"  {name}", sizes) for name, sizes in inverted_index["parts"].items()]
+  for name, sizes in rows + list(structures.items()):
+    print(f"{name:<24} {_megabytes(sizes['in_memory_bytes']):>12} {_megabytes(sizes.get('serialized_bytes')):>12} {_megabytes(sizes.get('redis_bytes')):>12}")
+
+  if report["build_phases"]:
+    print("\nBuild phases (last run / runs / total):")
+    for build, phases in report["build_phases"].items():
+      for phase, timing in phases.items():
+        print(f"  {build:<14} {phase:<16} {timing['last_seconds']:>9.3f}s {timing.get('runs', 0):>5} {timing.get('total_seconds', 0):>10.3f}s")
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description="Statistics and memory footprint of the search index")
+  parser.add_argument("--top", type=int, default=20, help="Number of heaviest terms listed")
+  parser.add_argument("--build", action="store_true", help="Rebuild the index in this process first, to time the build phases")
+  parser.add_argument("--no-serialized", action="store_true", help="Skip the pickled and Redis sizes (faster on a big index)")
+  parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+  parser.add_argument("--output", help="Also write the JSON report to this file")
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  args = parse_args(argv)
+
+  if args.build:
+    build_tfidf_data.build_tfidf_data()
+    build_inv_index.build_inverted_index()
+  else:
+    build_tfidf_data.get_prebuilt_tfidf_data()
+    build_inv_index.get_prebuilt_inv_index()
+
+  report = index_report(args.top, serialized=not args.no_serialized)
+  if args.output:
+    with open(args.output, "w", encoding="utf-8") as f:
+      json.dump(report, f, indent=2)
+  if args.json:
+    print(json.dumps(report, indent=2))
+  else:
+    print_report(report)
+  return report
+
+
+if __name__ == "__main__":
+  main()
@@ -1,13 +1,22 @@
+import logging
 import redis
+from contextlib import contextmanager
 from typing import Optional, Dict, Tuple, List
 
 from redis import client
 from app.core.config import settings
+from app.core.metrics import CACHE_HITS, CACHE_MISSES, REDIS_ERRORS, INDEX_GENERATION
 import pickle
+from array import array
+
+logger = logging.getLogger(__name__)
 
 # Global redis connection 
 redis_client: Optional[redis.Redis] = None  # For current scenario we set it to None when no client is created it's just a good practice
 
+# Key holding a counter that is bumped every time a new index is published
+INDEX_GENERATION_KEY = "index:generation"
+
 # Why we are creating only a single instance of redis client and not seperate redis client for different datas, because
 # - Each redis connection req memory and assets
 # - Creating a new connection takes time
@@ -30,109 +39,531 @@ def get_redis_client() -> redis.Redis:
       )
       # Tests the connection
       redis_client.ping()
-      print("Redis connection established successfully")
+      logger.info("Redis connection established successfully")
     except Exception as e:
-      print(f"Redis connection failed: {e}")
+      REDIS_ERRORS.labels("connect").inc()
+      logger.error(f"Redis connection failed: {e}")
       redis_client = None
   return redis_client
 
 
-import pickle
-from typing import Dict, Tuple
+# --- TF-IDF statistics ---
+# One versioned object instead of separate dicts: the terms (sorted, so a term's id is its position) and their
+# document frequencies as a uint32 array. IDF isn't stored, it follows from df and the document count when loading.
+# The version is bumped in the same transaction, so readers can tell cheaply whether they hold the latest stats.
+TFIDF_STATS_KEY = "tfidf:stats"
+TFIDF_VERSION_KEY = "tfidf:version"
+TFIDF_TOTAL_DOCUMENTS_KEY = "tfidf:total_documents"  # also read on its own by the startup freshness check
+LEGACY_TFIDF_KEYS = ("tfidf:document_frequencies", "tfidf:idf_scores")  # before the stats object
 
-def save_tfidf_data_to_redis(total_docs: int, doc_frequencies: Dict[str, int], idf_scores: Dict[str, float]) -> bool:
-  """Save TF-IDF data to Redis"""
+
+def save_tfidf_stats(total_docs: int, doc_frequencies: Dict[str, int], surface_forms: Optional[Dict[str, str]] = None) -> int:
+  """
+  Publish the document count and frequencies (and with stemming the surface form of each stem, see
+  tfidf.surface_forms), returns the new stats version (0 if Redis is unavailable)
+  """
   try: 
     client = get_redis_client()
     if client is None: 
-      print("Redis client is not available")
-      return False
+      logger.warning("Redis client is not available")
+      return 0
 
-    # Saving each component
-    client.set("tfidf:total_documents", total_docs)
-    # using pickle.dumps() to directly convert whole dict to bytes and save to redis 
-    # since redis only stores string or bytes 
-    client.set("tfidf:document_frequencies", pickle.dumps(doc_frequencies))
-    client.set("tfidf:idf_scores", pickle.dumps(idf_scores))
+    terms = sorted(doc_frequencies)
+    stats = {
+      # NUL separated utf-8, much smaller and faster to pickle than a list of str
+      "terms": "\x00".join(terms).encode("utf-8"),
+      "df": array("I", (doc_frequencies[term] for term in terms)).tobytes(),
+      # Aligned with terms, "" where the term is shown as it is. Empty without stemming
+      "surface": "\x00".join(surface_forms.get(term, "") for term in terms).encode("utf-8") if surface_forms else b"",
+    }
+    pipe = client.pipeline()
+    pipe.set(TFIDF_STATS_KEY, pickle.dumps(stats, protocol=pickle.HIGHEST_PROTOCOL))
+    pipe.set(TFIDF_TOTAL_DOCUMENTS_KEY, total_docs)
+    pipe.delete(*LEGACY_TFIDF_KEYS)
+    pipe.incr(TFIDF_VERSION_KEY)
+    version = int(pipe.execute()[-1])
 
-    print(f"Saved TF-IDF data to Redis: {total_docs} docs, {len(idf_scores)} terms")
-    return True
+    logger.info(f"Saved TF-IDF stats to Redis: {total_docs} docs, {len(terms)} terms (version {version})")
+    return version
+
+  except Exception as e:
+    REDIS_ERRORS.labels("save_tfidf").inc()
+    logger.error(f"Error saving TF-IDF data to Redis: {e}")
+    return 0
+
+
+def load_tfidf_stats() -> Optional[Tuple[int, int, List[str], array, Dict[str, str]]]:
+  """
+  (version, total documents, sorted terms, document frequencies, surface forms) in one round trip,
+  None if there are none
+  """
+  try:
+    client = get_redis_client()
+    if client is None:
+      logger.warning("Redis client not available")
+      return None
+
+    # MGET is a single atomic command, the three values always belong together
+    raw_version, raw_total, raw_stats = client.mget(TFIDF_VERSION_KEY, TFIDF_TOTAL_DOCUMENTS_KEY, TFIDF_STATS_KEY)
+    if raw_stats is None or raw_total is None:
+      CACHE_MISSES.labels("tfidf").inc()
+      logger.info("TF-IDF data not found in Redis")
+      return None
+
+    stats = pickle.loads(raw_stats)
+    terms = stats["terms"].decode("utf-8").split("\x00") if stats["terms"] else []
+    doc_frequencies = array("I")
+    doc_frequencies.frombytes(stats["df"])
+    surface = stats.get("surface")  # missing in stats saved before surface forms were kept
+    forms = {term: form for term, form in zip(terms, surface.decode("utf-8").split("\x00")) if form} if surface else {}
+
+    CACHE_HITS.labels("tfidf").inc()
+    logger.debug(f"Loaded TF-IDF stats from Redis: {int(raw_total)} docs, {len(terms)} terms")
+    return int(raw_version or 0), int(raw_total), terms, doc_frequencies, forms
+
+  except Exception as e:
+    REDIS_ERRORS.labels("load_tfidf").inc()
+    logger.error(f"Error loading TF-IDF data from Redis: {e}")
+    return None
 
+
+def get_tfidf_version() -> Optional[int]:
+  """Version of the published TF-IDF stats (0 if none yet), None if Redis is unavailable"""
+  try:
+    client = get_redis_client()
+    if client is None:
+      return None
+    raw_version = client.get(TFIDF_VERSION_KEY)
+    return int(raw_version) if raw_version is not None else 0
   except Exception as e:
-    print(f"Error saving TF-IDF data to Redis: {e}")
+    REDIS_ERRORS.labels("tfidf_version").inc()
+    logger.error(f"Error reading the TF-IDF stats version from Redis: {e}")
+    return None
+
+
+# --- Index segments (see services/segments.py) ---
+# Each segment is pickled under its own key. The manifest lists the live ones and is published together with
+# a bump of the generation, so readers always see a complete set of segments.
+SEGMENT_KEY_PREFIX = "index:segment:"
+SEGMENT_ID_KEY = "index:segment_id"
+SEGMENT_MANIFEST_KEY = "index:manifest"
+INDEX_WRITE_LOCK_KEY = "index:write_lock"
+
+
+def next_segment_id() -> int:
+  '''
+    A new unique segment id (0 if Redis is unavailable, the segment then only lives in this process)
+  '''
+  try:
+    client = get_redis_client()
+    if client is None:
+      return 0
+    return int(client.incr(SEGMENT_ID_KEY))
+  except Exception as e:
+    REDIS_ERRORS.labels("next_segment_id").inc()
+    logger.error(f"Error allocating a segment id in Redis: {e}")
+    return 0
+
+
+def save_segment(segment) -> bool:
+  '''
+    Saves one immutable index segment, it only becomes visible once a manifest listing it is published
+  '''
+  try:
+    client = get_redis_client()
+    if client is None:
+      logger.warning("Redis Client is not available")
+      return False
+    client.set(f"{SEGMENT_KEY_PREFIX}{segment.segment_id}", pickle.dumps(segment))
+    logger.debug(f"Saved index segment {segment.segment_id} to Redis: {len(segment.postings)} terms")
+    return True
+  except Exception as e:
+    REDIS_ERRORS.labels("save_segment").inc()
+    logger.error(f"Error saving index segment {segment.segment_id} to Redis: {e}")
     return False
-    
 
-def load_tfidf_data_from_redis() -> Tuple[int, Dict[str, int], Dict[str, float]]:
-  """Load TF-IDF data from Redis"""
+
+def load_segments(segment_ids: List[int]) -> Dict[int, object]:
+  '''
+    Loads the given segments in one round trip, ids that don't exist (any more) are left out
+  '''
+  if not segment_ids:
+    return {}
   try:
     client = get_redis_client()
     if client is None:
-      print("Redis client not available")
-      return 0, {}, {}
-    
-    # Check if all data exists
-    if not all([
-      client.exists("tfidf:total_documents"),
-      client.exists("tfidf:document_frequencies"), 
-      client.exists("tfidf:idf_scores")
-    ]):
-      print("TF-IDF data not found in Redis")
-      return 0, {}, {}
-    
-    # Loading each component
-    # Below error can be ignored since we know they are not none and are of correct datatype
-    total_docs = int(client.get("tfidf:total_documents"))
-    doc_frequencies = pickle.loads(client.get("tfidf:document_frequencies"))
-    idf_scores = pickle.loads(client.get("tfidf:idf_scores"))
-    
-    print(f"Loaded TF-IDF data from Redis: {total_docs} docs, {len(idf_scores)} terms")
-    return total_docs, doc_frequencies, idf_scores
-    
+      return {}
+    raw_segments = client.mget([f"{SEGMENT_KEY_PREFIX}{segment_id}" for segment_id in segment_ids])
+    segments = {}
+    for segment_id, raw_segment in zip(segment_ids, raw_segments):
+      if raw_segment is None:
+        CACHE_MISSES.labels("inv_index").inc()
+        continue
+      segments[segment_id] = pickle.loads(raw_segment)
+      CACHE_HITS.labels("inv_index").inc()
+    return segments
   except Exception as e:
-    print(f"Error loading TF-IDF data from Redis: {e}")
-    return 0, {}, {}
+    REDIS_ERRORS.labels("load_segments").inc()
+    logger.error(f"Error loading index segments from Redis: {e}")
+    return {}
 
 
-# TODO: saving and loading the inverted index from redis 
-def save_inv_index_to_redis(inv_index: Dict[str, List[Tuple[int, float]]]) -> bool:
+def delete_segments(segment_ids: List[int]):
   '''
-    Saves inverted index data to redis to prevent rebuilding it everytime
+    Removes segments no manifest refers to any more (merged or replaced by a rebuild)
+  '''
+  if not segment_ids:
+    return
+  try:
+    client = get_redis_client()
+    if client is None:
+      return
+    client.delete(*[f"{SEGMENT_KEY_PREFIX}{segment_id}" for segment_id in segment_ids])
+  except Exception as e:
+    REDIS_ERRORS.labels("delete_segments").inc()
+    logger.error(f"Error deleting index segments from Redis: {e}")
+
+
+def publish_segment_manifest(manifest: Dict) -> int:
+  '''
+    Publishes the list of live segments and bumps the generation in one transaction
+    Returns the new generation, or 0 if nothing was published
+  '''
+  try:
+    client = get_redis_client()
+    if client is None:
+      logger.warning("Redis Client is not available")
+      return 0
+    pipe = client.pipeline()
+    pipe.set(SEGMENT_MANIFEST_KEY, pickle.dumps(manifest))
+    pipe.incr(INDEX_GENERATION_KEY)
+    _, generation = pipe.execute()
+    INDEX_GENERATION.set(int(generation))
+    logger.info(f"Published index generation {generation}: {len(manifest['segments'])} segments")
+    return int(generation)
+  except Exception as e:
+    REDIS_ERRORS.labels("publish_manifest").inc()
+    logger.error(f"Error publishing the segment manifest to Redis: {e}")
+    return 0
+
+
+def load_segment_manifest() -> Tuple[Optional[Dict], int]:
+  '''
+    The published manifest {"segments": [{"id", "doc_count"}, ...], "max_doc_id"} and its generation
+    Returns (None, 0) when nothing has been published yet or Redis can't be reached
+  '''
+  try:
+    client = get_redis_client()
+    if client is None:
+      logger.warning("Redis Client is not available")
+      return None, 0
+
+    # the manifest and its generation in one round trip
+    raw_manifest, raw_generation = client.mget(SEGMENT_MANIFEST_KEY, INDEX_GENERATION_KEY)
+    if raw_manifest is None:
+      logger.info("Segment manifest not found in Redis")
+      return None, 0
+    generation = int(raw_generation) if raw_generation else 0
+    INDEX_GENERATION.set(generation)
+    return pickle.loads(raw_manifest), generation
+  except Exception as e:
+    REDIS_ERRORS.labels("load_manifest").inc()
+    logger.error(f"Error loading the segment manifest from Redis: {e}")
+    return None, 0
+
+
+@contextmanager
+def index_write_lock():
+  '''
+    Held by everything that publishes a new manifest, so two writers (a merge and a compaction, say)
+    never start from the same manifest and drop each other's segments. Without Redis there is nothing to share.
+  '''
+  client = get_redis_client()
+  if client is None:
+    yield
+    return
+  timeout = settings.INDEX_WRITE_LOCK_TIMEOUT_SECONDS
+  with client.lock(INDEX_WRITE_LOCK_KEY, timeout=timeout, blocking_timeout=timeout):
+    yield
+
+
+def get_index_generation() -> Optional[int]:
+  '''
+    Generation of the index currently published in Redis (a single small GET)
+    Returns None when Redis can't be reached
+  '''
+  try:
+    client = get_redis_client()
+    if client is None:
+      return None
+    raw_generation = client.get(INDEX_GENERATION_KEY)
+    return int(raw_generation) if raw_generation else 0
+  except Exception as e:
+    REDIS_ERRORS.labels("get_generation").inc()
+    logger.error(f"Error reading index generation from Redis: {e}")
+    return None
+
+
+def get_stored_sizes(keys: List[str]) -> Dict[str, int]:
+  '''
+    Bytes of the values stored under keys (STRLEN, 0 for missing keys) in one round trip, for the index report
+    Returns {} when Redis can't be reached
+  '''
+  if not keys:
+    return {}
+  try:
+    client = get_redis_client()
+    if client is None:
+      return {}
+    pipe = client.pipeline()
+    for key in keys:
+      pipe.strlen(key)
+    return dict(zip(keys, (int(size) for size in pipe.execute())))
+  except Exception as e:
+    REDIS_ERRORS.labels("stored_sizes").inc()
+    logger.error(f"Error reading value sizes from Redis: {e}")
+    return {}
+
+
+# --- Distributed build ---
+# The tasks of a distributed build (see distributed_build.py) pass their partial results on under keys of their own
+# until the index is published. They expire, so a build that never finished leaves nothing behind.
+# The id of the build in progress is kept too: only one runs at a time and compaction waits for it.
+BUILD_CHUNK_KEY_PREFIX = "index:build:"
+BUILD_CHUNK_TTL_SECONDS = 24 * 60 * 60
+BUILD_RUNNING_KEY = "index:build_running"
+BUILD_RUNNING_TTL_SECONDS = 60 * 60  # a build whose workers died doesn't hold compaction off forever
+
+
+def claim_build(build_id: str) -> bool:
+  '''
+    Registers build_id as the build in progress, False if another one is still running
   '''
-  # trying to connect to client
   try:
     client = get_redis_client()
     if client is None:
-      print("Redis Client is not available")
       return False
+    return bool(client.set(BUILD_RUNNING_KEY, build_id, ex=BUILD_RUNNING_TTL_SECONDS, nx=True))
+  except Exception as e:
+    REDIS_ERRORS.labels("claim_build").inc()
+    logger.error(f"Error registering build {build_id} in Redis: {e}")
+    return False
+
+
+def release_build():
+  try:
+    client = get_redis_client()
+    if client is None:
+      return
+    client.delete(BUILD_RUNNING_KEY)
+  except Exception as e:
+    REDIS_ERRORS.labels("release_build").inc()
+    logger.error(f"Error clearing the running build in Redis: {e}")
 
-    # if the connection suceeds we will save the data to redis
-    client.set("inv_index", pickle.dumps(inv_index))
 
-    print(f"Saved Inverted Index data to Redis: {len(inv_index)} terms")
+def get_running_build() -> Optional[str]:
+  try:
+    client = get_redis_client()
+    if client is None:
+      return None
+    build_id = client.get(BUILD_RUNNING_KEY)
+    return build_id.decode() if build_id else None
+  except Exception as e:
+    REDIS_ERRORS.labels("get_running_build").inc()
+    logger.error(f"Error reading the running build from Redis: {e}")
+    return None
+
+
+def save_build_chunk(key: str, partial: Dict) -> bool:
+  try:
+    client = get_redis_client()
+    if client is None:
+      logger.warning("Redis Client is not available")
+      return False
+    client.set(key, pickle.dumps(partial, protocol=pickle.HIGHEST_PROTOCOL), ex=BUILD_CHUNK_TTL_SECONDS)
     return True
-  
   except Exception as e:
-    print(f"Error saving Inverted Index data to Redis: {e}")
+    REDIS_ERRORS.labels("save_build_chunk").inc()
+    logger.error(f"Error saving build chunk {key} to Redis: {e}")
     return False
 
 
-def load_inv_index_from_redis() -> Dict[str, List[Tuple[int, float]]]:
+def load_build_chunks(keys: List[str]) -> List[Optional[Dict]]:
   '''
-    Loads the inverted index data present in Redis instead of building it from scratch
+    The partial results under keys in one round trip, None for the ones that are missing (or if Redis can't be reached)
   '''
   try:
     client = get_redis_client()
-    if client is None: 
-      print("Redis Client is not available")
-      return {}
+    if client is None:
+      return [None] * len(keys)
+    return [pickle.loads(raw) if raw is not None else None for raw in client.mget(keys)]
+  except Exception as e:
+    REDIS_ERRORS.labels("load_build_chunks").inc()
+    logger.error(f"Error loading build chunks from Redis: {e}")
+    return [None] * len(keys)
+
+
+def delete_build_chunks(keys: List[str]):
+  if not keys:
+    return
+  try:
+    client = get_redis_client()
+    if client is None:
+      return
+    client.delete(*keys)
+  except Exception as e:
+    REDIS_ERRORS.labels("delete_build_chunks").inc()
+    logger.error(f"Error deleting build chunks from Redis: {e}")
+
+
+# --- Tombstones ---
+# A bitmap with one bit per doc id: a set bit means the postings of that document in the published index are
+# stale (the document was deleted or updated). Next to it a set of the doc ids the compaction job still has to
+# fold into the index. SQLite never reuses ids, so the bits of deleted documents can simply stay set.
+TOMBSTONES_KEY = "index:tombstones"
+DIRTY_DOCS_KEY = "index:dirty_docs"
+# Ids a compaction took off the queue, removed only once their changes are published
+COMPACTING_DOCS_KEY = "index:dirty_docs:compacting"
+
+
+def add_tombstone(doc_id: int) -> bool:
+  '''
+    Marks a document's indexed postings as stale and queues it for compaction (one round trip)
+  '''
+  try:
+    client = get_redis_client()
+    if client is None:
+      return False
+    pipe = client.pipeline()
+    pipe.setbit(TOMBSTONES_KEY, doc_id, 1)
+    pipe.sadd(DIRTY_DOCS_KEY, doc_id)
+    pipe.execute()
+    return True
+  except Exception as e:
+    REDIS_ERRORS.labels("add_tombstone").inc()
+    logger.error(f"Error adding tombstone for document {doc_id}: {e}")
+    return False
+
+
+def load_tombstones() -> Optional[bytes]:
+  '''
+    The raw tombstone bitmap (Redis bit order: offset 0 is the highest bit of the first byte)
+    Returns None when Redis can't be reached, b"" when nothing was ever deleted
+  '''
+  try:
+    client = get_redis_client()
+    if client is None:
+      return None
+    return client.get(TOMBSTONES_KEY) or b""
+  except Exception as e:
+    REDIS_ERRORS.labels("load_tombstones").inc()
+    logger.error(f"Error loading tombstones from Redis: {e}")
+    return None
+
+
+def count_dirty_docs() -> int:
+  try:
+    client = get_redis_client()
+    if client is None:
+      return 0
+    with client.pipeline() as pipe:
+      queued, compacting = pipe.scard(DIRTY_DOCS_KEY).scard(COMPACTING_DOCS_KEY).execute()
+    return int(queued) + int(compacting)
+  except Exception as e:
+    REDIS_ERRORS.labels("count_dirty_docs").inc()
+    logger.error(f"Error counting documents waiting for compaction: {e}")
+    return 0
+
+
+def load_dirty_docs() -> List[int]:
+  '''
+    The doc ids deleted or updated since the last published compaction (queued or being compacted)
+  '''
+  try:
+    client = get_redis_client()
+    if client is None:
+      return []
+    return sorted(int(member) for member in client.sunion(DIRTY_DOCS_KEY, COMPACTING_DOCS_KEY))
+  except Exception as e:
+    REDIS_ERRORS.labels("load_dirty_docs").inc()
+    logger.error(f"Error loading documents waiting for compaction: {e}")
+    return []
+
+
+def claim_dirty_docs() -> List[int]:
+  '''
+    The doc ids to compact: the queued ones are moved to the compacting set (atomically, checked with WATCH)
+    and everything in it is returned. They stay there until finish_dirty_docs, so the ids of a compaction
+    that failed or died are taken again by the next one
+    A document changed again afterwards is simply queued again
+  '''
+  try:
+    client = get_redis_client()
+    if client is None:
+      return []
+    with client.pipeline() as pipe:
+      while True:
+        try:
+          pipe.watch(DIRTY_DOCS_KEY)
+          members = pipe.smembers(DIRTY_DOCS_KEY)
+          pipe.multi()
+          if members:
+            pipe.sadd(COMPACTING_DOCS_KEY, *members)
+            pipe.srem(DIRTY_DOCS_KEY, *members)
+          pipe.execute()
+          break
+        except redis.WatchError:
+          continue  # the queue changed under us, read it again
+    return sorted(int(member) for member in client.smembers(COMPACTING_DOCS_KEY))
+  except Exception as e:
+    REDIS_ERRORS.labels("claim_dirty_docs").inc()
+    logger.error(f"Error claiming documents waiting for compaction: {e}")
+    return []
 
-    # loading data from redis and returning it
-    inv_index = pickle.loads(client.get("inv_index"))
 
-    print(f"Loaded Inverted Index data from Redis: {len(inv_index)} terms")
-    return inv_index
+def finish_dirty_docs(doc_ids: List[int]) -> bool:
+  '''
+    Drops compacted doc ids from the compacting set, once the index holding their changes is published
+  '''
+  if not doc_ids:
+    return True
+  try:
+    client = get_redis_client()
+    if client is None:
+      return False
+    client.srem(COMPACTING_DOCS_KEY, *doc_ids)
+    return True
+  except Exception as e:
+    REDIS_ERRORS.labels("finish_dirty_docs").inc()
+    logger.error(f"Error finishing compacted documents: {e}")
+    return False
+
 
-  except Exception as e: 
-    print(f"Error Loading Inverted Index data from Redis: {e}")
-    return {}
\ No newline at end of file
+def clear_tombstones(doc_ids: List[int]) -> bool:
+  '''
+    Clears the bits of documents whose postings in the published index are current again
+    A document that was queued again in the meantime keeps its bit, checked atomically with WATCH
+  '''
+  if not doc_ids:
+    return True
+  try:
+    client = get_redis_client()
+    if client is None:
+      return False
+    with client.pipeline() as pipe:
+      while True:
+        try:
+          pipe.watch(DIRTY_DOCS_KEY)
+          still_dirty = {doc_id for doc_id in doc_ids if pipe.sismember(DIRTY_DOCS_KEY, doc_id)}
+          pipe.multi()
+          for doc_id in doc_ids:
+            if doc_id not in still_dirty:
+              pipe.setbit(TOMBSTONES_KEY, doc_id, 0)
+          pipe.execute()
+          return True
+        except redis.WatchError:
+          continue  # the queue changed under us, check again
+  except Exception as e:
+    REDIS_ERRORS.labels("clear_tombstones").inc()
+    logger.error(f"Error clearing tombstones: {e}")
+    return False
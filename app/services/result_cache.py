@@ -0,0 +1,101 @@
+# Short-lived cache of ranked results, so paging through a query doesn't redo the search
+#
+# The first page of a query scores all candidates and keeps the best RESULT_CACHE_DEPTH (doc_id, score)
+# pairs here, keyed by the query and the index generation they were computed on. Later pages are then
+# just a slice of that list plus hydrating the page from the segment docstores (docstore.py). A new index generation or a deleted/updated
+# document (tombstones.version) changes the key, so stale rankings are never served; they simply age out of the LRU.
+
+import base64
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.metrics import CACHE_HITS, CACHE_MISSES
+
+
+@dataclass
+class RankedResults:
+  ranked: List[Tuple[int, float]]  # best first, at most the depth it was computed for
+  total_matches: int  # every candidate, not just the ranked prefix
+  corrections: Dict[str, str] = field(default_factory=dict)
+  created_at: float = field(default_factory=time.monotonic)
+
+  @property
+  def complete(self) -> bool:
+    return len(self.ranked) >= self.total_matches
+
+  def covers(self, end: int) -> bool:
+    """True if the page ending at end can be served from this list"""
+    return self.complete or end <= len(self.ranked)
+
+
+class RankedResultCache:
+  """Thread-safe LRU with a TTL (FastAPI runs sync code in a thread pool)"""
+
+  def __init__(self, max_entries: int, ttl_seconds: float):
+    self.max_entries = max_entries
+    self.ttl_seconds = ttl_seconds
+    self._entries: "OrderedDict[tuple, RankedResults]" = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key: tuple) -> Optional[RankedResults]:
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None or time.monotonic() - entry.created_at > self.ttl_seconds:
+        if entry is not None:
+          del self._entries[key]
+        CACHE_MISSES.labels("ranked_results").inc()
+        return None
+      self._entries.move_to_end(key)
+      CACHE_HITS.labels("ranked_results").inc()
+      return entry
+
+  def put(self, key: tuple, entry: RankedResults):
+    if self.max_entries <= 0:
+      return
+    with self._lock:
+      self._entries[key] = entry
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+
+ranked_result_cache = RankedResultCache(settings.RESULT_CACHE_SIZE, settings.RESULT_CACHE_TTL_SECONDS)
+
+
+# --- Cursors ---
+# An opaque token for "the page after this one": the next offset plus a fingerprint of the query,
+# so a cursor can't be replayed against a different query by mistake
+
+def query_fingerprint(query: str) -> str:
+  return hashlib.sha1(query.strip().encode("utf-8")).hexdigest()[:12]
+
+
+def encode_cursor(query: str, offset: int) -> str:
+  payload = json.dumps({"q": query_fingerprint(query), "o": offset}, separators=(",", ":"))
+  return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(query: str, cursor: str) -> int:
+  """The offset a cursor points at, ValueError if it is malformed or belongs to another query"""
+  try:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    offset = int(payload["o"])
+    fingerprint = payload["q"]
+  except Exception:
+    raise ValueError("Malformed cursor")
+  if fingerprint != query_fingerprint(query):
+    raise ValueError("Cursor belongs to a different query")
+  if offset < 0:
+    raise ValueError("Malformed cursor")
+  return offset
@@ -1,50 +1,189 @@
-from typing import List, Dict, Any
+import heapq
+from itertools import islice
+from typing import List, Dict, Any, Optional, Tuple, Union
+from app.core.config import settings
+from app.core.metrics import SEARCH_REQUEST_SECONDS, CACHE_HITS, CACHE_MISSES
+from app.services import build_inv_index, build_tfidf_data, tombstones
 from app.services.build_inv_index import get_inverted_index
+from app.services.result_cache import RankedResults, ranked_result_cache, encode_cursor
+from app.services.fuzzy import correct_terms
+from app.services.index_lock import index_lock
+from app.services.boolean_query import is_boolean_query, parse_query, query_terms as boolean_query_terms, replace_terms, remove_terms, evaluate
+from app.services.search_trace import SearchTrace, log_if_slow
+from app.services.similar import find_similar
 from app.services.tfidf import preprocess_text
+from app.services.vector_scoring import DocumentScores, score_terms
 from app.db.database_utils import fetch_documents_by_ids
 
-def search_terms(query_terms: List[str]) -> Dict[int, float]:
+def find_unknown_terms(terms: List[str], inverted_index, trace: SearchTrace) -> List[str]:
+  """
+  Query terms with no postings that are worth a spelling correction
+  A term the corpus has (it has a document frequency) but the index doesn't was pruned at build time
+  (see prune_postings), correcting it would search some other word; it is recorded on the trace instead
+  """
+  unknown_terms = []
+  for term in terms:
+    if term in inverted_index or term in tombstones.overlay_index:
+      continue
+    if term in build_tfidf_data.document_frequencies:
+      if term not in trace.pruned_terms:
+        trace.pruned_terms.append(term)
+    else:
+      unknown_terms.append(term)
+  return unknown_terms
+
+
+def search_terms(query_terms: List[str], trace: Optional[SearchTrace] = None, max_postings_per_term: int = 0) -> Union[Dict[int, float], DocumentScores]:
   """
   Search for docs containing query terms and return relevance scores
-  Returns: {doc_id: combined_relevance_score}
+  Returns: {doc_id: combined_relevance_score}, or the same as DocumentScores arrays for broad queries
   combined_relvance_score: is found adding the scores currently for seperate tokens in your query
+  max_postings_per_term: degraded search under load (see admission.py), each segment's list of a term is only
+  visited up to its best max_postings_per_term postings (they are sorted by score), 0 visits everything
   """
-  inverted_index = get_inverted_index()
+  trace = trace or SearchTrace()
+
+  with trace.stage("index_load"):
+    inverted_index = get_inverted_index()
   if not inverted_index:
     return {}
-  
+
+  # A typo would otherwise just be dropped, search for the closest known term instead
+  unknown_terms = find_unknown_terms(query_terms, inverted_index, trace)
+  if unknown_terms:
+    with trace.stage("fuzzy"):
+      trace.corrections = correct_terms(unknown_terms, inverted_index)
+    query_terms = [trace.corrections.get(term, term) for term in query_terms]
+  trace.check_deadline()
+
+  # Broad queries are summed with numpy (see vector_scoring.py). Documents the setup pipeline added in memory
+  # have no slot, so the dict loop handles everything while there are any. A degraded search only visits
+  # a few postings per term, the dict loop is quicker for that too
+  term_postings = [inverted_index.document_frequency(term) for term in query_terms]
+  if not max_postings_per_term and sum(term_postings) >= settings.SEARCH_VECTORIZED_MIN_POSTINGS and not inverted_index.memtable:
+    for term, count in zip(query_terms, term_postings):
+      if count:
+        trace.record_postings(term, count)
+    with trace.stage("score"):
+      trace.scorer = "vectorized"
+      document_scores = score_terms(query_terms, inverted_index)
+    trace.candidates = len(document_scores)
+    return document_scores
+
   document_scores: Dict[int, float] = {}
   
-  for term in query_terms:
-    if term in inverted_index:
-      for doc_id, tf_idf_score in inverted_index[term]:
-        if doc_id not in document_scores:
-          document_scores[doc_id] = 0.0
-        document_scores[doc_id] += tf_idf_score
+  # Deleted / updated documents: skip their stale postings (O(1) bit check, only when there are any)
+  # and add the current postings of updated ones from the overlay
+  skip_tombstoned = tombstones.active
+  is_tombstoned = tombstones.is_tombstoned
+
+  with trace.stage("score"):
+    for term in query_terms:
+      # One postings list per segment holding the term, with the documents deleted from that segment
+      postings_lists = inverted_index.postings_lists(term)
+      if max_postings_per_term > 0:
+        if any(len(postings) > max_postings_per_term for postings, _ in postings_lists):
+          trace.degraded = True
+        # islice, a slice would copy the part of the list that is visited
+        postings_lists = [(islice(postings, max_postings_per_term), deleted, min(len(postings), max_postings_per_term)) for postings, deleted in postings_lists]
+      else:
+        postings_lists = [(postings, deleted, len(postings)) for postings, deleted in postings_lists]
+      if postings_lists:
+        trace.record_postings(term, sum(length for _, _, length in postings_lists))
+      for postings, deleted, _ in postings_lists:
+        trace.check_deadline()  # between lists, the costly part of a broad query
+        for doc_id, tf_idf_score in postings:
+          if (skip_tombstoned and is_tombstoned(doc_id)) or (deleted and doc_id in deleted):
+            continue
+          if doc_id not in document_scores:
+            document_scores[doc_id] = 0.0
+          document_scores[doc_id] += tf_idf_score
+      for doc_id, tf_idf_score in tombstones.overlay_index.get(term, ()):
+        document_scores[doc_id] = document_scores.get(doc_id, 0.0) + tf_idf_score
   
+  trace.candidates = len(document_scores)
+  return document_scores
+
+
+def search_boolean(query: str, trace: Optional[SearchTrace] = None) -> Dict[int, float]:
+  """
+  Search with AND / OR / NOT / -term syntax (see boolean_query.py)
+  Returns: {doc_id: summed tf-idf score of the matched query terms}
+  """
+  trace = trace or SearchTrace()
+
+  with trace.stage("tokenize"):
+    tree = parse_query(query)
+
+  with trace.stage("index_load"):
+    inverted_index = get_inverted_index()
+  if not inverted_index or tree is None:
+    return {}
+
+  unknown_terms = find_unknown_terms(boolean_query_terms(tree), inverted_index, trace)
+  if unknown_terms:
+    with trace.stage("fuzzy"):
+      trace.corrections = correct_terms(unknown_terms, inverted_index)
+    tree = replace_terms(tree, trace.corrections)
+  if trace.pruned_terms:
+    # Left out of the index, so they are treated like stop words: "a AND pruned" means just "a"
+    tree = remove_terms(tree, set(trace.pruned_terms))
+    if tree is None:
+      return {}
+
+  for term in boolean_query_terms(tree):
+    if term in inverted_index:
+      trace.record_postings(term, inverted_index.document_frequency(term))
+
+  trace.check_deadline()
+  with trace.stage("score"):
+    matches = evaluate(tree, inverted_index)
+    document_scores = dict(zip(matches.doc_ids, matches.scores))
+
+  trace.candidates = len(document_scores)
   return document_scores
 
 
-def get_document_details(document_scores: Dict[int, float], limit: int = 10) -> List[Dict[str, Any]]:
+def rank_documents(document_scores: Union[Dict[int, float], DocumentScores], count: int, trace: Optional[SearchTrace] = None) -> List[Tuple[int, float]]:
+  """
+  The count best (doc_id, score) pairs, highest first
+  heapq.nlargest keeps a heap of count entries instead of sorting every candidate,
+  the arrays of a vectorized search are cut with np.partition. Equal scores are ordered by doc id on both paths
   """
-  Convert document scores to actual document details
+  trace = trace or SearchTrace()
+  with trace.stage("rank"):
+    if isinstance(document_scores, DocumentScores):
+      return document_scores.top(count)
+    return heapq.nlargest(count, document_scores.items(), key=lambda x: (x[1], -x[0]))
+
+
+def hydrate_documents(ranked_docs: List[Tuple[int, float]], trace: Optional[SearchTrace] = None) -> List[Dict[str, Any]]:
+  """
+  Convert ranked (doc_id, score) pairs to actual document details
   Why: Users need to see title, URL, content - not just doc IDs and scores
   """
-  if not document_scores:
+  if not ranked_docs:
     return []
-  
-  # Sort by relevance score (highest first) and limit results
-  sorted_docs = sorted(document_scores.items(), key=lambda x: x[1], reverse=True)[:limit]
-  doc_ids = [doc_id for doc_id, score in sorted_docs]
-  
-  # Fetch actual document data from database
-  documents = fetch_documents_by_ids(doc_ids)
-  
-  # Combine document data with relevance scores
-  doc_lookup = {doc['id']: doc for doc in documents}
+
+  trace = trace or SearchTrace()
+
+  # Display fields come from the docstores of the index segments (or the overlay for updated documents),
+  # only documents no segment holds yet (added in memory by the setup pipeline) are read from the database
+  with trace.stage("hydrate"):
+    doc_lookup = {}
+    for doc_id, _ in ranked_docs:
+      document = tombstones.overlay_documents.get(doc_id) or build_inv_index.inverted_index.document(doc_id)
+      if document is not None:
+        doc_lookup[doc_id] = document
+    missing = [doc_id for doc_id, _ in ranked_docs if doc_id not in doc_lookup]
+    if doc_lookup:
+      CACHE_HITS.labels("docstore").inc(len(doc_lookup))
+    if missing:
+      CACHE_MISSES.labels("docstore").inc(len(missing))
+      doc_lookup.update((doc['id'], doc) for doc in fetch_documents_by_ids(missing))
   
   results = []
-  for doc_id, relevance_score in sorted_docs:
+  for doc_id, relevance_score in ranked_docs:
     if doc_id in doc_lookup:
       doc = doc_lookup[doc_id]
       results.append({
@@ -58,28 +197,120 @@ def get_document_details(document_scores: Dict[int, float], limit: int = 10) ->
   return results
 
 
-def perform_search(query: str, limit: int = 10) -> Dict[str, Any]:
+def get_document_details(document_scores: Dict[int, float], limit: int = 10, trace: Optional[SearchTrace] = None, offset: int = 0) -> List[Dict[str, Any]]:
+  """Details of the documents ranked offset .. offset + limit"""
+  if not document_scores:
+    return []
+  ranked_docs = rank_documents(document_scores, offset + limit, trace)
+  return hydrate_documents(ranked_docs[offset:offset + limit], trace)
+
+
+def rank_query(query: str, end: int, trace: SearchTrace, max_postings_per_term: int = 0) -> RankedResults:
+  """
+  Ranked results of query, deep enough to serve a page ending at end
+  Served from the ranked result cache when possible, so later pages skip the search entirely
+  max_postings_per_term: see search_terms, degraded results are not cached (a full ranking from the cache is used)
+  """
+  with trace.stage("index_load"):
+    get_inverted_index()  # picks up a newly published index before the cache key is made
+  # While the setup pipeline adds documents in memory the generation doesn't change, so don't cache then
+  cacheable = not build_inv_index.incremental_updates_active
+  cache_key = (query.strip(), build_inv_index.loaded_generation, tombstones.version)
+
+  if cacheable:
+    cached = ranked_result_cache.get(cache_key)
+    if cached is not None and cached.covers(end):
+      trace.result_cache_hit = True
+      trace.corrections = cached.corrections
+      trace.candidates = cached.total_matches
+      return cached
+
+  if is_boolean_query(query):
+    # AND / OR / NOT syntax, matched on the doc id ordered postings
+    document_scores = search_boolean(query, trace)
+  else:
+    # Preprocess the query (same as documents)
+    with trace.stage("tokenize"):
+      query_terms = preprocess_text(query)
+
+    # Search using inverted index
+    document_scores = search_terms(query_terms, trace, max_postings_per_term) if query_terms else {}
+
+  trace.check_deadline()
+  # Keep a bit more than this page so the next few pages are cache hits
+  ranked = RankedResults(
+    ranked=rank_documents(document_scores, max(end, settings.RESULT_CACHE_DEPTH), trace),
+    total_matches=len(document_scores),
+    corrections=trace.corrections,
+  )
+  if cacheable and not trace.degraded:
+    ranked_result_cache.put(cache_key, ranked)
+  return ranked
+
+
+def perform_search(
+  query: str, limit: int = 10, debug: bool = False, offset: int = 0, max_postings_per_term: int = 0, deadline: Optional[float] = None
+) -> Dict[str, Any]:
   """
   Main search function that handles the complete search process
   Why: This combines query processing + searching + getting document details
+  offset: how many ranked results to skip (pagination), next_cursor in the response points at the next page
+  debug: include the per-stage timing breakdown and work counters in the response
+  max_postings_per_term: degraded search under load, see search_terms. The response then says "degraded": true
+  deadline: time.perf_counter() value to be done by (admission control), SearchDeadlineExceeded is raised
+  between two steps once it has passed
   """
-  # Preprocess the query (same as documents)
-  query_terms = preprocess_text(query)
-  if not query_terms:
-    return {
-      "query_received": query,
-      "results_found": 0,
-      "search_results": []
-    }
-  
-  # Search using inverted index
-  document_scores = search_terms(query_terms)
-  
-  # Get actual document details with scores
-  search_results = get_document_details(document_scores, limit)
+  trace = SearchTrace(deadline)
+  trace.start_profiling_if_sampled()
+  try:
+    # Searches run in worker threads, the setup pipeline may be adding documents in place (see index_lock.py)
+    with SEARCH_REQUEST_SECONDS.time(), index_lock.reading():
+      ranked = rank_query(query, offset + limit, trace, max_postings_per_term)
+      trace.check_deadline()
+
+      # Get actual document details for this page only
+      search_results = hydrate_documents(ranked.ranked[offset:offset + limit], trace)
+  finally:
+    trace.stop_profiling()
+
+  log_if_slow(query, trace)
   
-  return {
+  next_offset = offset + limit
+  response = {
     "query_received": query,
     "results_found": len(search_results),
-    "search_results": search_results
+    "search_results": search_results,
+    "total_matches": ranked.total_matches,
+    "offset": offset,
+    "next_cursor": encode_cursor(query, next_offset) if next_offset < ranked.total_matches else None
+  }
+  if trace.corrections:
+    response["corrections"] = trace.corrections
+  if trace.degraded:
+    # Only the best postings of each term were scored, total_matches and the deeper ranks are approximate
+    response["degraded"] = True
+  if debug:
+    response["debug"] = trace.as_dict()
+  return response
+
+
+def perform_similar_search(doc_id: int, limit: int = 10) -> Optional[Dict[str, Any]]:
+  """
+  The documents most similar to doc_id (see similar.py), hydrated like search results
+  None if doc_id isn't in the index (unknown, deleted, or not indexed yet)
+  """
+  trace = SearchTrace()
+  with index_lock.reading():
+    with trace.stage("index_load"):
+      inverted_index = get_inverted_index()
+    similarities = find_similar(doc_id, inverted_index, trace)
+    if similarities is None:
+      return None
+
+    search_results = get_document_details(similarities, limit, trace)
+  log_if_slow(f"similar:{doc_id}", trace)
+  return {
+    "document_id": doc_id,
+    "results_found": len(search_results),
+    "similar_documents": search_results,
   }
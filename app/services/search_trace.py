@@ -0,0 +1,115 @@
+# Per-request tracing for the search path
+# A SearchTrace is threaded through perform_search; every stage is observed into the
+# prometheus histograms and kept on the trace so it can be returned in debug mode or
+# written to the slow query log.
+
+import cProfile
+import io
+import logging
+import pstats
+import random
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+from app.core.metrics import SEARCH_STAGE_SECONDS
+
+slow_query_logger = logging.getLogger("app.slow_queries")
+
+# How many functions of a sampled profile end up in the slow query log
+PROFILE_TOP_FUNCTIONS = 15
+
+
+class SearchDeadlineExceeded(Exception):
+  """The search ran past its deadline (see SearchTrace.check_deadline) and was given up"""
+
+
+class SearchTrace:
+  """Stage timings and work counters for a single search request"""
+
+  def __init__(self, deadline: Optional[float] = None):
+    self.started_at = time.perf_counter()
+    self.stages_ms: Dict[str, float] = {}
+    self.term_postings: Dict[str, int] = {}  # postings list length touched per query term
+    self.postings_touched = 0
+    self.candidates = 0
+    self.corrections: Dict[str, str] = {}  # misspelled query term -> term searched instead
+    self.pruned_terms: List[str] = []  # query terms left out of the index by static pruning
+    self.result_cache_hit = False  # ranking served from the ranked result cache (a later page)
+    self.scorer = "dict"  # how the scores were summed: the dict loop, or "vectorized" (numpy, broad queries)
+    self.degraded = False  # only the best postings of each term were scored (admission control under load)
+    self.profiler: Optional[cProfile.Profile] = None
+    self.deadline = deadline  # time.perf_counter() value the search must be done by (admission control), or None
+
+  def check_deadline(self):
+    """
+    Raises SearchDeadlineExceeded once the deadline has passed
+    A thread can't be interrupted from outside, so the search calls this between its steps and stops itself
+    """
+    if self.deadline is not None and time.perf_counter() > self.deadline:
+      raise SearchDeadlineExceeded()
+
+  @contextmanager
+  def stage(self, name: str):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - start
+      SEARCH_STAGE_SECONDS.labels(name).observe(elapsed)
+      self.stages_ms[name] = self.stages_ms.get(name, 0.0) + elapsed * 1000
+
+  def record_postings(self, term: str, count: int):
+    self.term_postings[term] = count
+    self.postings_touched += count
+
+  @property
+  def total_ms(self) -> float:
+    return (time.perf_counter() - self.started_at) * 1000
+
+  def as_dict(self) -> Dict[str, Any]:
+    return {
+      "total_ms": round(self.total_ms, 3),
+      "stages_ms": {name: round(ms, 3) for name, ms in self.stages_ms.items()},
+      "postings_touched": self.postings_touched,
+      "term_postings": self.term_postings,
+      "candidates": self.candidates,
+      "corrections": self.corrections,
+      "pruned_terms": self.pruned_terms,
+      "result_cache_hit": self.result_cache_hit,
+      "scorer": self.scorer,
+      "degraded": self.degraded,
+    }
+
+  # --- Sampled profiling ---
+
+  def start_profiling_if_sampled(self):
+    """Run a small random share of queries under cProfile so slow ones come with a profile"""
+    if settings.SLOW_QUERY_PROFILE_SAMPLE_RATE > 0 and random.random() < settings.SLOW_QUERY_PROFILE_SAMPLE_RATE:
+      self.profiler = cProfile.Profile()
+      self.profiler.enable()
+
+  def stop_profiling(self):
+    if self.profiler is not None:
+      self.profiler.disable()
+
+  def profile_summary(self) -> Optional[str]:
+    if self.profiler is None:
+      return None
+    output = io.StringIO()
+    stats = pstats.Stats(self.profiler, stream=output)
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+    return output.getvalue()
+
+
+def log_if_slow(query: str, trace: SearchTrace):
+  """Write queries over SLOW_QUERY_THRESHOLD_MS to the slow query log, with the profile if one was sampled"""
+  total_ms = trace.total_ms
+  if total_ms < settings.SLOW_QUERY_THRESHOLD_MS:
+    return
+
+  slow_query_logger.warning(f"Slow query ({total_ms:.1f}ms): {query!r} {trace.as_dict()}")
+  profile = trace.profile_summary()
+  if profile:
+    slow_query_logger.warning(f"Profile for slow query {query!r}:\n{profile}")
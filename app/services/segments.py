@@ -0,0 +1,361 @@
+# Segmented (LSM-style) inverted index
+#
+# Instead of one big index that is rewritten whenever anything changes, the index is a list of immutable segments.
+# Every segment is a small inverted index of its own (term -> postings sorted by score) over some of the documents:
+# - newly added documents are indexed into a new small segment, the existing ones are not touched
+# - a search looks each term up in every live segment and adds the postings up (a document lives in exactly one segment)
+# - the tiered merge policy below merges SEGMENT_MERGE_FACTOR segments of the same size tier into one segment of
+#   the next tier. A document is therefore rewritten about once per tier, log(N) times in its life instead of with
+#   every insert, and the number of live segments a search has to visit stays around factor x log(N)
+#
+# The manifest (see redis_client.SEGMENT_MANIFEST_KEY) lists the live segments. Published segments never change,
+# so a process picking up a new index generation only fetches the segments it doesn't hold yet.
+# Deleting a document from a big segment doesn't rewrite it either: the manifest keeps a per-segment list of
+# deleted doc ids whose postings are skipped, and the next merge (or a rewrite once half the segment is deleted)
+# drops them for good.
+#
+# Every segment also carries a forward index of its documents (doc -> its terms, best weighted first, and the
+# length of its tf-idf vector). "Similar documents" reads a document's top terms from it, and deleting documents
+# only has to visit the postings lists of their terms instead of scanning the whole segment.
+# And it carries the display fields of its documents (docstore.py), so search results are hydrated from memory.
+
+import bisect
+import heapq
+import math
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.core.config import settings
+from app.services.docstore import DocStore
+
+Postings = List[Tuple[int, float]]
+
+# Bumped when what a published segment holds changes, older manifests are rebuilt (see build_inv_index.analyzer_matches)
+INDEX_FORMAT = 3  # 2: segments carry a forward index, 3: and a docstore
+
+
+def _by_score(posting: Tuple[int, float]) -> float:
+  # Postings are sorted by score descending, i.e. ascending by -score
+  return -posting[1]
+
+
+class ForwardIndex:
+  """
+  doc -> terms in a few flat arrays, which keeps it small (no tuple or dict per document)
+  The terms of the document at position i are term_ids[offsets[i]:offsets[i + 1]], ids into terms,
+  sorted by tf-idf weight with the weights in the same places, so a document's top N terms are a prefix.
+  norms[i] is the length of the document's full tf-idf vector, for cosine similarity.
+  """
+
+  __slots__ = ("terms", "doc_ids", "offsets", "term_ids", "weights", "norms")
+
+  def __init__(self, terms: List[str], doc_ids: array, offsets: array, term_ids: array, weights: array, norms: array):
+    self.terms = terms
+    self.doc_ids = doc_ids  # sorted
+    self.offsets = offsets
+    self.term_ids = term_ids
+    self.weights = weights
+    self.norms = norms
+
+  @classmethod
+  def from_documents(cls, documents: Iterable[Tuple[int, Dict[str, float]]]) -> "ForwardIndex":
+    """documents: (doc_id, {term: tf-idf score}) pairs in any order"""
+    builder = ForwardIndexBuilder()
+    for doc_id, tfidf_scores in documents:
+      builder.add(doc_id, tfidf_scores)
+    return builder.build()
+
+  @classmethod
+  def _from_entries(cls, terms: List[str], entries: list) -> "ForwardIndex":
+    """entries: (doc_id, term ids, weights, norm) per document"""
+    entries.sort(key=lambda entry: entry[0])
+    forward = cls(terms, array("i"), array("q", [0]), array("i"), array("f"), array("d"))
+    for doc_id, ids, weights, norm in entries:
+      forward.doc_ids.append(doc_id)
+      forward.term_ids.extend(ids)
+      forward.weights.extend(weights)
+      forward.offsets.append(len(forward.term_ids))
+      forward.norms.append(norm)
+    return forward
+
+  @classmethod
+  def merge(cls, forwards: List["ForwardIndex"], deleted: List[frozenset]) -> "ForwardIndex":
+    """The documents of all forwards except the deleted ones (deleted[i] belongs to forwards[i]), in one term table"""
+    term_ids: Dict[str, int] = {}
+    entries = []
+    for forward, doc_ids in zip(forwards, deleted):
+      # Old term id -> id in the merged table, only for terms a kept document uses
+      remap: Dict[int, int] = {}
+      for position, doc_id in enumerate(forward.doc_ids):
+        if doc_id in doc_ids:
+          continue
+        start, end = forward.offsets[position], forward.offsets[position + 1]
+        ids = array("i")
+        for term_id in forward.term_ids[start:end]:
+          if term_id not in remap:
+            remap[term_id] = term_ids.setdefault(forward.terms[term_id], len(term_ids))
+          ids.append(remap[term_id])
+        entries.append((doc_id, ids, forward.weights[start:end], forward.norms[position]))
+    return cls._from_entries(list(term_ids), entries)
+
+  def position(self, doc_id: int) -> int:
+    """Index of doc_id in the arrays, -1 if it isn't here"""
+    position = bisect.bisect_left(self.doc_ids, doc_id)
+    return position if position < len(self.doc_ids) and self.doc_ids[position] == doc_id else -1
+
+  def top_terms(self, position: int, count: int) -> List[Tuple[str, float]]:
+    """The count highest weighted (term, weight) of the document at position"""
+    start = self.offsets[position]
+    end = min(self.offsets[position + 1], start + count)
+    return [(self.terms[self.term_ids[i]], self.weights[i]) for i in range(start, end)]
+
+  def document_terms(self, position: int) -> List[str]:
+    return [self.terms[term_id] for term_id in self.term_ids[self.offsets[position]:self.offsets[position + 1]]]
+
+  def __len__(self) -> int:
+    return len(self.doc_ids)
+
+
+class ForwardIndexBuilder:
+  """Collects documents one at a time (the full build never holds every document's scores at once)"""
+
+  def __init__(self):
+    self.term_ids: Dict[str, int] = {}
+    self.entries = []
+
+  def add(self, doc_id: int, tfidf_scores: Dict[str, float]):
+    ranked = sorted(tfidf_scores.items(), key=_by_score)
+    ids = array("i", (self.term_ids.setdefault(term, len(self.term_ids)) for term, _ in ranked))
+    weights = array("f", (score for _, score in ranked))
+    self.entries.append((doc_id, ids, weights, math.sqrt(sum(score * score for _, score in ranked))))
+
+  def build(self) -> ForwardIndex:
+    return ForwardIndex._from_entries(list(self.term_ids), self.entries)
+
+
+class Segment:
+  """An immutable piece of the index: term -> score sorted postings, plus the forward index and docstore of its documents"""
+
+  __slots__ = ("segment_id", "postings", "forward", "documents")
+
+  def __init__(self, segment_id: int, postings: Dict[str, Postings], forward: ForwardIndex, documents: DocStore):
+    self.segment_id = segment_id
+    self.postings = postings
+    self.forward = forward
+    self.documents = documents
+
+  @classmethod
+  def from_documents(
+    cls, segment_id: int, documents: Iterable[Tuple[int, Dict[str, float]]], display: Iterable[Tuple[int, str, str, str]]
+  ) -> "Segment":
+    """documents: (doc_id, {term: tf-idf score}) pairs, display: (doc_id, title, url, content) of the same documents"""
+    postings: Dict[str, Postings] = {}
+    scored = []
+    for doc_id, tfidf_scores in documents:
+      scored.append((doc_id, tfidf_scores))
+      for term, score in tfidf_scores.items():
+        postings.setdefault(term, []).append((doc_id, score))
+    for term_postings in postings.values():
+      term_postings.sort(key=_by_score)
+    return cls(segment_id, postings, ForwardIndex.from_documents(scored), DocStore.from_documents(display))
+
+  @classmethod
+  def merge(cls, segment_id: int, segments: List["Segment"], deleted: Dict[int, frozenset]) -> "Segment":
+    """
+    One segment with the live documents of all of segments (deleted: segment id -> deleted doc ids)
+    The lists are already sorted by score so they are just interleaved, forward indexes and docstores are concatenated
+    """
+    deleted_docs = [deleted.get(segment.segment_id, frozenset()) for segment in segments]
+    forward = ForwardIndex.merge([segment.forward for segment in segments], deleted_docs)
+    documents = DocStore.merge([segment.documents for segment in segments], deleted_docs)
+    lists_by_term: Dict[str, List[Postings]] = {}
+    for segment in segments:
+      live_postings = segment.live_postings(deleted[segment.segment_id]) if segment.segment_id in deleted else segment.postings
+      for term, term_postings in live_postings.items():
+        lists_by_term.setdefault(term, []).append(term_postings)
+    postings = {
+      term: lists[0] if len(lists) == 1 else list(heapq.merge(*lists, key=_by_score))
+      for term, lists in lists_by_term.items()
+    }
+    return cls(segment_id, postings, forward, documents)
+
+  def without_documents(self, segment_id: int, doc_ids: set) -> "Segment":
+    """A copy without the documents doc_ids"""
+    deleted_docs = [frozenset(doc_ids)]
+    return Segment(
+      segment_id, self.live_postings(doc_ids), ForwardIndex.merge([self.forward], deleted_docs), DocStore.merge([self.documents], deleted_docs)
+    )
+
+  def live_postings(self, doc_ids: set) -> Dict[str, Postings]:
+    """The postings without those of doc_ids, only the lists of their terms (from the forward index) are rewritten"""
+    affected = set()
+    for doc_id in doc_ids:
+      position = self.forward.position(doc_id)
+      if position >= 0:
+        affected.update(self.forward.document_terms(position))
+    postings = dict(self.postings)  # the other lists are shared, segments never change them
+    for term in affected:
+      if term in postings:  # not when pruned from the index
+        kept = [posting for posting in postings[term] if posting[0] not in doc_ids]
+        if kept:
+          postings[term] = kept
+        else:
+          del postings[term]
+    return postings
+
+  def count_postings(self, doc_ids: set, counts: Counter):
+    """Add the terms of doc_ids in this segment to counts (document frequencies), read from the forward index"""
+    for doc_id in doc_ids:
+      position = self.forward.position(doc_id)
+      if position >= 0:
+        counts.update(self.forward.document_terms(position))
+
+  def contains_doc(self, doc_id: int) -> bool:
+    return self.forward.position(doc_id) >= 0
+
+  @property
+  def doc_ids(self) -> array:
+    """The sorted ids of the segment's documents"""
+    return self.forward.doc_ids
+
+  @property
+  def doc_count(self) -> int:
+    return len(self.doc_ids)
+
+  def postings_count(self) -> int:
+    return sum(len(term_postings) for term_postings in self.postings.values())
+
+
+class SegmentedIndex:
+  """
+  The live segments searched as one index
+  Reads like the old term -> postings dict (in, get, [], len, iteration over the terms), but a postings list
+  is stitched together from every segment holding the term, so hot paths use postings_lists() instead.
+  deleted: segment id -> doc ids whose postings in that segment are no longer live.
+  memtable holds documents the setup pipeline adds in memory, the next full build replaces it.
+  """
+
+  def __init__(self, segments: List[Segment], max_doc_id: int = 0, deleted: Optional[Dict[int, frozenset]] = None):
+    self.segments = segments
+    self.max_doc_id = max_doc_id  # highest doc id indexed, newer documents go into the next segment
+    # Only what belongs to a live segment, the deletes of merged / rewritten segments are gone with them
+    live_ids = {segment.segment_id for segment in segments}
+    self.deleted = {segment_id: doc_ids for segment_id, doc_ids in (deleted or {}).items() if doc_ids and segment_id in live_ids}
+    self.memtable: Dict[str, Postings] = {}
+    self._vocabulary: Optional[set] = None
+
+  def postings_lists(self, term: str) -> List[Tuple[Postings, Optional[frozenset]]]:
+    """The postings of term, one score sorted list per segment that has it, with the doc ids to skip in it (or None)"""
+    lists = []
+    for segment in self.segments:
+      term_postings = segment.postings.get(term)
+      if term_postings:
+        lists.append((term_postings, self.deleted.get(segment.segment_id)))
+    if term in self.memtable:
+      lists.append((self.memtable[term], None))
+    return lists
+
+  def get(self, term: str, default=None) -> Optional[Postings]:
+    lists = [
+      [posting for posting in term_postings if posting[0] not in deleted] if deleted else term_postings
+      for term_postings, deleted in self.postings_lists(term)
+    ]
+    if not lists:
+      return default
+    if len(lists) == 1:
+      return lists[0]
+    return list(heapq.merge(*lists, key=_by_score))
+
+  def __getitem__(self, term: str) -> Postings:
+    term_postings = self.get(term)
+    if term_postings is None:
+      raise KeyError(term)
+    return term_postings
+
+  def __contains__(self, term: str) -> bool:
+    return term in self.memtable or any(term in segment.postings for segment in self.segments)
+
+  def __bool__(self) -> bool:
+    return bool(self.segments) or bool(self.memtable)
+
+  @property
+  def vocabulary(self) -> set:
+    # Segments don't change, so the union of their terms is only computed once per index
+    if self._vocabulary is None:
+      vocabulary = set(self.memtable)
+      for segment in self.segments:
+        vocabulary.update(segment.postings)
+      self._vocabulary = vocabulary
+    return self._vocabulary
+
+  def __len__(self) -> int:
+    return len(self.vocabulary)
+
+  def __iter__(self):
+    return iter(self.vocabulary)
+
+  def document_frequency(self, term: str) -> int:
+    """Postings of term including not yet purged deleted ones, cheap enough for every query"""
+    return sum(len(term_postings) for term_postings, _ in self.postings_lists(term))
+
+  def postings_count(self) -> int:
+    return sum(segment.postings_count() for segment in self.segments) + sum(len(p) for p in self.memtable.values())
+
+  @property
+  def doc_count(self) -> int:
+    return sum(segment.doc_count for segment in self.segments) - sum(len(doc_ids) for doc_ids in self.deleted.values())
+
+  def manifest(self) -> Dict:
+    """What is published in Redis: the live segments in order, their deletes, the indexed doc id range and the analyzer"""
+    return {
+      "segments": [
+        {"id": segment.segment_id, "doc_count": segment.doc_count, "deleted": sorted(self.deleted.get(segment.segment_id, ()))}
+        for segment in self.segments
+      ],
+      "max_doc_id": self.max_doc_id,
+      "stemming": settings.STEMMING_ENABLED,  # how the terms were analyzed, queries must match
+      "format": INDEX_FORMAT,
+    }
+
+  def document(self, doc_id: int) -> Optional[Dict[str, str]]:
+    """Display fields of a live document from the docstore of its segment, None if no segment has it"""
+    for segment in self.segments:
+      if doc_id in self.deleted.get(segment.segment_id, ()):
+        continue
+      found = segment.documents.get(doc_id)
+      if found is not None:
+        return found
+    return None
+
+  def add_posting(self, term: str, posting: Tuple[int, float]):
+    """Insert into the memtable at its place in the score order"""
+    if self._vocabulary is not None and term not in self._vocabulary:
+      self._vocabulary.add(term)
+    bisect.insort(self.memtable.setdefault(term, []), posting, key=_by_score)
+
+
+# --- Tiered merge policy ---
+
+def segment_tier(doc_count: int) -> int:
+  """Tier t holds segments of factor**t up to factor**(t + 1) - 1 documents"""
+  factor = max(settings.SEGMENT_MERGE_FACTOR, 2)
+  tier = 0
+  while doc_count >= factor ** (tier + 1):
+    tier += 1
+  return tier
+
+
+def plan_merge(segments: List[Segment]) -> List[Segment]:
+  """
+  The next segments to merge: the oldest SEGMENT_MERGE_FACTOR segments of the smallest tier that has that many
+  Empty when every tier holds fewer, which bounds the live segments to (factor - 1) per tier
+  """
+  factor = max(settings.SEGMENT_MERGE_FACTOR, 2)
+  tiers: Dict[int, List[Segment]] = {}
+  for segment in segments:
+    tiers.setdefault(segment_tier(segment.doc_count), []).append(segment)
+  for tier in sorted(tiers):
+    if len(tiers[tier]) >= factor:
+      return sorted(tiers[tier], key=lambda segment: segment.segment_id)[:factor]
+  return []
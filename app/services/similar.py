@@ -0,0 +1,89 @@
+# "More like this": documents similar to a given one
+#
+# Re-tokenizing the document and searching with all of its terms would touch the postings of hundreds of terms.
+# Instead the document's vector comes from the forward index of its segment (see segments.ForwardIndex), where its
+# terms are already sorted by tf-idf weight, and only the best SIMILAR_QUERY_TERMS of them are used as the query.
+# Postings lists are sorted by score too, so each of those terms only visits its first SIMILAR_POSTINGS_PER_TERM
+# postings: the documents where the term matters most. Deeper postings have small weights and can hardly lift
+# a document into the top results, so this is where the scan stops early.
+#
+# Candidates are ranked by cosine similarity: the dot product over the query terms divided by both vector lengths,
+# which are precomputed in the forward index. Long documents don't win just because they contain more words.
+
+import math
+from typing import Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.services import tombstones
+from app.services.segments import SegmentedIndex
+from app.services.search_trace import SearchTrace
+
+
+def document_vector(doc_id: int, inverted_index: SegmentedIndex) -> Optional[Tuple[List[Tuple[str, float]], float]]:
+  """The top SIMILAR_QUERY_TERMS (term, weight) of a document and its vector length, None if it isn't indexed"""
+  count = settings.SIMILAR_QUERY_TERMS
+  scores = tombstones.overlay_docs.get(doc_id)  # one lookup, a DELETE in another thread may remove it meanwhile
+  if scores is not None:
+    # Updated since the last compaction, its current content is in the overlay
+    top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:count]
+    return top, math.sqrt(sum(score * score for score in scores.values()))
+  if tombstones.active and tombstones.is_tombstoned(doc_id):
+    return None  # deleted
+
+  for segment in inverted_index.segments:
+    position = segment.forward.position(doc_id)
+    if position >= 0 and doc_id not in inverted_index.deleted.get(segment.segment_id, ()):
+      return segment.forward.top_terms(position, count), segment.forward.norms[position]
+  return None
+
+
+def find_similar(doc_id: int, inverted_index: SegmentedIndex, trace: Optional[SearchTrace] = None) -> Optional[Dict[int, float]]:
+  """
+  Cosine similarity of doc_id to every document sharing one of its top terms
+  Returns: {doc_id: similarity} without doc_id itself, None if doc_id isn't indexed
+  """
+  trace = trace or SearchTrace()
+  vector = document_vector(doc_id, inverted_index)
+  if vector is None:
+    return None
+  query, query_norm = vector
+  depth = settings.SIMILAR_POSTINGS_PER_TERM
+
+  dot_products: Dict[int, float] = {}
+  norms: Dict[int, float] = {}  # vector length of every candidate, from the forward index of its segment
+  skip_tombstoned = tombstones.active
+  is_tombstoned = tombstones.is_tombstoned
+
+  with trace.stage("score"):
+    for term, weight in query:
+      touched = 0
+      # Per segment rather than postings_lists(), the segment is where a candidate's norm is
+      for segment in inverted_index.segments:
+        postings = segment.postings.get(term)
+        if not postings:
+          continue
+        deleted = inverted_index.deleted.get(segment.segment_id)
+        forward = segment.forward
+        for candidate, score in postings[:depth]:
+          if (skip_tombstoned and is_tombstoned(candidate)) or (deleted and candidate in deleted):
+            continue
+          if candidate not in norms:
+            norms[candidate] = forward.norms[forward.position(candidate)]
+          dot_products[candidate] = dot_products.get(candidate, 0.0) + weight * score
+        touched += min(len(postings), depth)
+      for candidate, score in tombstones.overlay_index.get(term, ())[:depth]:
+        if candidate not in norms:
+          candidate_scores = tombstones.overlay_docs.get(candidate)
+          if candidate_scores is None:
+            continue  # deleted or compacted since this postings list was read
+          norms[candidate] = math.sqrt(sum(s * s for s in candidate_scores.values()))
+        dot_products[candidate] = dot_products.get(candidate, 0.0) + weight * score
+      trace.record_postings(term, touched)
+
+  dot_products.pop(doc_id, None)
+  trace.candidates = len(dot_products)
+  return {
+    candidate: dot / (query_norm * norms[candidate])
+    for candidate, dot in dot_products.items()
+    if norms[candidate] and query_norm
+  }
@@ -0,0 +1,131 @@
+# Prefix autocomplete (type-ahead) over the index vocabulary
+#
+# With stemming the index holds stems ("battl"), which nobody types, so each term is shown as its surface form
+# (build_tfidf_data.surface_forms: "battle"); stems sharing a surface form count once, with their highest df.
+# The shown terms are kept in one sorted list, so all the completions of a prefix
+# are a contiguous slice found with two binary searches. Short prefixes match huge slices
+# ("c" matches a good part of the vocabulary), so their top completions are precomputed at build time.
+# Everything is rebuilt when a new index generation is published, but never on a keystroke: building takes
+# far longer than the lookup may, and loading the published statistics means a Redis round trip. At most once per
+# GENERATION_CHECK_SECONDS a keystroke starts a background refresh (background_rebuild.py), and the previous
+# structures answer until it swaps the new ones in, all three as one tuple so a lookup never mixes two builds.
+
+import heapq
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+from app.services import build_tfidf_data
+from app.services.background_rebuild import BackgroundRebuild
+from app.services.index_lock import index_lock
+from app.services.redis_client import get_index_generation
+
+logger = logging.getLogger(__name__)
+
+TOP_K = 10  # most suggestions returned for a prefix
+PRECOMPUTED_PREFIX_LENGTH = 3  # prefixes up to this length are answered from top_completions
+GENERATION_CHECK_SECONDS = 1.0  # how often a keystroke may start a check for a newer index
+
+# The sorted terms, their document frequencies (term_dfs[i] is the df of sorted_terms[i]) and the top completions
+# of the short prefixes
+SuggestIndex = Tuple[List[str], array, Dict[str, List[Tuple[str, int]]]]
+
+suggest_index: SuggestIndex = ([], array("I"), {})
+built_for: Optional[Tuple[Optional[int], int]] = None  # (index generation, document count) the data was built from
+last_generation_check: float = 0.0
+build_lock = threading.Lock()  # one refresh at a time, warm start's or the background one
+
+
+def build_suggest_index(document_frequencies: Dict[str, int], surface_forms: Optional[Dict[str, str]] = None) -> SuggestIndex:
+  """The sorted term array (surface forms where given) and the top completions of every short prefix"""
+  start = time.perf_counter()
+  shown = document_frequencies
+  if surface_forms:
+    shown = {}
+    for term, df in document_frequencies.items():
+      form = surface_forms.get(term, term)
+      if df > shown.get(form, 0):
+        shown[form] = df
+  terms = sorted(shown)
+  dfs = array("I", (shown[term] for term in terms))
+
+  # Terms sharing a prefix are next to each other in sorted order, so one pass per
+  # prefix length groups them and a heap keeps the TOP_K most frequent of each group
+  completions: Dict[str, List[Tuple[str, int]]] = {}
+  for length in range(1, PRECOMPUTED_PREFIX_LENGTH + 1):
+    group_prefix = None
+    group: List[int] = []
+    for i, term in enumerate(terms):
+      if len(term) < length:
+        continue
+      prefix = term[:length]
+      if prefix != group_prefix:
+        if group:
+          completions[group_prefix] = _top_of(group, terms, dfs)
+        group_prefix, group = prefix, []
+      group.append(i)
+    if group:
+      completions[group_prefix] = _top_of(group, terms, dfs)
+
+  logger.info(f"Suggest index built: {len(terms)} terms, {len(completions)} precomputed prefixes in {time.perf_counter() - start:.2f}s")
+  return terms, dfs, completions
+
+
+def _top_of(positions: List[int], terms: List[str], dfs: array) -> List[Tuple[str, int]]:
+  best = heapq.nlargest(TOP_K, positions, key=lambda i: (dfs[i], -i))
+  return [(terms[i], dfs[i]) for i in best]
+
+
+def refresh_suggest_index(force: bool = False):
+  """
+  Rebuild the suggestions in the calling thread if a newer index was published (or documents were added in
+  memory), always with force. Called by warm start and in the background, never on a keystroke
+  """
+  global suggest_index, built_for
+
+  with build_lock:
+    generation = get_index_generation()
+    if not force and built_for is not None and built_for[0] != generation:
+      # A new build was published by the celery worker, pick up its document frequencies
+      build_tfidf_data.get_prebuilt_tfidf_data()
+
+    # The setup pipeline changes document_frequencies in place: copied under the index read lock, built without it
+    with index_lock.reading():
+      key = (generation, build_tfidf_data.total_document_count)
+      if not force and key == built_for:
+        return
+      frequencies = dict(build_tfidf_data.document_frequencies)
+      surface_forms = build_tfidf_data.surface_forms  # replaced, never changed in place
+    suggest_index = build_suggest_index(frequencies, surface_forms)
+    built_for = key
+
+
+background_rebuild = BackgroundRebuild("suggest-rebuild", refresh_suggest_index)
+
+
+def suggest(prefix: str, limit: int = TOP_K) -> List[Tuple[str, int]]:
+  """Up to limit (term, document frequency) completions of prefix, most frequent first"""
+  global last_generation_check
+
+  now = time.monotonic()
+  if built_for is None or now - last_generation_check >= GENERATION_CHECK_SECONDS:
+    last_generation_check = now
+    background_rebuild.trigger()  # checks for a newer index off this keystroke, which uses what is built already
+
+  prefix = prefix.strip().lower()
+  limit = max(0, min(limit, TOP_K))
+  if not prefix or not limit:
+    return []
+
+  sorted_terms, term_dfs, top_completions = suggest_index
+  if len(prefix) <= PRECOMPUTED_PREFIX_LENGTH:
+    return top_completions.get(prefix, [])[:limit]
+
+  # Longer prefixes select a short slice of the sorted terms
+  lo = bisect_left(sorted_terms, prefix)
+  hi = bisect_left(sorted_terms, prefix + "\U0010ffff", lo)
+  best = heapq.nlargest(limit, range(lo, hi), key=lambda i: (term_dfs[i], -i))
+  return [(sorted_terms[i], term_dfs[i]) for i in best]
@@ -1,7 +1,13 @@
 import re  # Python RegEx(Regular Expression) For text cleaning
 import math  # Calculating log for IDF
 from collections import Counter
-from typing import List, Dict, Set  # For type hinting
+from functools import lru_cache
+from typing import List, Dict, Optional, Set  # For type hinting
+
+import numpy as np  # IDF of the whole vocabulary in one vectorized operation
+import snowballstemmer  # Porter2 ("english") stemmer, runs on the much faster PyStemmer C code when that is installed
+
+from app.core.config import settings
 
 # What we want
 
@@ -41,9 +47,38 @@ DEFAULT_STOP_WORDS = set([
     "july", "august", "september", "october", "november", "december" 
 ])
 
-def preprocess_text(text: str, stop_words: Set[str] = DEFAULT_STOP_WORDS) -> List[str]:  # This is just to show that it outputs a list
+# 2. Stemming (optional, STEMMING_ENABLED)
+# Reduces the inflected forms of a word to one term: "battle", "battles" and "battled" all become "battl",
+# so they share one postings list and a query for any of them finds all of them.
+# A corpus has far fewer distinct tokens than token occurrences, so every distinct token is stemmed
+# only once and looked up in the memo cache after that.
+english_stemmer = snowballstemmer.stemmer("english")
+
+
+@lru_cache(maxsize=settings.STEM_CACHE_SIZE)
+def stem(token: str) -> str:
+  return english_stemmer.stemWord(token)
+
+
+def surface_forms(token_frequencies: Dict[str, int]) -> Dict[str, str]:
+  """
+  stem -> the unstemmed token it comes from in the most documents (ties: alphabetically first), for showing
+  terms to people: "battl" -> "battle". Only stems that differ from their surface form are listed
+  """
+  best: Dict[str, tuple] = {}
+  for token, frequency in token_frequencies.items():
+    term = stem(token)
+    if term not in best or (-frequency, token) < best[term]:
+      best[term] = (-frequency, token)
+  return {term: token for term, (_, token) in best.items() if token != term}
+
+
+def preprocess_text(text: str, stop_words: Set[str] = DEFAULT_STOP_WORDS, stemming: Optional[bool] = None) -> List[str]:  # This is just to show that it outputs a list
+  """stemming defaults to settings.STEMMING_ENABLED, index and queries must always agree on it"""
   if not text: 
     return []
+  if stemming is None:
+    stemming = settings.STEMMING_ENABLED
 
   text = text.lower()  # Lowercase
   text = re.sub(r'[^\w\s]', '', text)  # Only selecting numbers, spaces and alphanumerics, discarding puntuation and stuff
@@ -54,7 +89,7 @@ def preprocess_text(text: str, stop_words: Set[str] = DEFAULT_STOP_WORDS) -> Lis
   processed_tokens: List[str] = []
   for token in tokens:
     if token not in stop_words: 
-      processed_tokens.append(token)
+      processed_tokens.append(stem(token) if stemming else token)
 
   return processed_tokens
 
@@ -102,6 +137,16 @@ def calculate_idf_with_freq(corpus_tokens: List[List[str]]) -> tuple[Dict[str, f
   return idf_scores, dict(doc_frequencies)
 
 
+def idf_from_document_frequencies(total_docs: int, doc_frequencies: np.ndarray) -> np.ndarray:
+  """
+  IDF of every term at once from its document frequency: log(N / df_t), one numpy operation over the
+  whole df array instead of a Python loop over the vocabulary (df 0 gives 0, like calculate_idf_with_freq)
+  """
+  doc_frequencies = doc_frequencies.astype(np.float64)
+  ratios = np.divide(total_docs, doc_frequencies, out=np.ones_like(doc_frequencies), where=doc_frequencies > 0)
+  return np.log(ratios)
+
+
 def calculate_tfidf(tokens: List[str], idf_scores: Dict[str, float]) -> Dict[str, float]:
   """
   Calculates the TF-IDF score for each term in a document, given the document's tokens and the corpus IDF scores.
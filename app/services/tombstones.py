@@ -0,0 +1,145 @@
+# Deleted and updated documents between two compactions
+#
+# Rewriting the index for every DELETE / PUT would mean a corpus-wide rebuild, so instead:
+# - tombstone_bits: one bit per doc id (mirrors redis_client.TOMBSTONES_KEY). A set bit means the document's
+#   postings in the loaded index are stale, and searches skip them. Checking it is O(1).
+# - overlay: the fresh postings (and display fields) of updated documents, searched next to the index until
+#   compaction has folded them in. An update is therefore searchable immediately.
+# The compaction task (tasks.indexing_tasks.compact_index) removes the stale postings, fixes the
+# document frequencies and clears the bits of updated documents in Redis. The next index reload picks up
+# the bitmap again and drops the overlay entries it no longer needs.
+# Documents changed by another process (a PUT handled by another API worker, the recrawl task) only have their
+# bit set in Redis. An index reload reads their new content from SQLite into the overlay, so from then on
+# they are searchable with it instead of hidden until compaction.
+# Searches read all of this from worker threads without a lock. So writers (DELETE / PUT, index reloads) hold
+# tombstones_lock among themselves and never change an overlay postings list in place: they build a new list and
+# swap it in, a search keeps reading the list it got.
+
+import logging
+import math
+import threading
+from typing import Dict, List, Tuple
+
+from app.db.database_utils import fetch_articles_by_ids
+from app.services import build_tfidf_data
+from app.services.docstore import make_preview
+from app.services.redis_client import add_tombstone, load_dirty_docs, load_tombstones
+from app.services.tfidf import calculate_tfidf, preprocess_text
+
+logger = logging.getLogger(__name__)
+
+tombstone_bits = bytearray()
+active: bool = False  # any bit set, lets searches skip the check entirely in the common case
+
+overlay_docs: Dict[int, Dict[str, float]] = {}  # doc_id -> {term: tf-idf} of its current content
+overlay_index: Dict[str, List[Tuple[int, float]]] = {}  # the same postings by term
+overlay_documents: Dict[int, Dict[str, str]] = {}  # doc_id -> its new title / url / preview for search results
+
+# Bumped on every change, caches of search results and postings views include it in their key
+version: int = 0
+tombstones_lock = threading.Lock()  # held by every writer below
+
+
+def is_tombstoned(doc_id: int) -> bool:
+  """O(1) check whether the loaded index holds stale postings for doc_id"""
+  byte = doc_id >> 3
+  # Redis bitmaps are big endian within a byte, offset 0 is the 0x80 bit
+  return byte < len(tombstone_bits) and bool(tombstone_bits[byte] & (0x80 >> (doc_id & 7)))
+
+
+def _set_bit(doc_id: int):
+  global active
+  byte = doc_id >> 3
+  if byte >= len(tombstone_bits):
+    tombstone_bits.extend(bytes(byte + 1 - len(tombstone_bits)))
+  tombstone_bits[byte] |= 0x80 >> (doc_id & 7)
+  active = True
+
+
+def _remove_from_overlay(doc_id: int):
+  overlay_documents.pop(doc_id, None)
+  for term in overlay_docs.pop(doc_id, {}):
+    postings = [posting for posting in overlay_index.get(term, []) if posting[0] != doc_id]
+    if postings:
+      overlay_index[term] = postings
+    else:
+      overlay_index.pop(term, None)
+
+
+def mark_deleted(doc_id: int):
+  """The document is gone: hide its postings everywhere"""
+  global version
+  with tombstones_lock:
+    _set_bit(doc_id)
+    _remove_from_overlay(doc_id)
+    add_tombstone(doc_id)
+    version += 1
+
+
+def _score(tokens: List[str]) -> Dict[str, float]:
+  """
+  tf-idf of an updated document, with the current IDF (like documents added by the setup pipeline); a term
+  the index has never seen gets the IDF of a term in one document. Compaction makes both exact.
+  """
+  total_documents = max(build_tfidf_data.total_document_count, 1)
+  idf_scores = build_tfidf_data.idf_scores
+  idf = {term: idf_scores.get(term, math.log(total_documents)) for term in set(tokens)}
+  return calculate_tfidf(tokens, idf)
+
+
+def _add_to_overlay(doc_id: int, scores: Dict[str, float], title: str, url: str, content: str):
+  overlay_docs[doc_id] = scores
+  overlay_documents[doc_id] = {"id": doc_id, "title": title, "url": url, "content": make_preview(content)}
+  for term, score in scores.items():
+    postings = overlay_index.get(term, []) + [(doc_id, score)]
+    postings.sort(key=lambda posting: posting[1], reverse=True)
+    overlay_index[term] = postings
+
+
+def mark_updated(doc_id: int, tokens: List[str], title: str, url: str, content: str):
+  """The document has new content: hide its old postings and search the new ones from the overlay"""
+  global version
+  scores = _score(tokens)
+
+  with tombstones_lock:
+    _set_bit(doc_id)
+    _remove_from_overlay(doc_id)
+    _add_to_overlay(doc_id, scores, title, url, content)
+    add_tombstone(doc_id)
+    version += 1
+
+
+def reload_tombstones():
+  """
+  Called with every index reload: take over the bitmap published in Redis
+  Updated documents whose bit was cleared by compaction are in the index now, drop them from the overlay.
+  Documents tombstoned by another process and still in SQLite were updated there, add their new content
+  """
+  global tombstone_bits, active, version
+  with tombstones_lock:
+    # Read under the lock too: a bit set by a DELETE meanwhile must not be lost to an older bitmap
+    raw = load_tombstones()
+    if raw is None:
+      return  # Redis unavailable, keep what we have
+    tombstone_bits = bytearray(raw)
+    active = any(tombstone_bits)
+    for doc_id in [doc_id for doc_id in list(overlay_docs) if not is_tombstoned(doc_id)]:
+      _remove_from_overlay(doc_id)
+    version += 1
+
+  # Only the ids waiting for compaction can be new to this process (deleted documents keep their bit for good).
+  # Read and scored without the lock, a DELETE or PUT of this process must not wait for SQLite
+  changed = [doc_id for doc_id in load_dirty_docs() if is_tombstoned(doc_id) and doc_id not in overlay_docs]
+  if changed:
+    articles = fetch_articles_by_ids(changed)  # deleted ones are gone from SQLite
+    updates = [
+      (article, _score(preprocess_text(f"{article['title']} {article['title']} {article['content']}")))
+      for article in articles
+    ]
+    with tombstones_lock:
+      for article, scores in updates:
+        # Unless this process changed it meanwhile, its own change is newer
+        if is_tombstoned(article['id']) and article['id'] not in overlay_docs:
+          _add_to_overlay(article['id'], scores, article['title'], article['url'], article['content'])
+      version += 1
+  logger.debug(f"Tombstones reloaded: {len(tombstone_bits)} bytes, {len(overlay_docs)} updated documents in the overlay")
@@ -0,0 +1,194 @@
+# Score accumulation for broad queries with numpy
+#
+# search_terms adds the score of every posting of every query term into a dict: one interpreter iteration and
+# one dict update per posting, hundreds of thousands of them for a query of a few common words. Here instead:
+# - every document of every live segment gets a dense slot number 0..N-1 (segment after segment, in the order
+#   of the segment's forward index), so scores can live in one numpy array of N floats
+# - each query term's postings are turned into two arrays, slots and scores, the first time the term is searched
+#   and kept in an LRU of SEARCH_VECTORIZED_CACHED_TERMS terms until a new index is loaded (see SlotTable)
+# - a query is one np.bincount of all its terms' arrays into the N scores. Deleted and tombstoned documents are
+#   a mask over the slots (rebuilt when the tombstones change), the overlay postings of updated documents are added
+#   in Python, there are only a handful of them
+# - the top k come out of np.partition, candidates never become Python objects
+# Scores are summed in the same order as the dict loop, so they come out bit for bit the same.
+# Allocating N floats costs more than a few hundred dict updates, so queries touching fewer than
+# SEARCH_VECTORIZED_MIN_POSTINGS postings stay on the dict loop (search_logic.search_terms decides).
+
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+from app.services import tombstones
+from app.services.segments import SegmentedIndex
+
+
+class DocumentScores:
+  """Candidates of a vectorized search: their doc ids and summed scores, as numpy arrays"""
+
+  __slots__ = ("doc_ids", "scores")
+
+  def __init__(self, doc_ids: np.ndarray, scores: np.ndarray):
+    self.doc_ids = doc_ids
+    self.scores = scores
+
+  def __len__(self) -> int:
+    return len(self.doc_ids)
+
+  def items(self):
+    """(doc_id, score) pairs like dict.items(), for code that wants the candidates one by one"""
+    return zip(self.doc_ids.tolist(), self.scores.tolist())
+
+  def top(self, count: int) -> List[Tuple[int, float]]:
+    """The count best (doc_id, score) pairs, highest first (equal scores by doc id)"""
+    if count <= 0 or not len(self.doc_ids):
+      return []
+    if count < len(self.doc_ids):
+      # Partial selection, O(candidates): the count-th best score is the cut and every candidate scoring at least
+      # that is kept, so documents tied at the cut are ordered by doc id below like the dict path does
+      # (argpartition alone would keep an arbitrary few of them)
+      cut = len(self.scores) - count
+      threshold = np.partition(self.scores, cut)[cut]
+      best = np.flatnonzero(self.scores >= threshold)
+    else:
+      best = np.arange(len(self.doc_ids))
+    best = best[np.lexsort((self.doc_ids[best], -self.scores[best]))][:count]
+    return list(zip(self.doc_ids[best].tolist(), self.scores[best].tolist()))
+
+
+# --- Slot numbering and per-term arrays of the loaded index ---
+
+class SlotTable:
+  """
+  Slots and cached per-term arrays of one loaded index. A new index gets a new table, swapped in as a whole,
+  so a search running meanwhile keeps using the table it started with.
+  The arrays of a common term take 16 bytes per posting, so only the SEARCH_VECTORIZED_CACHED_TERMS most recently
+  searched terms are kept (LRU). Searches run in worker threads: one lock guards the LRU, another lets a single
+  thread recompute the live mask while the others wait for it
+  """
+
+  def __init__(self, inverted_index: SegmentedIndex):
+    self.inverted_index = inverted_index
+    self.segment_bases: Dict[int, int] = {}  # segment id -> its first slot
+    doc_id_arrays = []
+    base = 0
+    for segment in inverted_index.segments:
+      self.segment_bases[segment.segment_id] = base
+      doc_id_arrays.append(np.frombuffer(segment.forward.doc_ids, dtype=np.int32))
+      base += len(segment.forward.doc_ids)
+    # slot -> doc id
+    self.slot_doc_ids = np.concatenate(doc_id_arrays).astype(np.int64) if doc_id_arrays else np.zeros(0, dtype=np.int64)
+    self.term_arrays: "OrderedDict[str, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()  # term -> (slots, scores) of its postings
+    self.max_terms = settings.SEARCH_VECTORIZED_CACHED_TERMS
+    self._lock = threading.Lock()
+    self._live_lock = threading.Lock()
+    # (tombstones.version, mask) swapped as one tuple, the mask is False for documents deleted from their
+    # segment or tombstoned
+    self.live_mask: Tuple[int, np.ndarray] = (-1, np.zeros(0, dtype=bool))
+
+  def live(self) -> np.ndarray:
+    """The mask of slots whose postings count, recomputed when the tombstones changed"""
+    version, mask = self.live_mask
+    if version == tombstones.version:
+      return mask
+    with self._live_lock:
+      version, mask = self.live_mask
+      if version == tombstones.version:
+        return mask  # another thread recomputed it while this one waited
+      version = tombstones.version
+      mask = self._compute_live()
+      self.live_mask = (version, mask)
+      return mask
+
+  def _compute_live(self) -> np.ndarray:
+    live = np.ones(len(self.slot_doc_ids), dtype=bool)
+    for segment in self.inverted_index.segments:
+      deleted = self.inverted_index.deleted.get(segment.segment_id)
+      if deleted:
+        segment_doc_ids = np.frombuffer(segment.forward.doc_ids, dtype=np.int32)
+        positions = np.searchsorted(segment_doc_ids, np.fromiter(deleted, dtype=np.int64, count=len(deleted)))
+        live[self.segment_bases[segment.segment_id] + positions[positions < len(segment_doc_ids)]] = False
+    if tombstones.active:
+      # Redis bit order, offset 0 is the highest bit of the first byte: what unpackbits gives
+      bits = np.unpackbits(np.frombuffer(bytes(tombstones.tombstone_bits), dtype=np.uint8)).astype(bool)
+      covered = self.slot_doc_ids < len(bits)
+      live[covered] &= ~bits[self.slot_doc_ids[covered]]
+    return live
+
+  def postings_arrays(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """(slots, scores) of every posting of term across the segments, in the order the dict loop visits them"""
+    with self._lock:
+      cached = self.term_arrays.get(term)
+      if cached is not None:
+        self.term_arrays.move_to_end(term)
+        return cached
+    slots, scores = [], []
+    for segment in self.inverted_index.segments:
+      term_postings = segment.postings.get(term)
+      if not term_postings:
+        continue
+      pairs = np.array(term_postings, dtype=np.float64).reshape(-1, 2)
+      segment_doc_ids = np.frombuffer(segment.forward.doc_ids, dtype=np.int32)
+      slots.append(self.segment_bases[segment.segment_id] + np.searchsorted(segment_doc_ids, pairs[:, 0].astype(np.int64)))
+      scores.append(pairs[:, 1])
+    if not slots:
+      return None
+    cached = (np.concatenate(slots), np.concatenate(scores))
+    if self.max_terms > 0:
+      with self._lock:
+        self.term_arrays[term] = cached
+        while len(self.term_arrays) > self.max_terms:
+          self.term_arrays.popitem(last=False)
+    return cached
+
+
+slot_table: Optional[SlotTable] = None
+slot_table_lock = threading.Lock()  # one thread builds the table of a new index, the others wait for it
+
+
+def get_slot_table(inverted_index: SegmentedIndex) -> SlotTable:
+  global slot_table
+  table = slot_table
+  if table is None or table.inverted_index is not inverted_index:
+    with slot_table_lock:
+      table = slot_table
+      if table is None or table.inverted_index is not inverted_index:
+        table = SlotTable(inverted_index)
+        slot_table = table
+  return table
+
+
+def score_terms(query_terms: List[str], inverted_index: SegmentedIndex) -> DocumentScores:
+  """The summed scores of every document matching one of query_terms (what search_terms computes as a dict)"""
+  table = get_slot_table(inverted_index)
+  live = table.live()
+
+  slots, scores = [], []
+  for term in query_terms:
+    arrays = table.postings_arrays(term)
+    if arrays is not None:
+      slots.append(arrays[0])
+      scores.append(arrays[1])
+
+  if slots:
+    all_slots = np.concatenate(slots)
+    totals = np.bincount(all_slots, weights=np.concatenate(scores), minlength=len(table.slot_doc_ids))
+    matched = np.zeros(len(table.slot_doc_ids), dtype=bool)
+    matched[all_slots] = True  # a posting can score 0 (a term in every document) and still be a match
+    candidates = np.flatnonzero(matched & live)
+    doc_ids, doc_scores = table.slot_doc_ids[candidates], totals[candidates]
+  else:
+    doc_ids, doc_scores = np.zeros(0, dtype=np.int64), np.zeros(0)
+
+  # Updated documents: their segment postings are tombstoned, the current ones are in the overlay
+  overlay_scores: Dict[int, float] = {}
+  for term in query_terms:
+    for doc_id, tf_idf_score in tombstones.overlay_index.get(term, ()):
+      overlay_scores[doc_id] = overlay_scores.get(doc_id, 0.0) + tf_idf_score
+  if overlay_scores:
+    doc_ids = np.concatenate([doc_ids, np.fromiter(overlay_scores.keys(), dtype=np.int64, count=len(overlay_scores))])
+    doc_scores = np.concatenate([doc_scores, np.fromiter(overlay_scores.values(), dtype=np.float64, count=len(overlay_scores))])
+
+  return DocumentScores(doc_ids, doc_scores)
@@ -72,7 +72,7 @@ async def run_crawler():
     project_root = Path(__file__).parent.parent
     data_dir = project_root / "data"
     featured_file = data_dir / "featured_articles_list.json"
-    fetched_file = data_dir / "fetched_sample_articles.json"
+    fetched_file = data_dir / "fetched_sample_articles.jsonl"
     
     if not featured_file.exists():
       raise FileNotFoundError(f"Crawler didn't create: {featured_file}")
@@ -123,9 +123,10 @@ def cleanup_partial_setup():
       db_path.unlink()
       print(f"Removed: {db_path}")
     
-    # Remove JSON files
+    # Remove the article list, but keep data/fetched_sample_articles.jsonl:
+    # it is the crawl checkpoint, and the next setup run resumes from it instead of refetching
     data_dir = Path("data")
-    for json_file in ["featured_articles_list.json", "fetched_sample_articles.json"]:
+    for json_file in ["featured_articles_list.json"]:
       file_path = data_dir / json_file
       if file_path.exists():
         file_path.unlink()
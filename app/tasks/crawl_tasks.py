@@ -0,0 +1,37 @@
+import logging
+from app.celery_app import celery_app
+from app.crawler.recrawl import run_recrawl
+from app.services.redis_client import add_tombstone
+from app.tasks.indexing_tasks import compact_index, index_new_documents
+
+logger = logging.getLogger(__name__)
+
+@celery_app.task
+def recrawl_articles():
+  """
+  Periodic incremental recrawl, reindexes only the articles that actually changed
+  Changed articles are tombstoned and queued for compaction like a PUT /documents/{id} (which also indexes
+  any new articles), new ones alone only need a new segment. Nothing is rebuilt from scratch.
+  The API processes don't share this worker's memory, so their overlay gets the new content on their next
+  index reload (tombstones.reload_tombstones reads it from SQLite): until compaction a changed article is
+  found with its new text, not hidden.
+  """
+  logger.info("Celery: Recrawling articles...")
+  summary = run_recrawl()
+
+  new_doc_ids = set(summary["new_doc_ids"])
+  updated_doc_ids = [doc_id for doc_id in summary["changed_doc_ids"] if doc_id not in new_doc_ids]
+  if updated_doc_ids:
+    # Their indexed postings are stale. The bit and the dirty queue are all the API needs to pick the new
+    # content up into its overlay
+    for doc_id in updated_doc_ids:
+      add_tombstone(doc_id)
+    logger.info(f"Celery: {len(updated_doc_ids)} articles changed and {len(new_doc_ids)} new, queueing compaction")
+    compact_index.delay()
+  elif new_doc_ids:
+    logger.info(f"Celery: {len(new_doc_ids)} new articles, queueing indexing")
+    index_new_documents.delay()
+  else:
+    logger.info("Celery: No articles changed, index left as is")
+
+  return summary
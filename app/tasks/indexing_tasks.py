@@ -1,16 +1,123 @@
+import logging
+import uuid
+from typing import Any, Dict, List, Optional
+
+from celery import chord
 from app.celery_app import celery_app
+from app.core.config import settings
 from app.services.build_tfidf_data import build_tfidf_data
-from app.services.build_inv_index import build_inverted_index
+from app.services import build_inv_index, distributed_build
+from app.services.build_inv_index import build_inverted_index, compact_index as compact_inverted_index
+from app.services.redis_client import index_write_lock, claim_build, release_build
+
+logger = logging.getLogger(__name__)
+
+@celery_app.task(bind=True)
+def update_search_index(self):
+  # Queued to the workers: spread the build over all of them. Called in-process (warm start, setup pipeline)
+  # the caller waits for the new index, and there may be no worker running at all, so it's built right here
+  if settings.INDEX_BUILD_CHUNK_SIZE > 0 and not self.request.called_directly:
+    return start_distributed_build()
+
+  logger.info("Celery: Rebuilding TF-IDF data and inverted index...")
+  with index_write_lock():
+    build_tfidf_data()
+    build_inverted_index()
+  logger.info("Celery: Search index rebuilt.")
+
+
+def start_distributed_build() -> Optional[str]:
+  """Queue the map/reduce build (see services/distributed_build.py), returns its id"""
+  chunks = distributed_build.plan_chunks(settings.INDEX_BUILD_CHUNK_SIZE)
+  if not chunks:
+    logger.warning("Celery: No articles to index")
+    return None
+  build_id = uuid.uuid4().hex
+  if not claim_build(build_id):
+    logger.info("Celery: A distributed build is already running, not starting another one")
+    return None
+
+  logger.info(f"Celery: Rebuilding the search index as {len(chunks)} chunks (build {build_id})")
+  on_error = abort_distributed_build.s(build_id=build_id)
+  chord(
+    build_index_chunk.s(build_id, first_id, last_id) for first_id, last_id in chunks
+  )(count_build_frequencies.s(build_id).on_error(on_error))
+  return build_id
+
+
+# Every step retries with exponential backoff when it fails, only the failing chunk is redone
+retrying = dict(autoretry_for=(Exception,), retry_backoff=True, max_retries=settings.INDEX_BUILD_CHUNK_RETRIES)
+
+
+@celery_app.task(**retrying)
+def build_index_chunk(build_id: str, first_id: int, last_id: int) -> Dict[str, Any]:
+  """Map step of a distributed build: tokenize one id range"""
+  return distributed_build.map_chunk(build_id, first_id, last_id)
+
+
+@celery_app.task(**retrying)
+def count_build_frequencies(chunks: List[Dict[str, Any]], build_id: str) -> int:
+  """Reduce the document frequencies of every range, then score the ranges in parallel"""
+  total_documents = distributed_build.count_document_frequencies(build_id, chunks)
+  max_doc_id = max(chunk["last_id"] for chunk in chunks)
+  chord(
+    score_index_chunk.s(build_id, chunk) for chunk in chunks
+  )(publish_distributed_build.s(build_id, max_doc_id).on_error(abort_distributed_build.s(build_id=build_id)))
+  return total_documents
+
+
+@celery_app.task(**retrying)
+def score_index_chunk(build_id: str, chunk: Dict[str, Any]) -> Dict[str, Any]:
+  """Score one id range into a segment"""
+  return distributed_build.score_chunk(build_id, chunk)
+
+
+@celery_app.task(**retrying)
+def publish_distributed_build(chunks: List[Dict[str, Any]], build_id: str, max_doc_id: int) -> int:
+  """Publish the segments of every range as the new index"""
+  indexed = distributed_build.publish_build(build_id, chunks, max_doc_id)
+  logger.info(f"Celery: Search index rebuilt from {len(chunks)} chunks ({indexed} documents).")
+  # Articles added while the build ran (and merging the range segments, when there are enough of them)
+  index_new_documents.delay()
+  return indexed
+
+
+@celery_app.task
+def abort_distributed_build(request, exc, traceback, build_id: str):
+  """Error callback: a step failed for good, the published index stays as it was"""
+  logger.error(f"Celery: Distributed build {build_id} failed, keeping the published index: {exc}")
+  release_build()  # what the build left in Redis expires on its own
+
+
+@celery_app.task
+def index_new_documents():
+  """Index articles added since the last segment into a new small segment (queued by POST /documents)"""
+  indexed = build_inv_index.index_new_documents()
+  if indexed:
+    logger.info(f"Celery: Indexed {indexed} new documents.")
+  if build_inv_index.merge_needed():
+    merge_segments.delay()
+
+
+@celery_app.task
+def merge_segments():
+  """Merge index segments by the tiered merge policy (see services/segments.py)"""
+  merges = build_inv_index.merge_segments()
+  if merges:
+    logger.info(f"Celery: Done {merges} segment merges.")
+
 
 @celery_app.task
-def update_search_index():
-  print("Celery: Rebuilding TF-IDF data and inverted index...")
-  build_tfidf_data()
-  build_inverted_index()
-  print("Celery: Search index rebuilt.")
+def compact_index():
+  """Fold deleted / updated documents into the index (queued by the API, also run periodically)"""
+  compacted = compact_inverted_index()
+  if compacted:
+    logger.info(f"Celery: Compacted {compacted} documents into the index.")
+  if build_inv_index.merge_needed():
+    merge_segments.delay()
 
 
 if __name__ == "__main__":
   
   print(type(update_search_index))  # Should show <class 'celery.app.task.Task'>
-  print(hasattr(update_search_index, 'delay'))  # Should print True
\ No newline at end of file
+  print(hasattr(update_search_index, 'delay'))  # Should print True
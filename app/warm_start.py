@@ -0,0 +1,168 @@
+# Non-blocking warm start: the index is loaded (or rebuilt) in the background while the API already answers
+#
+# Loading the TF-IDF stats and the segments from Redis, and worse a full rebuild when the cache is stale,
+# used to run inside the FastAPI lifespan, so the app accepted no traffic for minutes and orchestrators
+# killed it. Now the lifespan only starts warm_start() as a task:
+# - until an index is loaded, search endpoints answer 503 with Retry-After (see main.require_ready)
+# - as soon as the published index is loaded the app is ready, even if it is stale. A stale index is then
+#   rebuilt in a thread and picked up by the searches through the new generation, like a worker's rebuild.
+# /status reports the phase, the progress through the steps, the loaded generation and document count,
+# /ready answers 200 or 503 for readiness probes.
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from app.core.metrics import APP_READY
+from app.db.database_utils import count_articles
+from app.services import build_inv_index
+from app.services.build_inv_index import get_prebuilt_inv_index
+from app.services.build_tfidf_data import get_prebuilt_tfidf_data
+from app.services.fuzzy import refresh_fuzzy_index
+from app.services.redis_client import get_redis_client, TFIDF_TOTAL_DOCUMENTS_KEY
+from app.services.suggest import refresh_suggest_index
+from app.tasks.indexing_tasks import update_search_index
+
+logger = logging.getLogger(__name__)
+
+# The steps of a warm start in order, progress is the share of them done
+STEPS = ["load_tfidf", "load_index", "build_suggest", "build_fuzzy", "check_freshness"]
+
+phase: str = "starting"
+steps_done: int = 0
+ready: bool = False
+stale: bool = False  # serving the published index while a fresher one is being built
+error: Optional[str] = None
+started_at: float = time.monotonic()
+ready_after_seconds: Optional[float] = None
+
+
+def set_phase(name: str):
+  global phase
+  phase = name
+  logger.info(f"Warm start: {name}")
+
+
+def step_done():
+  global steps_done
+  steps_done += 1
+
+
+def mark_ready():
+  """Searches are answered from now on"""
+  global ready, ready_after_seconds
+  if not ready:
+    ready = True
+    ready_after_seconds = round(time.monotonic() - started_at, 3)
+    logger.info(f"Ready to serve searches after {ready_after_seconds}s")
+
+
+def is_ready() -> bool:
+  """Marked ready, or this process holds an index anyway (e.g. built by a benchmark before serving)"""
+  return ready or bool(build_inv_index.inverted_index)
+
+
+APP_READY.set_function(lambda: 1 if is_ready() else 0)
+
+
+def status() -> Dict[str, Any]:
+  """Readiness and load progress, for /status"""
+  return {
+    "ready": is_ready(),
+    "phase": phase,
+    "progress": round(steps_done / len(STEPS), 3),
+    "index_stale": stale,
+    "index_generation": build_inv_index.loaded_generation,
+    "documents": build_inv_index.inverted_index.doc_count,
+    "ready_after_seconds": ready_after_seconds,
+    "error": error,
+  }
+
+
+def check_cache_freshness() -> bool:
+  """True if the cached TF-IDF data covers a different number of documents than the database"""
+  try:
+    db_count = count_articles()
+
+    client = get_redis_client()
+    if client is None:
+      return True  # No Redis, need to refresh
+
+    cached_count_raw = client.get(TFIDF_TOTAL_DOCUMENTS_KEY)
+    cached_count = int(cached_count_raw) if cached_count_raw else 0
+
+    # If counts don't match, cache is stale
+    if db_count != cached_count:
+      logger.info(f"Cache mismatch: DB has {db_count} docs, cache has {cached_count}")
+      return True
+    return False
+  except Exception as e:
+    logger.error(f"Error checking cache freshness: {e}")
+    return True  # On error refresh just to be safe
+
+
+def load_search_structures():
+  """Everything a search needs, from Redis when it's there (a first build otherwise)"""
+  # The order matters here since first we need to build our tfidf_data
+  # Then only we can build the inverted index according to it
+  set_phase("load_tfidf")
+  get_prebuilt_tfidf_data()
+  step_done()
+
+  set_phase("load_index")
+  get_prebuilt_inv_index()
+  step_done()
+
+  # Sorted term dictionary for /suggest
+  set_phase("build_suggest")
+  refresh_suggest_index(force=True)
+  step_done()
+
+  # Delete-variant index for correcting misspelled query terms
+  set_phase("build_fuzzy")
+  refresh_fuzzy_index(force=True)
+  step_done()
+
+
+async def warm_start():
+  """Load the index, become ready, then rebuild it if it turned out stale. Runs as a background task."""
+  global stale, error
+  try:
+    # Blocking Redis / SQLite work runs in a thread, the event loop keeps answering requests meanwhile
+    await asyncio.to_thread(load_search_structures)
+    mark_ready()
+
+    set_phase("check_freshness")
+    should_refresh = await asyncio.to_thread(check_cache_freshness)
+    step_done()
+    if should_refresh:
+      stale = True
+      set_phase("rebuilding_index")
+      logger.info("Cache appears stale - serving the published index while it is rebuilt in the background...")
+      await asyncio.to_thread(update_search_index)
+      # Searches pick up the new generation on their own, the helper structures follow it
+      await asyncio.to_thread(refresh_suggest_index, True)
+      await asyncio.to_thread(refresh_fuzzy_index)
+      stale = False
+      logger.info("Cache refresh completed.")
+    set_phase("ready")
+  except Exception as e:
+    error = str(e)
+    set_phase("failed")
+    # Whatever index got loaded is still served (see is_ready), a later publish is picked up as usual
+    logger.exception(f"Warm start failed: {e}")
+
+
+def start_warm_start() -> asyncio.Task:
+  global started_at
+  started_at = time.monotonic()
+  return asyncio.create_task(warm_start())
+
+
+def mark_ready_for_pipeline():
+  """The setup pipeline fills the index while serving, searches return whatever is indexed so far"""
+  global steps_done
+  steps_done = len(STEPS)
+  set_phase("setup_pipeline")
+  mark_ready()
@@ -0,0 +1,89 @@
+# Synthetic Wikipedia-like corpus and query log generator
+# Term frequencies follow a Zipf distribution like natural language, with a sprinkling of
+# numbers, years and stop words so that preprocess_text does realistic work.
+
+import random
+from itertools import accumulate
+from typing import Dict, Iterator, List
+
+from app.services.tfidf import DEFAULT_STOP_WORDS
+
+# Named corpus sizes accepted by run_benchmarks --size
+CORPUS_SIZES = {"2k": 2_000, "20k": 20_000, "200k": 200_000}
+
+ONSETS = ["b", "br", "c", "ch", "d", "dr", "f", "g", "gr", "h", "k", "l", "m", "n", "p", "pr", "r", "s", "st", "t", "tr", "v", "w", "z"]
+VOWELS = ["a", "e", "i", "o", "u", "ai", "ea", "io", "ou"]
+CODAS = ["", "", "n", "r", "s", "l", "th", "ck", "nd", "st"]
+
+
+def build_vocabulary(size: int, rng: random.Random) -> List[str]:
+  """Deterministic list of pseudo-words, most frequent first"""
+  vocabulary: List[str] = []
+  seen = set()
+  while len(vocabulary) < size:
+    syllables = rng.choice((1, 2, 2, 3, 3, 4))
+    word = "".join(rng.choice(ONSETS) + rng.choice(VOWELS) + rng.choice(CODAS) for _ in range(syllables))
+    if word not in seen and word not in DEFAULT_STOP_WORDS:
+      seen.add(word)
+      vocabulary.append(word)
+  return vocabulary
+
+
+class SyntheticCorpus:
+  """Generates articles and queries from one Zipf distributed vocabulary"""
+
+  def __init__(self, num_docs: int, vocabulary_size: int = 60_000, doc_words: int = 400, seed: int = 42):
+    self.num_docs = num_docs
+    self.doc_words = doc_words
+    self.seed = seed
+    rng = random.Random(seed)
+    self.vocabulary = build_vocabulary(vocabulary_size, rng)
+    # Zipf weights: the word at rank r appears proportionally to 1/r
+    self.cum_weights = list(accumulate(1.0 / rank for rank in range(1, vocabulary_size + 1)))
+    self.stop_words = sorted(DEFAULT_STOP_WORDS)
+
+  def _words(self, rng: random.Random, count: int) -> List[str]:
+    return rng.choices(self.vocabulary, cum_weights=self.cum_weights, k=count)
+
+  def _sentence(self, rng: random.Random, length: int) -> str:
+    words = self._words(rng, length)
+    # Roughly a third of running text in English is stop words
+    for position in range(0, length, 3):
+      words.insert(position, rng.choice(self.stop_words))
+    if rng.random() < 0.3:
+      words.append(str(rng.randint(1000, 2025)))
+    return " ".join(words).capitalize() + "."
+
+  def articles(self) -> Iterator[Dict[str, str]]:
+    """Yield articles shaped like the crawler output"""
+    rng = random.Random(self.seed + 1)
+    for doc_number in range(self.num_docs):
+      title = " ".join(word.capitalize() for word in self._words(rng, rng.randint(1, 4)))
+      paragraphs = []
+      remaining = self.doc_words
+      while remaining > 0:
+        sentences = []
+        for _ in range(rng.randint(3, 7)):
+          length = rng.randint(8, 20)
+          sentences.append(self._sentence(rng, length))
+          remaining -= length
+        paragraphs.append(" ".join(sentences))
+      yield {
+        "title": title,
+        "url": f"https://en.wikipedia.org/wiki/Synthetic_{doc_number}",
+        "content": "\n\n".join(paragraphs),
+        "retrieved_at": "2025-01-01T00:00:00+00:00",
+      }
+
+  def queries(self, count: int) -> List[str]:
+    """Query log mixing broad head-term queries with rarer tail-term ones"""
+    rng = random.Random(self.seed + 2)
+    log = []
+    for _ in range(count):
+      terms = rng.choice((1, 1, 2, 2, 2, 3, 4))
+      if rng.random() < 0.7:
+        words = self._words(rng, terms)
+      else:
+        words = rng.sample(self.vocabulary, terms)
+      log.append(" ".join(words))
+    return log
@@ -0,0 +1,189 @@
+# In-process stand-in for the Redis server used by the benchmarks
+# Implements just the subset of redis.Redis that app/services/redis_client.py calls,
+# storing values as bytes exactly like the real client does with decode_responses=False
+
+import threading
+from typing import Dict, List, Optional, Set
+
+
+def _to_bytes(value) -> bytes:
+  if isinstance(value, bytes):
+    return value
+  return str(value).encode()
+
+
+class LocalRedis:
+  """Dictionary backed replacement for redis.Redis"""
+
+  def __init__(self):
+    self._data: Dict[str, bytes] = {}
+    self._sets: Dict[str, Set[bytes]] = {}
+    self._lock = threading.RLock()
+    self._named_locks: Dict[str, "LocalLock"] = {}
+
+  def ping(self) -> bool:
+    return True
+
+  def get(self, key: str) -> Optional[bytes]:
+    return self._data.get(key)
+
+  def set(self, key: str, value, ex: Optional[int] = None, nx: bool = False) -> Optional[bool]:
+    # ex (expiry in seconds) is accepted but not enforced, a benchmark run doesn't live that long
+    with self._lock:
+      if nx and key in self._data:
+        return None
+      self._data[key] = _to_bytes(value)
+    return True
+
+  def mget(self, *keys) -> List[Optional[bytes]]:
+    if len(keys) == 1 and isinstance(keys[0], (list, tuple)):
+      keys = keys[0]
+    return [self._data.get(key) for key in keys]
+
+  def strlen(self, key: str) -> int:
+    return len(self._data.get(key, b""))
+
+  def exists(self, *keys) -> int:
+    return sum(1 for key in keys if key in self._data)
+
+  def delete(self, *keys) -> int:
+    with self._lock:
+      return sum(1 for key in keys if self._data.pop(key, None) is not None)
+
+  def incr(self, key: str, amount: int = 1) -> int:
+    with self._lock:
+      value = int(self._data.get(key, b"0")) + amount
+      self._data[key] = _to_bytes(value)
+    return value
+
+  # Bitmaps, same bit order as Redis: offset 0 is the highest bit of the first byte
+  def setbit(self, key: str, offset: int, value: int) -> int:
+    with self._lock:
+      data = bytearray(self._data.get(key, b""))
+      byte, mask = offset >> 3, 0x80 >> (offset & 7)
+      if byte >= len(data):
+        data.extend(bytes(byte + 1 - len(data)))
+      previous = int(bool(data[byte] & mask))
+      if value:
+        data[byte] |= mask
+      else:
+        data[byte] &= ~mask & 0xFF
+      self._data[key] = bytes(data)
+    return previous
+
+  def getbit(self, key: str, offset: int) -> int:
+    data = self._data.get(key, b"")
+    byte = offset >> 3
+    return int(byte < len(data) and bool(data[byte] & (0x80 >> (offset & 7))))
+
+  # Sets
+  def sadd(self, key: str, *members) -> int:
+    with self._lock:
+      current = self._sets.setdefault(key, set())
+      added = {_to_bytes(member) for member in members} - current
+      current.update(added)
+    return len(added)
+
+  def srem(self, key: str, *members) -> int:
+    with self._lock:
+      current = self._sets.get(key, set())
+      removed = {_to_bytes(member) for member in members} & current
+      current.difference_update(removed)
+    return len(removed)
+
+  def smembers(self, key: str) -> Set[bytes]:
+    return set(self._sets.get(key, set()))
+
+  def sunion(self, *keys) -> Set[bytes]:
+    with self._lock:
+      return set().union(*(self._sets.get(key, set()) for key in keys))
+
+  def sismember(self, key: str, member) -> bool:
+    return _to_bytes(member) in self._sets.get(key, set())
+
+  def scard(self, key: str) -> int:
+    return len(self._sets.get(key, set()))
+
+  def pipeline(self) -> "LocalPipeline":
+    return LocalPipeline(self)
+
+  def lock(self, name: str, timeout: Optional[float] = None, blocking_timeout: Optional[float] = None) -> "LocalLock":
+    with self._lock:
+      named_lock = self._named_locks.setdefault(name, LocalLock())
+    named_lock.blocking_timeout = blocking_timeout
+    return named_lock
+
+  def memory_usage(self) -> int:
+    """Total size of the stored values in bytes (what Redis would hold in RAM)"""
+    return sum(len(value) for value in self._data.values()) + sum(len(m) for s in self._sets.values() for m in s)
+
+
+class LocalPipeline:
+  """
+  Like redis-py's Pipeline: commands are queued until execute(), except between watch() and multi()
+  where they run immediately. Everything runs in one process, so WATCH never fails.
+  """
+
+  def __init__(self, local: LocalRedis):
+    self._local = local
+    self._queue = []
+    self._immediate = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.reset()
+
+  def reset(self):
+    self._queue = []
+    self._immediate = False
+
+  def watch(self, *keys):
+    self._immediate = True
+
+  def multi(self):
+    self._immediate = False
+
+  def execute(self) -> list:
+    with self._local._lock:
+      results = [command() for command in self._queue]
+    self.reset()
+    return results
+
+  def __getattr__(self, name):
+    command = getattr(self._local, name)
+
+    def run(*args, **kwargs):
+      if self._immediate:
+        return command(*args, **kwargs)
+      self._queue.append(lambda: command(*args, **kwargs))
+      return self
+
+    return run
+
+
+class LocalLock:
+  """Like redis-py's Lock used as a context manager (not reentrant, raises if it can't be acquired in time)"""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.blocking_timeout: Optional[float] = None
+
+  def __enter__(self):
+    timeout = -1 if self.blocking_timeout is None else self.blocking_timeout
+    if not self._lock.acquire(timeout=timeout):
+      raise TimeoutError("Unable to acquire lock within the time specified")
+    return self
+
+  def __exit__(self, *exc):
+    self._lock.release()
+
+
+def install_local_redis() -> LocalRedis:
+  """Make get_redis_client() hand out a LocalRedis instead of connecting to a server"""
+  from app.services import redis_client
+
+  local = LocalRedis()
+  redis_client.redis_client = local
+  return local
@@ -0,0 +1,131 @@
+# What static index pruning saves and what it costs in result quality
+#
+# Usage (from the project root):
+#   python -m benchmarks.pruning_report --docs 2000 --min-df 2 --max-df-ratio 0.5 --max-postings 500
+#
+# The synthetic corpus is indexed twice: once without pruning (the reference) and once with the given
+# PRUNE_* settings. Both indexes answer the same query sample and the report compares their size
+# (terms, postings, bytes in Redis) and the overlap of their top-k results (recall@k against the full index).
+
+import argparse
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+
+def top_documents(queries: List[str], k: int) -> List[List[int]]:
+  """The top k doc ids of every query, searched the way /search does minus the hydration"""
+  from app.services.boolean_query import is_boolean_query
+  from app.services.search_logic import search_boolean, search_terms, rank_documents
+  from app.services.tfidf import preprocess_text
+
+  results = []
+  for query in queries:
+    if is_boolean_query(query):
+      document_scores = search_boolean(query)
+    else:
+      query_terms = preprocess_text(query)
+      document_scores = search_terms(query_terms) if query_terms else {}
+    results.append([doc_id for doc_id, _ in rank_documents(document_scores, k)])
+  return results
+
+
+def recall_at_k(reference: List[List[int]], pruned: List[List[int]]) -> Dict[str, Any]:
+  """Share of the reference top k the pruned index still returns, over the queries that had results"""
+  recalls = []
+  identical = 0
+  for full, cut in zip(reference, pruned):
+    if not full:
+      continue
+    recalls.append(len(set(full) & set(cut)) / len(full))
+    identical += full == cut
+  return {
+    "queries_with_results": len(recalls),
+    "mean_recall": round(sum(recalls) / len(recalls), 4) if recalls else None,
+    "min_recall": round(min(recalls), 4) if recalls else None,
+    "identical_rankings": identical,
+  }
+
+
+def saved(before: int, after: int) -> Optional[float]:
+  return round((before - after) / before * 100, 2) if before else None
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description="Memory saved and recall lost by static index pruning")
+  parser.add_argument("--docs", type=int, default=2000, help="Number of synthetic documents")
+  parser.add_argument("--doc-words", type=int, default=400, help="Approximate words per document")
+  parser.add_argument("--vocabulary", type=int, default=60_000, help="Synthetic vocabulary size")
+  parser.add_argument("--queries", type=int, default=500, help="Size of the query sample")
+  parser.add_argument("--query-log", type=Path, help="Use this file (one query per line) as the query sample")
+  parser.add_argument("--k", type=int, default=10, help="Depth recall is measured at")
+  parser.add_argument("--seed", type=int, default=42)
+  parser.add_argument("--min-df", type=int, default=2, help="PRUNE_MIN_DF of the pruned index")
+  parser.add_argument("--max-df-ratio", type=float, default=1.0, help="PRUNE_MAX_DF_RATIO of the pruned index")
+  parser.add_argument("--max-postings", type=int, default=0, help="PRUNE_MAX_POSTINGS_PER_TERM of the pruned index")
+  parser.add_argument("--output", type=Path, help="Also write the report to this file")
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  args = parse_args(argv)
+
+  # Same in-process setup as run_benchmarks: scratch database, Redis replaced, before importing app
+  workdir = Path(tempfile.mkdtemp(prefix="searcheng-prune-"))
+  os.environ["SQLITE_DB"] = str(workdir / "benchmark.db")
+  os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+  from benchmarks.corpus import SyntheticCorpus
+  from benchmarks.local_redis import install_local_redis
+  from benchmarks.run_benchmarks import populate_database, index_summary
+
+  local_redis = install_local_redis()
+  corpus = SyntheticCorpus(args.docs, vocabulary_size=args.vocabulary, doc_words=args.doc_words, seed=args.seed)
+  print(f"Loading {args.docs} synthetic documents...")
+  populate_database(corpus)
+
+  from app.core.config import settings
+  from app.services import build_inv_index
+  from app.services.build_tfidf_data import build_tfidf_data
+
+  if args.query_log:
+    queries = [line.strip() for line in args.query_log.read_text(encoding="utf-8").splitlines() if line.strip()]
+  else:
+    queries = corpus.queries(args.queries)
+
+  print("Building the full index...")
+  settings.PRUNE_MIN_DF, settings.PRUNE_MAX_DF_RATIO, settings.PRUNE_MAX_POSTINGS_PER_TERM = 1, 1.0, 0
+  build_tfidf_data()
+  build_inv_index.build_inverted_index()
+  full_index = index_summary(local_redis)
+  full_results = top_documents(queries, args.k)
+
+  print("Building the pruned index...")
+  settings.PRUNE_MIN_DF = args.min_df
+  settings.PRUNE_MAX_DF_RATIO = args.max_df_ratio
+  settings.PRUNE_MAX_POSTINGS_PER_TERM = args.max_postings
+  build_inv_index.build_inverted_index()  # same TF-IDF data, so scores and IDF are identical
+  pruned_index = index_summary(local_redis)
+  pruned_results = top_documents(queries, args.k)
+
+  report = {
+    "settings": {"min_df": args.min_df, "max_df_ratio": args.max_df_ratio, "max_postings_per_term": args.max_postings},
+    "pruning": build_inv_index.pruning_stats,
+    "memory": {
+      key: {"full": full_index[key], "pruned": pruned_index[key], "saved_pct": saved(full_index[key], pruned_index[key])}
+      for key in ("terms", "postings", "redis_bytes")
+    },
+    "recall_at_k": {"k": args.k, "queries": len(queries), **recall_at_k(full_results, pruned_results)},
+  }
+
+  if args.output:
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+  print(json.dumps(report, indent=2))
+  return report
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,306 @@
+# Reproducible benchmarks for index build and search
+#
+# Usage (from the project root):
+#   python -m benchmarks.run_benchmarks --size 2k
+#   python -m benchmarks.run_benchmarks --docs 5000 --queries 2000 --baseline benchmarks/results/old.json
+#
+# Everything runs in-process: a temporary SQLite database is filled with a synthetic corpus,
+# Redis is replaced by benchmarks.local_redis and /search is called through the ASGI app directly.
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlencode
+
+RESULTS_DIR = Path(__file__).parent / "results"
+REJECTED_BACKOFF_SECONDS = 0.25  # pause of a --concurrency client after a 429 / 503
+
+
+def peak_rss_mb() -> float:
+  """High-water mark of the process resident set size"""
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+  if sys.platform == "darwin":
+    return peak / (1024 * 1024)
+  return peak / 1024
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+  if not sorted_values:
+    return 0.0
+  index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+  return sorted_values[index]
+
+
+def git_commit() -> Optional[str]:
+  try:
+    return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+  except Exception:
+    return None
+
+
+def populate_database(corpus) -> float:
+  """Insert the synthetic corpus into the configured SQLite database, returns seconds taken"""
+  from app.db.database_utils import init_db, get_db_connection
+
+  init_db()
+  start = time.perf_counter()
+  with get_db_connection() as conn:
+    conn.executemany(
+      "INSERT OR IGNORE INTO articles (title, url, content, retrieved_at) VALUES (?, ?, ?, ?)",
+      ((a["title"], a["url"], a["content"], a["retrieved_at"]) for a in corpus.articles()),
+    )
+    conn.commit()
+  return time.perf_counter() - start
+
+
+def measure_build() -> Dict[str, Any]:
+  """Time the two build steps the app runs on a cold cache"""
+  from app.services.build_tfidf_data import build_tfidf_data
+  from app.services.build_inv_index import build_inverted_index
+
+  results: Dict[str, Any] = {}
+  for name, step in (("build_tfidf_data", build_tfidf_data), ("build_inverted_index", build_inverted_index)):
+    start = time.perf_counter()
+    step()
+    results[name] = {
+      "seconds": round(time.perf_counter() - start, 4),
+      "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+  return results
+
+
+async def asgi_get(app, path: str, params: Dict[str, Any]) -> tuple:
+  """Minimal ASGI client: one GET request straight into the app, no sockets involved"""
+  query_string = urlencode(params).encode()
+  scope = {
+    "type": "http",
+    "asgi": {"version": "3.0"},
+    "http_version": "1.1",
+    "method": "GET",
+    "scheme": "http",
+    "path": path,
+    "raw_path": path.encode(),
+    "root_path": "",
+    "query_string": query_string,
+    "headers": [(b"host", b"benchmark")],
+    "client": ("127.0.0.1", 0),
+    "server": ("benchmark", 80),
+  }
+  status = 0
+  body = []
+
+  async def receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+  async def send(message):
+    nonlocal status
+    if message["type"] == "http.response.start":
+      status = message["status"]
+    elif message["type"] == "http.response.body":
+      body.append(message.get("body", b""))
+
+  await app(scope, receive, send)
+  return status, b"".join(body)
+
+
+async def replay_queries(queries: List[str], limit: int, warmup: int, concurrency: int = 1) -> Dict[str, Any]:
+  """
+  Replay the query log against /search and collect latency percentiles and QPS
+  concurrency > 1 keeps that many requests in flight at once (an overload test of the admission control),
+  latencies are those of the answered searches, searches turned away with 429 / 503 are counted apart
+  """
+  from app.main import app
+
+  for query in queries[:warmup]:
+    await asgi_get(app, "/search", {"query": query, "limit": limit})
+
+  latencies_ms: List[float] = []
+  errors = 0
+  empty = 0
+  rejected = 0
+  degraded = 0
+  pending = iter(queries)
+
+  async def client():
+    nonlocal errors, empty, rejected, degraded
+    for query in pending:
+      query_start = time.perf_counter()
+      status, body = await asgi_get(app, "/search", {"query": query, "limit": limit})
+      elapsed_ms = (time.perf_counter() - query_start) * 1000
+      if status in (429, 503):
+        # A real client waits Retry-After, here a bit less so the run stays short. Retrying at once would
+        # spin in this very process and take the CPU from the searches being measured
+        rejected += 1
+        await asyncio.sleep(REJECTED_BACKOFF_SECONDS)
+        continue
+      latencies_ms.append(elapsed_ms)
+      if status != 200:
+        errors += 1
+        continue
+      result = json.loads(body)
+      degraded += bool(result.get("degraded"))
+      if result.get("results_found", 0) == 0:
+        empty += 1
+
+  start = time.perf_counter()
+  await asyncio.gather(*(client() for _ in range(max(1, concurrency))))
+  elapsed = time.perf_counter() - start
+
+  latencies_ms.sort()
+  return {
+    "queries": len(queries),
+    "concurrency": max(1, concurrency),
+    "errors": errors,
+    "rejected": rejected,
+    "degraded": degraded,
+    "empty_results": empty,
+    "qps": round(len(latencies_ms) / elapsed, 2) if elapsed else 0.0,
+    "mean_ms": round(statistics.fmean(latencies_ms), 3) if latencies_ms else 0.0,
+    "p50_ms": round(percentile(latencies_ms, 50), 3),
+    "p95_ms": round(percentile(latencies_ms, 95), 3),
+    "p99_ms": round(percentile(latencies_ms, 99), 3),
+    "max_ms": round(latencies_ms[-1], 3) if latencies_ms else 0.0,
+    "peak_rss_mb": round(peak_rss_mb(), 1),
+  }
+
+
+def index_summary(local_redis) -> Dict[str, Any]:
+  from app.services import build_inv_index, build_tfidf_data
+  from app.services.index_stats import structure_sizes
+
+  sizes = structure_sizes(build_inv_index.inverted_index, serialized=False)
+  return {
+    "documents": build_tfidf_data.total_document_count,
+    "terms": len(build_inv_index.inverted_index),
+    "postings": build_inv_index.inverted_index.postings_count(),
+    "segments": len(build_inv_index.inverted_index.segments),
+    "redis_bytes": local_redis.memory_usage(),
+    "stemming": build_tfidf_data.stemming_stats,
+    # Estimated process memory per structure (see services/index_stats.py), compared like everything else
+    "memory_bytes": {
+      **{name: part["in_memory_bytes"] for name, part in sizes["inverted_index"]["parts"].items()},
+      "idf_scores": sizes["idf_scores"]["in_memory_bytes"],
+      "document_frequencies": sizes["document_frequencies"]["in_memory_bytes"],
+    },
+  }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, float]:
+  """Relative change (in %) of every numeric metric present in both result files"""
+  changes: Dict[str, float] = {}
+  for section in ("index", "build", "search"):
+    for key, value in _flatten(current.get(section, {}), section).items():
+      old = _flatten(baseline.get(section, {}), section).get(key)
+      if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+        changes[key] = round((value - old) / old * 100, 2)
+  return changes
+
+
+def _flatten(data: Dict[str, Any], prefix: str) -> Dict[str, Any]:
+  flat: Dict[str, Any] = {}
+  for key, value in data.items():
+    name = f"{prefix}.{key}"
+    if isinstance(value, dict):
+      flat.update(_flatten(value, name))
+    else:
+      flat[name] = value
+  return flat
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark index build and /search latency")
+  parser.add_argument("--size", choices=["2k", "20k", "200k"], default="2k", help="Named corpus size")
+  parser.add_argument("--docs", type=int, help="Exact number of documents (overrides --size)")
+  parser.add_argument("--doc-words", type=int, default=400, help="Approximate words per document")
+  parser.add_argument("--vocabulary", type=int, default=60_000, help="Synthetic vocabulary size")
+  parser.add_argument("--queries", type=int, default=1000, help="Number of queries to replay")
+  parser.add_argument("--query-log", type=Path, help="Replay this file (one query per line) instead of a synthetic log")
+  parser.add_argument("--limit", type=int, default=10, help="limit passed to /search")
+  parser.add_argument("--warmup", type=int, default=20, help="Queries sent before measuring")
+  parser.add_argument("--concurrency", type=int, default=1, help="Requests kept in flight at once (overload test)")
+  parser.add_argument("--seed", type=int, default=42)
+  parser.add_argument("--stemming", action="store_true", help="Build and search with STEMMING_ENABLED")
+  parser.add_argument("--workdir", type=Path, help="Where to create the SQLite database (default: temp dir)")
+  parser.add_argument("--output", type=Path, help="Result file (default: benchmarks/results/<commit>-<size>.json)")
+  parser.add_argument("--baseline", type=Path, help="Earlier result file to compare against")
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  args = parse_args(argv)
+
+  # Settings are read when app.core.config is first imported, so point the app at a
+  # scratch database and quiet the logs before importing anything from app
+  workdir = args.workdir or Path(tempfile.mkdtemp(prefix="searcheng-bench-"))
+  workdir.mkdir(parents=True, exist_ok=True)
+  os.environ["SQLITE_DB"] = str(workdir / "benchmark.db")
+  os.environ.setdefault("LOG_LEVEL", "WARNING")
+  os.environ["STEMMING_ENABLED"] = "true" if args.stemming else "false"
+
+  from benchmarks.corpus import CORPUS_SIZES, SyntheticCorpus
+  from benchmarks.local_redis import install_local_redis
+
+  local_redis = install_local_redis()
+  num_docs = args.docs or CORPUS_SIZES[args.size]
+  corpus = SyntheticCorpus(num_docs, vocabulary_size=args.vocabulary, doc_words=args.doc_words, seed=args.seed)
+
+  print(f"Generating and loading {num_docs} synthetic documents into {os.environ['SQLITE_DB']}...")
+  load_seconds = populate_database(corpus)
+
+  print("Building TF-IDF data and inverted index...")
+  build = measure_build()
+  build["load_corpus"] = {"seconds": round(load_seconds, 4)}
+
+  if args.query_log:
+    queries = [line.strip() for line in args.query_log.read_text(encoding="utf-8").splitlines() if line.strip()]
+  else:
+    queries = corpus.queries(args.queries)
+  print(f"Replaying {len(queries)} queries against /search...")
+  search = asyncio.run(replay_queries(queries, args.limit, args.warmup, args.concurrency))
+
+  commit = git_commit()
+  results = {
+    "meta": {
+      "commit": commit,
+      "timestamp": datetime.now(timezone.utc).isoformat(),
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "documents": num_docs,
+      "doc_words": args.doc_words,
+      "vocabulary": args.vocabulary,
+      "seed": args.seed,
+      "limit": args.limit,
+      "stemming": args.stemming,
+      "concurrency": args.concurrency,
+    },
+    "index": index_summary(local_redis),
+    "build": build,
+    "search": search,
+  }
+
+  if args.baseline:
+    results["comparison_pct"] = compare(results, json.loads(args.baseline.read_text(encoding="utf-8")))
+
+  output = args.output or RESULTS_DIR / f"{commit or 'local'}-{num_docs}.json"
+  output.parent.mkdir(parents=True, exist_ok=True)
+  output.write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+  print(json.dumps(results, indent=2))
+  print(f"Results written to {output}")
+  return results
+
+
+if __name__ == "__main__":
+  main()
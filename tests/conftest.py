@@ -0,0 +1,51 @@
+# Shared setup of the tests
+#
+# They run without a Redis server or a crawl: the in-process Redis stand-in of the benchmarks and a throwaway
+# SQLite database filled with the synthetic corpus. Both have to be in place before app is imported
+# (settings and the Redis client are created at import time), so this runs first.
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ["SQLITE_DB"] = os.path.join(tempfile.mkdtemp(prefix="searcheng-tests-"), "articles.db")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from benchmarks.corpus import SyntheticCorpus  # noqa: E402
+from benchmarks.local_redis import install_local_redis  # noqa: E402
+from benchmarks.run_benchmarks import populate_database  # noqa: E402
+
+local_redis = install_local_redis()
+
+TEST_DOCS = 400
+
+
+@pytest.fixture(scope="session")
+def corpus():
+  """The synthetic corpus in the test database, with its TF-IDF data and inverted index built"""
+  from app.services.build_inv_index import build_inverted_index
+  from app.services.build_tfidf_data import build_tfidf_data
+
+  synthetic = SyntheticCorpus(TEST_DOCS, vocabulary_size=5000, doc_words=200)
+  populate_database(synthetic)
+  build_tfidf_data()
+  build_inverted_index()
+  return synthetic
+
+
+@pytest.fixture
+def changes(corpus):
+  """Deletes and updates (services/tombstones.py) made by a test are undone afterwards, queue and bits"""
+  from app.services import tombstones
+  from app.services.redis_client import claim_dirty_docs, clear_tombstones, finish_dirty_docs, load_tombstones
+
+  yield
+  # Taken off the compaction queue first, clear_tombstones keeps the bits of queued documents
+  finish_dirty_docs(claim_dirty_docs())
+  clear_tombstones(list(range(len(load_tombstones() or b"") * 8)))
+  tombstones.reload_tombstones()
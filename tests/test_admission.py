@@ -0,0 +1,55 @@
+# Admission control (services/admission.py): while every slot is busy a broad ranked query runs degraded,
+# a broad boolean query can't be degraded and has to queue
+
+import asyncio
+
+import pytest
+
+from app.core.config import settings
+from app.services import build_inv_index
+from app.services.admission import AdmissionController, AdmissionRejected
+
+LIMITS = {
+  "SEARCH_MAX_CONCURRENCY": 1,
+  "SEARCH_MAX_QUEUED": 0,
+  "SEARCH_MAX_DEGRADED_CONCURRENCY": 2,
+  "SEARCH_DEGRADE_MIN_COST": 10,
+  "SEARCH_DEGRADED_POSTINGS_PER_TERM": 5,
+}
+
+
+@pytest.fixture
+def busy(corpus, monkeypatch):
+  """An admission controller whose only slot is taken"""
+  for name, value in LIMITS.items():
+    monkeypatch.setattr(settings, name, value)
+  controller = AdmissionController()
+
+  async def admit_while_busy(query: str):
+    first = await controller.admit("anything")
+    try:
+      return await controller.admit(query)
+    finally:
+      controller.release(first)
+
+  return lambda query: asyncio.run(admit_while_busy(query))
+
+
+def broad_terms():
+  index = build_inv_index.get_inverted_index()
+  return sorted(index.vocabulary, key=lambda term: (-index.document_frequency(term), term))[:2]
+
+
+def test_broad_query_runs_degraded_when_busy(busy):
+  first, second = broad_terms()
+  admission = busy(f"{first} {second}")
+  assert admission.max_postings_per_term == settings.SEARCH_DEGRADED_POSTINGS_PER_TERM
+
+
+def test_broad_boolean_query_queues_instead(busy):
+  first, second = broad_terms()
+  for query in (f"{first} AND {second}", f"{first} OR {second}", f"{first} -{second}"):
+    with pytest.raises(AdmissionRejected) as rejected:
+      busy(query)  # no queue room in LIMITS, so queueing means a 429
+    assert rejected.value.status_code == 429
+    assert "searches are waiting" in rejected.value.detail
@@ -0,0 +1,179 @@
+# Boolean queries (services/boolean_query.py): how queries are parsed, and the matches and scores a brute force
+# evaluation of the query tree gives, with the doc-id ordered views cached in a bounded LRU that deletes and
+# updates leave alone
+
+import random
+from array import array
+from bisect import bisect_left
+
+import pytest
+
+from app.core.config import settings
+from app.services import boolean_query, build_inv_index, tombstones
+from app.services.boolean_query import Cursor, DocPostings, evaluate, intersect, parse_query
+
+
+def document_terms(terms):
+  """doc_id -> {term: score} of every live document containing one of terms, the overlay included"""
+  index = build_inv_index.inverted_index
+  documents = {}
+  for term in terms:
+    for doc_id, score in index.get(term, []):
+      if not tombstones.is_tombstoned(doc_id):
+        documents.setdefault(doc_id, {})[term] = score
+  for doc_id, scores in tombstones.overlay_docs.items():
+    documents[doc_id] = {term: score for term, score in scores.items() if term in terms}
+  return documents
+
+
+def brute_force_score(node, scores):
+  """The score of a document with these term scores, None if it doesn't match"""
+  if node is None:
+    return None
+  if node[0] == "term":
+    return scores.get(node[1])
+  kind, positives, negatives = node
+  if not positives or any(brute_force_score(child, scores) is not None for child in negatives):
+    return None
+  matched = [score for score in (brute_force_score(child, scores) for child in positives) if score is not None]
+  if not matched or (kind == "and" and len(matched) < len(positives)):
+    return None
+  return sum(matched)
+
+
+def expected_matches(query):
+  tree = parse_query(query)
+  terms = set(boolean_query.query_terms(tree))
+  expected = {}
+  for doc_id, scores in document_terms(terms).items():
+    score = brute_force_score(tree, scores)
+    if score is not None:
+      expected[doc_id] = score
+  return expected
+
+
+def matches(query):
+  result = evaluate(parse_query(query), build_inv_index.inverted_index)
+  assert list(result.doc_ids) == sorted(result.doc_ids)
+  return dict(zip(result.doc_ids, result.scores))
+
+
+def assert_same(query):
+  found, expected = matches(query), expected_matches(query)
+  assert found.keys() == expected.keys(), query
+  for doc_id, score in expected.items():
+    assert found[doc_id] == pytest.approx(score), query
+
+
+def common_terms(count, skip=0):
+  """count terms in order of document frequency, after the skip most frequent ones"""
+  index = build_inv_index.get_inverted_index()
+  return sorted(index.vocabulary, key=lambda term: (-index.document_frequency(term), term))[skip:skip + count]
+
+
+@pytest.mark.parametrize("query, tree", [
+  # Terms next to each other are OR'ed, an exclusion belongs to the group it is written in
+  ("solar panel -roof", ("or", [("term", "solar"), ("term", "panel")], [("term", "roof")])),
+  ("solar AND NOT panel", ("and", [("term", "solar")], [("term", "panel")])),
+  ("solar AND (panel OR cell) -roof", (
+    "or", [("and", [("term", "solar"), ("or", [("term", "panel"), ("term", "cell")], [])], [])], [("term", "roof")]
+  )),
+  ("(solar OR (panel AND cell)) AND NOT (roof OR tile)", (
+    "and",
+    [("or", [("term", "solar"), ("and", [("term", "panel"), ("term", "cell")], [])], [])],
+    [("or", [("term", "roof"), ("term", "tile")], [])],
+  )),
+  ("NOT solar", ("or", [], [("term", "solar")])),  # only an exclusion, matches nothing
+  # Stop words drop out, dangling operators and parentheses are ignored, operators only count in capitals
+  ("the AND solar", ("term", "solar")),
+  ("solar AND", ("term", "solar")),
+  ("solar)", ("term", "solar")),
+  ("solar and panel", ("or", [("term", "solar"), ("term", "panel")], [])),
+])
+def test_parse_query(query, tree):
+  assert parse_query(query) == tree
+
+
+def test_cursor_advance_lands_where_a_binary_search_does():
+  rng = random.Random(7)
+  doc_ids = sorted(rng.sample(range(1, 100000), 5000))
+  postings = DocPostings(array("i", doc_ids), array("d", [1.0] * len(doc_ids)))
+  assert postings.skip_step == 70
+  cursor = Cursor(postings)
+  for target in sorted(rng.sample(range(0, 100001), 500)):
+    cursor.advance(target)
+    assert cursor.pos == bisect_left(doc_ids, target)
+
+
+def test_intersection_is_driven_by_the_shortest_list(monkeypatch):
+  long = DocPostings(array("i", range(0, 200000, 2)), array("d", [1.0] * 100000))
+  short = DocPostings(array("i", [4, 5, 1000, 150001, 199998]), array("d", [2.0] * 5))
+  excluded = DocPostings(array("i", [1000]), array("d", [3.0]))
+  visited = []
+
+  class CountingCursor(Cursor):
+    def advance(self, target):
+      visited.append(target)
+      super().advance(target)
+
+  monkeypatch.setattr(boolean_query, "Cursor", CountingCursor)
+  result = intersect([long, short], [excluded])
+  assert list(result.doc_ids) == [4, 199998] and list(result.scores) == [3.0, 3.0]
+  assert len(visited) < 20  # a handful of skips, not a walk over the 100000 long postings
+
+
+def random_query(rng, terms, depth=0):
+  """A query string with AND / OR / NOT / -term and nested groups"""
+  if depth >= 2 or rng.random() < 0.3:
+    term = rng.choice(terms)
+    return rng.choice([term, term, f"-{term}", f"NOT {term}"])
+  children = [random_query(rng, terms, depth + 1) for _ in range(rng.randint(2, 3))]
+  children[0] = children[0].lstrip("-").replace("NOT ", "")  # at least one part that matches something
+  operator = rng.choice([" AND ", " OR ", " "])
+  group = operator.join(children)
+  return f"NOT ({group})" if depth and rng.random() < 0.2 else f"({group})"
+
+
+def test_random_queries_match_a_brute_force_evaluation(corpus):
+  rng = random.Random(3)
+  terms = common_terms(6, skip=10) + common_terms(6, skip=300)  # lists of ~300 and ~30 documents
+  checked = 0
+  for _ in range(300):
+    query = random_query(rng, terms)
+    assert_same(query)
+    checked += bool(expected_matches(query))
+  assert checked > 100
+
+
+def test_views_are_kept_in_a_bounded_lru(corpus, monkeypatch):
+  monkeypatch.setattr(settings, "BOOLEAN_CACHED_TERMS", 3)
+  terms = common_terms(6)
+  for first, second in zip(terms[::2], terms[1::2]):
+    matches(f"{first} AND {second}")
+  assert list(boolean_query.doc_ordered_cache) == terms[-3:]
+
+  matches(terms[3])  # used again, so the oldest one goes next
+  matches(f"{terms[0]} AND {terms[1]}")
+  assert list(boolean_query.doc_ordered_cache) == [terms[3], terms[0], terms[1]]
+
+
+def test_deletes_and_updates_match_without_rebuilding_the_views(changes):
+  first, second, third = common_terms(3, skip=20)  # in about 60% of the documents each
+  query = f"{first} AND {second} -{third}"
+  assert_same(query)
+  views = {term: boolean_query.doc_ordered_cache[term][1] for term in (first, second, third)}
+
+  both = sorted(set(matches(f"{first} AND {second}")))
+  deleted, updated, emptied = both[:3]
+  tombstones.mark_deleted(deleted)
+  tombstones.mark_updated(updated, [first, second, second], "title", "https://example.com", "content")
+  tombstones.mark_updated(emptied, [first, third], "title", "https://example.com", "content")
+  outside = next(doc_id for doc_id in range(1, build_inv_index.inverted_index.max_doc_id + 1) if doc_id not in both)
+  tombstones.mark_updated(outside, [first, second], "title", "https://example.com", "content")
+
+  found = matches(query)
+  assert deleted not in found and emptied not in found
+  assert found[updated] == pytest.approx(sum(tombstones.overlay_docs[updated].values()))
+  assert outside in found
+  assert_same(query)
+  assert all(boolean_query.doc_ordered_cache[term][1] is view for term, view in views.items())
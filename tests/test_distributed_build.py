@@ -0,0 +1,102 @@
+# A distributed build (services/distributed_build.py) must give the index a single-worker build gives,
+# also when the PRUNE_* settings prune it
+
+import pytest
+
+from app.core.config import settings
+from app.services import build_inv_index, distributed_build
+from app.services import build_tfidf_data as tfidf_data
+from app.services.build_tfidf_data import build_tfidf_data, replace_tfidf_data
+
+PRUNING = {"PRUNE_MIN_DF": 2, "PRUNE_MAX_DF_RATIO": 0.6, "PRUNE_MAX_POSTINGS_PER_TERM": 25}
+
+
+@pytest.fixture
+def pruning(corpus):
+  previous = {name: getattr(settings, name) for name in PRUNING}
+  for name, value in PRUNING.items():
+    setattr(settings, name, value)
+  yield
+  for name, value in previous.items():
+    setattr(settings, name, value)
+  # Leave the unpruned index of the corpus fixture for the other tests
+  build_tfidf_data()
+  build_inv_index.build_inverted_index()
+
+
+@pytest.fixture
+def stemming(corpus, monkeypatch):
+  monkeypatch.setattr(settings, "STEMMING_ENABLED", True)
+  yield
+  monkeypatch.undo()
+  # Leave the unstemmed index of the corpus fixture for the other tests
+  build_tfidf_data()
+  build_inv_index.build_inverted_index()
+
+
+def published_postings():
+  """term -> its postings across every segment of the published index"""
+  assert build_inv_index.load_published_index()
+  index = build_inv_index.inverted_index
+  return {
+    term: sorted(posting for postings, _ in index.postings_lists(term) for posting in postings)
+    for term in index.vocabulary
+  }
+
+
+def score_distributed_build(build_id: str, chunk_size: int):
+  """The chord steps of tasks/indexing_tasks.py up to the publish: (scored chunks, max doc id)"""
+  chunks = [distributed_build.map_chunk(build_id, first_id, last_id) for first_id, last_id in distributed_build.plan_chunks(chunk_size)]
+  distributed_build.count_document_frequencies(build_id, chunks)
+  scored = [distributed_build.score_chunk(build_id, chunk) for chunk in chunks]
+  return scored, max(chunk["last_id"] for chunk in chunks)
+
+
+def run_distributed_build(chunk_size: int):
+  """The chord steps of tasks/indexing_tasks.py, called in order"""
+  scored, max_doc_id = score_distributed_build("test", chunk_size)
+  distributed_build.publish_build("test", scored, max_doc_id)
+  return len(scored)
+
+
+def test_pruned_distributed_build_matches_single_worker_build(pruning):
+  build_tfidf_data()
+  build_inv_index.build_inverted_index()
+  single_postings = published_postings()
+  single_stats = build_inv_index.pruning_stats
+  assert single_stats.get("terms_truncated")  # the settings above really cut some lists
+
+  assert run_distributed_build(chunk_size=97) > 1
+  assert published_postings() == single_postings
+  assert build_inv_index.pruning_stats == single_stats
+
+
+def test_failed_publish_keeps_the_statistics_and_the_build_for_a_retry(corpus, monkeypatch):
+  build_tfidf_data()
+  build_inv_index.build_inverted_index()
+  expected = {term: [doc_id for doc_id, _ in postings] for term, postings in published_postings().items()}
+  scored, max_doc_id = score_distributed_build("retry", chunk_size=97)
+
+  replace_tfidf_data(1, {"marker": 1})  # statistics the currently published segments would go with
+  monkeypatch.setattr(build_inv_index, "publish_segment_manifest", lambda manifest: None)
+  with pytest.raises(RuntimeError):
+    distributed_build.publish_build("retry", scored, max_doc_id)
+  assert tfidf_data.total_document_count == 1 and tfidf_data.document_frequencies == {"marker": 1}
+
+  # The chunks and statistics of the build are still there, the task's retry publishes it
+  monkeypatch.undo()
+  distributed_build.publish_build("retry", scored, max_doc_id)
+  assert tfidf_data.total_document_count == corpus.num_docs
+  assert {term: [doc_id for doc_id, _ in postings] for term, postings in published_postings().items()} == expected
+
+
+def test_stemmed_distributed_build_keeps_the_surface_forms(stemming):
+  build_tfidf_data()
+  single_forms = tfidf_data.surface_forms
+  assert single_forms
+
+  replace_tfidf_data(1, {"marker": 1}, {})
+  run_distributed_build(chunk_size=97)
+  assert tfidf_data.surface_forms == single_forms
+  tfidf_data.get_prebuilt_tfidf_data()  # and as saved in Redis
+  assert tfidf_data.surface_forms == single_forms
@@ -0,0 +1,63 @@
+# Spelling correction (services/fuzzy.py): what it finds, and that a search never waits for a rebuild
+
+import time
+
+import pytest
+
+from app.services import build_inv_index, fuzzy
+
+
+@pytest.fixture
+def vocabulary(corpus):
+  fuzzy.refresh_fuzzy_index(force=True)
+  index = build_inv_index.get_inverted_index()
+  # Long terms: deleting a character from one of them hardly ever gives another term
+  return [term for term in sorted(index.vocabulary) if len(term) >= 8][:200]
+
+
+def test_corrects_one_edit(vocabulary):
+  index = build_inv_index.inverted_index
+  for term in vocabulary[:50]:
+    typo = term[:2] + term[3:]  # a deleted character
+    assert typo not in index
+    assert fuzzy.correct_terms([typo], index).get(typo) is not None
+
+
+def test_corrects_two_substitutions_in_the_prefix(vocabulary):
+  index = build_inv_index.inverted_index
+  corrected = 0
+  for term in vocabulary:
+    typo = term[0] + "q" + term[2] + "q" + term[4:]  # like abcdef -> aqcqef
+    if typo in index or fuzzy.edit_distance(typo, term, 2) != 2:
+      continue
+    matches = fuzzy.find_corrections(typo, time.perf_counter() + 1, limit=50)
+    assert term in [match[0] for match in matches], typo
+    corrected += 1
+  assert corrected > 100
+
+
+def test_a_stale_index_is_rebuilt_in_the_background(vocabulary, monkeypatch):
+  index = build_inv_index.inverted_index
+  term = vocabulary[0]
+  typo = term[:2] + term[3:]
+  expected = fuzzy.correct_terms([typo], index)
+  previous = fuzzy.fuzzy_index
+
+  build = fuzzy.build_fuzzy_index
+
+  def slow_build(inverted_index):
+    time.sleep(0.5)
+    return build(inverted_index)
+
+  monkeypatch.setattr(fuzzy, "build_fuzzy_index", slow_build)
+  monkeypatch.setattr(build_inv_index, "loaded_generation", build_inv_index.loaded_generation + 1)
+
+  start = time.perf_counter()
+  assert fuzzy.correct_terms([typo], index) == expected  # answered by the previous build
+  assert time.perf_counter() - start < 0.25
+  assert fuzzy.fuzzy_index is previous
+
+  fuzzy.background_rebuild.wait()
+  assert fuzzy.fuzzy_index is not previous
+  assert fuzzy.built_for[0] == build_inv_index.loaded_generation
+  assert not fuzzy.is_stale(index)
@@ -0,0 +1,96 @@
+# Searches run in worker threads while the setup pipeline adds documents to the index in place
+# (services/index_lock.py) and DELETE / PUT change the overlay (services/tombstones.py): no search may see
+# any of them half done
+
+import random
+import threading
+import time
+
+import pytest
+
+from app.services import build_inv_index, tombstones
+from app.services.build_tfidf_data import build_tfidf_data
+from app.services.index_lock import ReadWriteLock
+from app.services.search_logic import perform_search, perform_similar_search
+from app.services.suggest import suggest
+
+
+@pytest.fixture
+def growing_index(changes):
+  yield build_inv_index.inverted_index
+  # Leave the index of the corpus fixture, without the added documents, for the other tests
+  build_tfidf_data()
+  build_inv_index.build_inverted_index()
+
+
+def test_writer_waits_for_readers_and_blocks_new_ones():
+  lock = ReadWriteLock()
+  events = []
+  reading = threading.Event()
+
+  def writer():
+    with lock.writing():
+      events.append("write")
+
+  def late_reader():
+    with lock.reading():
+      events.append("late read")
+
+  with lock.reading():
+    reading.set()
+    write = threading.Thread(target=writer)
+    write.start()
+    time.sleep(0.05)
+    read = threading.Thread(target=late_reader)
+    read.start()  # a writer is waiting, this reader queues behind it
+    time.sleep(0.05)
+    events.append("first read done")
+  write.join()
+  read.join()
+  assert events == ["first read done", "write", "late read"]
+
+
+def test_searches_while_documents_are_added(growing_index):
+  doc_count = growing_index.doc_count
+  terms = sorted(growing_index.vocabulary, key=growing_index.document_frequency, reverse=True)[:300]
+  errors = []
+  stop = threading.Event()
+
+  def keep_searching(seed: int):
+    rng = random.Random(seed)
+    while not stop.is_set():
+      try:
+        perform_search(" ".join(rng.sample(terms, 3)) + f" q{rng.random()}", 10)
+        perform_search(f"{rng.choice(terms[:50])} AND {rng.choice(terms[:50])}", 10)
+        suggest(rng.choice(terms)[:2])
+        perform_similar_search(rng.randint(1, doc_count), 5)
+      except Exception as e:
+        errors.append(e)
+        stop.set()
+
+  def keep_changing():
+    rng = random.Random(-1)
+    while not stop.is_set():
+      doc_id = rng.randint(1, doc_count)
+      if rng.random() < 0.3:
+        tombstones.mark_deleted(doc_id)
+      else:
+        tombstones.mark_updated(doc_id, rng.sample(terms, 30), "title", "https://example.com", "content")
+
+  searchers = [threading.Thread(target=keep_searching, args=(seed,)) for seed in range(4)]
+  searchers.append(threading.Thread(target=keep_changing))
+  for searcher in searchers:
+    searcher.start()
+  rng = random.Random(0)
+  added = []
+  for batch in range(150):
+    documents = [(100000 + batch * 10 + i, rng.sample(terms, 40) + [f"added{batch}x{i}"]) for i in range(10)]
+    build_inv_index.add_documents_to_index(documents)
+    added.extend(documents)
+  stop.set()
+  for searcher in searchers:
+    searcher.join()
+
+  assert not errors, errors
+  doc_id, tokens = added[-1]
+  assert doc_id in [posting[0] for posting in growing_index.get(tokens[-1], [])]
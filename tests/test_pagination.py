@@ -0,0 +1,75 @@
+# Pagination of /search (services/result_cache.py): pages by offset or cursor follow one ranking, later pages
+# come from the ranked result cache, and a delete / update or a new index generation never serves a stale one
+
+import pytest
+
+from app.services import build_inv_index, tombstones
+from app.services.result_cache import decode_cursor, ranked_result_cache
+from app.services.search_logic import perform_search
+
+
+@pytest.fixture
+def query(changes):
+  """Two terms most documents contain, so there are many pages. Starts from an empty cache"""
+  index = build_inv_index.get_inverted_index()
+  first, second = sorted(index.vocabulary, key=lambda term: (-index.document_frequency(term), term))[10:12]
+  ranked_result_cache.clear()
+  return f"{first} {second}"
+
+
+def page(query, offset=0, limit=10):
+  response = perform_search(query, limit, debug=True, offset=offset)
+  return [result["id"] for result in response["search_results"]], response
+
+
+def test_pages_follow_one_ranking(query):
+  full, first = page(query, limit=100)
+  total = first["total_matches"]
+  assert total > 100
+
+  offset, pages = 0, []
+  while offset < 100:
+    ids, response = page(query, offset)
+    assert response["total_matches"] == total
+    pages += ids
+    # The cursor points at the next page, for this query only
+    offset = decode_cursor(query, response["next_cursor"])
+    assert offset == len(pages)
+  assert pages == full
+
+  ids, last = page(query, total - 5)
+  assert len(ids) == 5 and last["next_cursor"] is None
+
+
+def test_later_pages_come_from_the_cache(query):
+  assert not page(query)[1]["debug"]["result_cache_hit"]
+  assert page(query, offset=10)[1]["debug"]["result_cache_hit"]
+  assert page(query, offset=20)[1]["debug"]["result_cache_hit"]
+
+
+def test_a_cursor_only_works_for_its_query(query):
+  cursor = page(query)[1]["next_cursor"]
+  assert decode_cursor(query, cursor) == 10
+  with pytest.raises(ValueError):
+    decode_cursor(f"{query} more", cursor)
+  with pytest.raises(ValueError):
+    decode_cursor(query, "not a cursor")
+
+
+def test_deletes_updates_and_new_generations_drop_cached_rankings(query):
+  ids, _ = page(query)
+  top = ids[0]
+  assert page(query, offset=10)[1]["debug"]["result_cache_hit"]
+
+  tombstones.mark_deleted(top)
+  ids, response = page(query)
+  assert not response["debug"]["result_cache_hit"] and top not in ids
+
+  updated = ids[0]
+  tombstones.mark_updated(updated, ["nothing", "in", "common"], "title", "https://example.com", "content")
+  ids, response = page(query)
+  assert not response["debug"]["result_cache_hit"] and updated not in ids
+
+  assert page(query, offset=10)[1]["debug"]["result_cache_hit"]
+  build_inv_index.build_inverted_index()  # publishes a new generation
+  assert not page(query, offset=10)[1]["debug"]["result_cache_hit"]
@@ -0,0 +1,114 @@
+# Incremental recrawl (crawler/recrawl.py) against a local stand-in for the article server: every page lands in
+# the right bucket, stored validators turn into conditional GETs, and a changed article stays searchable with its
+# new content once the API reloads the tombstones (tasks/crawl_tasks.py only sets its bit)
+
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.crawler.recrawl import recrawl_articles_async
+from app.db.database_utils import delete_article, fetch_articles_by_ids
+from app.services import tombstones
+from app.services.redis_client import add_tombstone
+from app.services.search_logic import perform_search
+
+LAST_MODIFIED = "Mon, 05 Oct 2026 10:00:00 GMT"
+
+
+class ArticleServer(BaseHTTPRequestHandler):
+  """Serves pages like a wiki would: path -> (paragraph text, ETag, Last-Modified), and keeps the request headers"""
+
+  pages = {}
+  requests = []
+
+  def do_GET(self):
+    type(self).requests.append((self.path, dict(self.headers)))
+    text, etag, last_modified = self.pages[self.path]
+    if etag and self.headers.get("If-None-Match") == etag:
+      self.send_response(304)
+      self.end_headers()
+      return
+    # If-Modified-Since is ignored, like servers that always send the page: the content hash has to tell
+    body = f'<html><body><div id="mw-content-text"><p>{text}</p></div></body></html>'.encode()
+    self.send_response(200)
+    self.send_header("Content-Type", "text/html; charset=utf-8")
+    self.send_header("Content-Length", str(len(body)))
+    if etag:
+      self.send_header("ETag", etag)
+    if last_modified:
+      self.send_header("Last-Modified", last_modified)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+@pytest.fixture
+def server(changes):
+  ArticleServer.pages = {}
+  ArticleServer.requests = []
+  httpd = ThreadingHTTPServer(("127.0.0.1", 0), ArticleServer)
+  threading.Thread(target=httpd.serve_forever, daemon=True).start()
+  written = []
+  yield httpd, written
+  httpd.shutdown()
+  # Leave the database of the corpus fixture for the other tests
+  for doc_id in written:
+    delete_article(doc_id)
+
+
+def recrawl(httpd, written, paths):
+  articles = [{"title": path.strip("/"), "link": f"http://127.0.0.1:{httpd.server_port}{path}"} for path in paths]
+  summary = asyncio.run(recrawl_articles_async(articles))
+  written.extend(summary["changed_doc_ids"])
+  return summary
+
+
+def test_recrawl_classifies_pages_and_sends_conditional_gets(server):
+  httpd, written = server
+  ArticleServer.pages = {
+    "/etag": ("zorbleflax served with an etag", '"etag-1"', None),
+    "/modified": ("quillfrond served with last modified", None, LAST_MODIFIED),
+    "/changing": ("vintrapol before the edit", None, None),
+  }
+  first = recrawl(httpd, written, ["/etag", "/modified", "/changing"])
+  assert (first["new"], first["changed"], first["not_modified"], first["unchanged"]) == (3, 0, 0, 0)
+  assert len(first["new_doc_ids"]) == 3
+
+  ArticleServer.requests = []
+  ArticleServer.pages["/changing"] = ("vintrapol after the edit with glimmerhorn", None, None)
+  ArticleServer.pages["/added"] = ("brantwhistle a new page", None, None)
+  second = recrawl(httpd, written, ["/etag", "/modified", "/changing", "/added"])
+  assert (second["new"], second["changed"], second["not_modified"], second["unchanged"], second["failed"]) == (1, 1, 1, 1, 0)
+
+  headers = dict(ArticleServer.requests)
+  assert headers["/etag"].get("If-None-Match") == '"etag-1"'
+  assert headers["/modified"].get("If-Modified-Since") == LAST_MODIFIED
+  assert "If-None-Match" not in headers["/changing"] and "If-Modified-Since" not in headers["/changing"]
+
+  # Only the changed and the new page were written (in the order they came back), the new one is told apart
+  (added_id,) = second["new_doc_ids"]
+  (changed_id,) = set(second["changed_doc_ids"]) - {added_id}
+  assert {article["id"]: article["content"] for article in fetch_articles_by_ids([changed_id, added_id])} == {
+    changed_id: "vintrapol after the edit with glimmerhorn",
+    added_id: "brantwhistle a new page",
+  }
+
+
+def test_changed_article_is_searched_with_its_new_content_after_a_reload(server):
+  httpd, written = server
+  ArticleServer.pages = {"/changing": ("vintrapol before the edit", None, None)}
+  recrawl(httpd, written, ["/changing"])
+  ArticleServer.pages["/changing"] = ("vintrapol after the edit with glimmerhorn", None, None)
+  (doc_id,) = recrawl(httpd, written, ["/changing"])["changed_doc_ids"]
+
+  add_tombstone(doc_id)  # what crawl_tasks.recrawl_articles does in the worker
+  tombstones.reload_tombstones()  # the API's next index reload
+
+  assert tombstones.is_tombstoned(doc_id)
+  results = perform_search("glimmerhorn", 10)["search_results"]
+  assert [result["id"] for result in results] == [doc_id]
+  assert "glimmerhorn" in results[0]["content_preview"]
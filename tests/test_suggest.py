@@ -0,0 +1,82 @@
+# Autocomplete (services/suggest.py): the right completions (words, not stems), and a keystroke never waits
+# for a rebuild
+
+import time
+
+import pytest
+
+from app.core.config import settings
+from app.services import build_tfidf_data, suggest
+from app.db.database_utils import fetch_all_articles
+from app.services.tfidf import preprocess_text, stem
+
+
+@pytest.fixture
+def suggestions(corpus):
+  suggest.refresh_suggest_index(force=True)
+  yield
+  suggest.background_rebuild.wait()
+
+
+@pytest.fixture
+def stemmed_suggestions(corpus, monkeypatch):
+  monkeypatch.setattr(settings, "STEMMING_ENABLED", True)
+  build_tfidf_data.build_tfidf_data()
+  suggest.refresh_suggest_index(force=True)
+  yield
+  monkeypatch.undo()
+  # Leave the unstemmed statistics of the corpus fixture for the other tests
+  build_tfidf_data.build_tfidf_data()
+  suggest.refresh_suggest_index(force=True)
+
+
+def expected_completions(prefix: str, limit: int):
+  matching = [(term, df) for term, df in build_tfidf_data.document_frequencies.items() if term.startswith(prefix)]
+  return sorted(matching, key=lambda item: (-item[1], item[0]))[:limit]
+
+
+def test_completions_are_the_most_frequent_terms_with_the_prefix(suggestions):
+  terms = sorted(build_tfidf_data.document_frequencies)
+  prefixes = {term[:length] for term in terms[::50] for length in (1, 2, 3, 4, 6)}
+  for prefix in sorted(prefixes):
+    assert suggest.suggest(prefix, 10) == expected_completions(prefix, 10), prefix
+
+
+def test_a_new_generation_is_picked_up_in_the_background(suggestions, monkeypatch):
+  previous = suggest.suggest_index
+  prefix = min(build_tfidf_data.document_frequencies)[:2]
+  expected = suggest.suggest(prefix, 5)
+
+  build = suggest.build_suggest_index
+
+  def slow_build(*args):
+    time.sleep(0.5)
+    return build(*args)
+
+  monkeypatch.setattr(suggest, "build_suggest_index", slow_build)
+  monkeypatch.setattr(suggest, "built_for", (-1, 0))  # built for some older generation
+  monkeypatch.setattr(suggest, "last_generation_check", 0.0)
+
+  start = time.perf_counter()
+  assert suggest.suggest(prefix, 5) == expected  # the previous structures answer
+  assert time.perf_counter() - start < 0.25
+  assert suggest.suggest_index is previous
+
+  suggest.background_rebuild.wait()
+  assert suggest.suggest_index is not previous
+  assert suggest.suggest(prefix, 5) == expected
+
+
+def test_stemmed_terms_are_suggested_as_words(stemmed_suggestions):
+  words = {word for article in fetch_all_articles() for word in preprocess_text(f"{article['title']} {article['content']}", stemming=False)}
+  forms = build_tfidf_data.surface_forms
+  assert len(forms) > 100  # the synthetic words do get stemmed ("traistfe" -> "traistf")
+  for term, form in sorted(forms.items())[::10]:
+    assert stem(form) == term and form in words
+    completions = [completion for completion, _ in suggest.suggest(form, 10)]
+    assert form in completions and term not in completions, form
+
+  terms = sorted(build_tfidf_data.document_frequencies)
+  for prefix in sorted({term[:length] for term in terms[::50] for length in (1, 2, 4)}):
+    for completion, _ in suggest.suggest(prefix, 10):
+      assert completion in words, completion
@@ -0,0 +1,95 @@
+# Deleting and updating documents (services/tombstones.py): tombstoned postings are masked on both scoring paths,
+# updated documents are scored from the overlay, and compaction folds both into the index
+
+import math
+from datetime import datetime, timezone
+
+import pytest
+
+from app.core.config import settings
+from app.db.database_utils import delete_article, insert_articles, update_article
+from app.services import build_inv_index, build_tfidf_data, tombstones
+from app.services.result_cache import ranked_result_cache
+from app.services.search_logic import perform_search
+from app.services.tfidf import calculate_tfidf
+
+
+@pytest.fixture
+def articles(changes):
+  """Two articles of their own in the database and the index, so a test may really delete or change them"""
+  now = datetime.now(timezone.utc).isoformat()
+  inserted = insert_articles([
+    {"title": "Plimbarrow", "url": "https://example.com/plimbarrow", "content": "plimbarrow quorvexold", "retrieved_at": now},
+    {"title": "Snargleboot", "url": "https://example.com/snargleboot", "content": "snargleboot", "retrieved_at": now},
+  ])
+  build_tfidf_data.build_tfidf_data()
+  build_inv_index.build_inverted_index()
+  yield [doc_id for doc_id, _ in inserted]
+  for doc_id, _ in inserted:
+    delete_article(doc_id)
+  # Leave the index of the corpus fixture for the other tests
+  build_tfidf_data.build_tfidf_data()
+  build_inv_index.build_inverted_index()
+
+
+def found(query):
+  ranked_result_cache.clear()
+  return {result["id"]: result for result in perform_search(query, 50)["search_results"]}
+
+
+@pytest.mark.parametrize("min_postings", [10 ** 9, 0], ids=["dict", "vectorized"])
+def test_deleted_and_updated_documents_are_masked(changes, monkeypatch, min_postings):
+  monkeypatch.setattr(settings, "SEARCH_VECTORIZED_MIN_POSTINGS", min_postings)
+  index = build_inv_index.get_inverted_index()
+  term = sorted(index.vocabulary, key=lambda term: (-index.document_frequency(term), term))[30]
+  deleted, updated = list(found(term))[:2]
+
+  tombstones.mark_deleted(deleted)
+  tombstones.mark_updated(updated, ["nothing", "in", "common"], "title", "https://example.com", "content")
+  results = found(term)
+  assert deleted not in results and updated not in results
+  assert len(results) == min(50, index.document_frequency(term) - 2)
+
+
+def test_updated_documents_are_scored_from_the_overlay(changes):
+  index = build_inv_index.get_inverted_index()
+  term = sorted(index.vocabulary, key=lambda term: (-index.document_frequency(term), term))[30]
+  doc_id = list(found(term))[0]
+  tokens = [term, term, "zindleprawn", "other"]
+
+  tombstones.mark_updated(doc_id, tokens, "New title", "https://example.com/new", "zindleprawn new content")
+  # Scored with the IDF of the corpus, a term the index doesn't know gets the IDF of a term in one document
+  idf = {token: build_tfidf_data.idf_scores.get(token, math.log(build_tfidf_data.total_document_count)) for token in tokens}
+  expected = calculate_tfidf(tokens, idf)
+
+  result = found(f"{term} zindleprawn")[doc_id]
+  assert result["relevance_score"] == round(expected[term] + expected["zindleprawn"], 4)
+  assert result["title"] == "New title" and "zindleprawn" in result["content_preview"]
+
+
+def test_compaction_folds_the_changes_into_the_index(articles):
+  updated, deleted = articles
+  update_article(updated, "Plimbarrow", "https://example.com/plimbarrow", "plimbarrow quorvexnew", datetime.now(timezone.utc).isoformat())
+  tombstones.mark_updated(updated, ["plimbarrow", "plimbarrow", "plimbarrow", "quorvexnew"], "Plimbarrow", "https://example.com/plimbarrow", "plimbarrow quorvexnew")
+  delete_article(deleted)
+  tombstones.mark_deleted(deleted)
+
+  def searches():
+    return list(found("quorvexnew")), list(found("quorvexold")), list(found("snargleboot"))
+
+  assert searches() == ([updated], [], [])
+  generation = build_inv_index.loaded_generation
+  assert build_inv_index.compact_index() >= 2
+
+  # Compaction ran in this process and loaded its index already, what an API process reloads with it:
+  tombstones.reload_tombstones()
+  index = build_inv_index.get_inverted_index()
+  assert build_inv_index.loaded_generation != generation
+  assert updated not in tombstones.overlay_docs and not tombstones.is_tombstoned(updated)
+  assert tombstones.is_tombstoned(deleted)  # deleted documents keep their bit
+  assert [doc_id for doc_id, _ in index.get("quorvexnew", [])] == [updated]
+  # The stale postings are deleted in their segment, which keeps them until the next merge
+  assert index.get("quorvexold", []) == [] and index.get("snargleboot", []) == []
+  assert build_tfidf_data.document_frequencies.get("quorvexnew") == 1
+  assert build_tfidf_data.document_frequencies.get("quorvexold", 0) == 0
+  assert searches() == ([updated], [], [])
@@ -0,0 +1,34 @@
+# The vectorized scorer (services/vector_scoring.py) must rank exactly like the dict loop of search_terms
+
+import numpy as np
+
+from app.core.config import settings
+from app.services import build_inv_index
+from app.services.search_logic import rank_documents, search_terms
+from app.services.vector_scoring import DocumentScores
+
+
+def test_ties_at_the_cut_are_ordered_by_doc_id():
+  # Most candidates share one of three scores, so every cut below lands inside a run of equal scores
+  rng = np.random.default_rng(7)
+  doc_ids = rng.permutation(500).astype(np.int64)
+  scores = rng.choice([0.5, 0.25, 0.125], size=500)
+  as_dict = dict(zip(doc_ids.tolist(), scores.tolist()))
+
+  for count in (1, 10, 50, 137, 499, 500, 600):
+    assert DocumentScores(doc_ids, scores).top(count) == rank_documents(as_dict, count)
+
+
+def test_broad_queries_rank_the_same_on_both_paths(corpus, monkeypatch):
+  index = build_inv_index.get_inverted_index()
+  common_terms = sorted(index.vocabulary, key=lambda term: (-index.document_frequency(term), term))[:200]
+  queries = [[term] for term in common_terms[:40]]
+  queries += [common_terms[i:i + 3] for i in range(0, 120, 3)]
+
+  for query_terms in queries:
+    monkeypatch.setattr(settings, "SEARCH_VECTORIZED_MIN_POSTINGS", 10 ** 12)
+    dict_scores = search_terms(query_terms)
+    monkeypatch.setattr(settings, "SEARCH_VECTORIZED_MIN_POSTINGS", 0)
+    vector_scores = search_terms(query_terms)
+    assert isinstance(vector_scores, DocumentScores)
+    assert rank_documents(vector_scores, 50) == rank_documents(dict_scores, 50), query_terms